@@ -60,6 +60,33 @@
 #define MSG_HEADER_SIZE 2
 #define MSG_BODY_SIZE 4
 #define EXPECTED_MSG_LENGTH (MSG_HEADER_SIZE + MSG_BODY_SIZE)
+// 'ca' set commands carry one 4 byte body per channel
+#define ALL_CHANNELS_BODY_SIZE (MSG_BODY_SIZE * NUM_CHANNELS)
+
+/**
+ * Binary protocol, see arduino_communcation/protocol.py for the python side.
+ * Binary frames are fixed size and start with a sync byte that can never be the
+ * first byte of an ASCII command, so both protocols can be used on the same line.
+ *
+ * Command frame (11 bytes): sync | type | seq | channel mask | p0 | p1 | p2 | crc8
+ * Reply frame   (15 bytes): sync | type | seq | channel mask | millis | p0 | p1 | p2 | crc8
+ *
+ * Multi-byte fields are little-endian, pressures are uint16 centi-psi and the
+ * crc8 (polynomial 0x07) covers every byte before it.
+ */
+#define PROTOCOL_VERSION 1
+#define BIN_HOST_SYNC 0xA5
+#define BIN_ARDUINO_SYNC 0x5A
+#define BIN_COMMAND_SIZE 11
+#define BIN_REPLY_SIZE 15
+#define BIN_SET_PRESSURES 0x01
+#define BIN_READ_PRESSURES 0x02
+#define BIN_SELECT_CHANNELS 0x03
+#define BIN_STREAM 0x04
+#define BIN_ACK 0x81
+#define BIN_PRESSURES 0x82
+#define BIN_TELEMETRY 0x83
+#define BIN_NAK 0xFF
 
 // Enabled when our pressure sensor functions are defined here in file
 #define LOCAL_PRESSURE_SENSOR_FUNCTIONS
@@ -104,6 +131,12 @@ channelData channels[NUM_CHANNELS] =
     {OFF, HOLD, DEFAULT_PRESSURE, DEFAULT_PRESSURE, 8,   7, 48, 49, 160, POSITIVE_SOLENOID_DUTY_CYCLE}, // Channel 2
 };
 
+// Telemetry streaming, started and stopped with a BIN_STREAM command
+uint16_t streamPeriodMs = 0;    // Time between telemetry frames, 0 when not streaming
+uint8_t streamMask = 0;         // Channels included in the telemetry frames
+uint8_t streamSeq = 0;          // Free running sample counter sent as the sequence number
+uint32_t lastStreamMs = 0;      // millis() when the last telemetry frame was sent
+
 /*
  * @name  setup
  * @desc  called once on startup
@@ -142,7 +175,14 @@ void loop() {
 
     // Read in serial command if needed...
     // Arduino serial buffer holds 64 bytes
-    if (Serial.available() >= EXPECTED_MSG_LENGTH)
+    if (Serial.available() > 0 && Serial.peek() == BIN_HOST_SYNC)
+    {
+        if (Serial.available() >= BIN_COMMAND_SIZE)
+        {
+            handleBinaryCommand();
+        }
+    }
+    else if (Serial.available() >= EXPECTED_MSG_LENGTH)
     {
         handleCommand();
     }
@@ -244,6 +284,35 @@ void loop() {
         } 
     }
 
+    // Push a pressure sample if streaming. A sample can only go out once per
+    // pass through this loop, so the real rate is capped by the loop time
+    if (streamPeriodMs > 0 && (millis() - lastStreamMs) >= streamPeriodMs)
+    {
+        lastStreamMs = millis();
+        sendTelemetry();
+    }
+
+}
+
+/*
+ * @name    sendTelemetry
+ * @desc    Send the latest pressure of the streamed channels. Active channels
+ *          were just read by the control loop, inactive ones are read here
+ * @param   None
+ * @return  None
+ */
+void sendTelemetry(void)
+{
+    float pressures[NUM_CHANNELS];
+    for (uint8_t cNum = 0; cNum < NUM_CHANNELS; cNum++)
+    {
+        if ((streamMask & (1 << cNum)) && !channels[cNum].active)
+        {
+            channels[cNum].currentPressure = get_pressure(mpr, cNum);
+        }
+        pressures[cNum] = channels[cNum].currentPressure;
+    }
+    sendBinaryReply(BIN_TELEMETRY, streamSeq++, streamMask, pressures);
 }
 
 /*
@@ -263,6 +332,7 @@ void handleCommand(void)
      *      'c0' - command for channel 0
      *      'c1' - command for channel 1
      *      'c2' - command for channel 2
+     *      'ca' - command for all channels, see handleAllChannelsCommand()
      *      'sc' - select channel
      * 
      * The next 4 bytes is the body of the message.
@@ -298,6 +368,11 @@ void handleCommand(void)
     {
         cNum = 2;
     }
+    else if (strncmp(header, "ca", 2) == 0)
+    {
+        handleAllChannelsCommand();
+        return;
+    }
     else if (strncmp(header, "sc", 2) == 0)
     {
         handleSelectionCommand();
@@ -326,15 +401,90 @@ void handleCommand(void)
     {
         // Set pressure command...
         // Contains desired PSI (implied decimal XX.XX) for channels that are enabled
-        char pressure[5];
-        sprintf(pressure, "%c%c.%c%c", msg[0], msg[1], msg[2], msg[3]);
-        channels[cNum].desiredPressure = ((String(pressure)).toFloat());
+        setPressureFromBody(cNum, msg);
         // Send confirmation back
         Serial.println("rx");
     }
 
 }
 
+/*
+ * @name    setPressureFromBody
+ * @desc    Set the desired pressure of a channel from a 4 byte
+ *          message body with an implied decimal in the middle
+ * @param   cNum - channel to set
+ * @param   body - 4 digit pressure, e.g. '1225' for 12.25 psi
+ * @return  None
+ */
+void setPressureFromBody(uint8_t cNum, const char *body)
+{
+    char pressure[6];
+    sprintf(pressure, "%c%c.%c%c", body[0], body[1], body[2], body[3]);
+    channels[cNum].desiredPressure = ((String(pressure)).toFloat());
+}
+
+/*
+ * @name    handleAllChannelsCommand
+ * @desc    Handle a command that applies to every channel at once.
+ *          body options
+ *              'read' - read the pressure of every active channel and send
+ *                       them back on one line, comma separated and in channel
+ *                       order, e.g. '12.25,12.31,12.20'
+ *              - Otherwise the body is one 4 byte pressure (same format as a
+ *                single channel command) per channel in channel order, e.g.
+ *                'ca122512251225'.
+ *          Only one reply is sent back so the python side pays a single
+ *          round trip for all channels.
+ * @param   None
+ * @return  None
+ */
+void handleAllChannelsCommand(void)
+{
+    char body[ALL_CHANNELS_BODY_SIZE];
+
+    // Read the first body as usual to check if this is a read command
+    for (int8_t i = 0; i < MSG_BODY_SIZE; i++)
+    {
+        body[i] = Serial.read();
+    }
+
+    if (strncmp(body, "read", MSG_BODY_SIZE) == 0)
+    {
+        bool first = true;
+        for (uint8_t cNum = 0; cNum < NUM_CHANNELS; cNum++)
+        {
+            if (channels[cNum].active)
+            {
+                channels[cNum].currentPressure = get_pressure(mpr, cNum);
+                if (!first)
+                {
+                    Serial.print(',');
+                }
+                Serial.print(channels[cNum].currentPressure, 2);
+                first = false;
+            }
+        }
+        Serial.println();
+        return;
+    }
+
+    // The rest of the pressures may still be on the wire, so wait for them
+    const size_t remaining = ALL_CHANNELS_BODY_SIZE - MSG_BODY_SIZE;
+    if (Serial.readBytes(&body[MSG_BODY_SIZE], remaining) != remaining)
+    {
+        Serial.println("CMD ERROR");
+        return;
+    }
+
+    for (uint8_t cNum = 0; cNum < NUM_CHANNELS; cNum++)
+    {
+        setPressureFromBody(cNum, &body[cNum * MSG_BODY_SIZE]);
+    }
+
+    // Send confirmation back
+    Serial.println("rx");
+}
+
 /*
  * @name    handleSelctionCommand
  * @desc    Handle command for channel selection. This starts
@@ -345,7 +495,7 @@ void handleCommand(void)
  *                                     channel 0 on.
  *          byte 1 - indicates whether or not you want to turn channel 1 on
  *          byte 2 - indicates whether or not you want to turn channel 2 on
- *          byte 3 - unused, last byte in body
+ *          byte 3 - 'v' to query the protocol version instead, otherwise unused
  * 
  *          Enabled is represented by 1, disabled is represented by 0
  * 
@@ -354,21 +504,164 @@ void handleCommand(void)
  */
 void handleSelectionCommand(void)
 {
+    char body[MSG_BODY_SIZE];
+    for (int8_t i = 0; i < MSG_BODY_SIZE; i++)
+    {
+        body[i] = Serial.read();
+    }
+
+    // 'sc000v' asks which protocol version we speak. Firmware without
+    // binary support sees a selection that enables nothing and replies "rx"
+    if (body[3] == 'v')
+    {
+        Serial.print('v');
+        Serial.println(PROTOCOL_VERSION);
+        return;
+    }
+
     for (int8_t cNum = 0; cNum < 3; cNum++)
     {
-        char enabled = Serial.read();
-        if (enabled == '1')
+        if (body[cNum] == '1')
         {
             channels[cNum].active = ON;
         }
     }
-    // Extra character currently not being used
-    char reserved = Serial.read();
 
     // Send confirmation back
     Serial.println("rx");
 }
 
+/*
+ * @name    crc8
+ * @desc    crc8 with polynomial 0x07 and an initial value of 0
+ * @param   data - bytes to check
+ * @param   len - number of bytes
+ * @return  crc of the bytes
+ */
+uint8_t crc8(const uint8_t *data, uint8_t len)
+{
+    uint8_t crc = 0;
+    for (uint8_t i = 0; i < len; i++)
+    {
+        crc ^= data[i];
+        for (uint8_t bit = 0; bit < 8; bit++)
+        {
+            crc = (crc & 0x80) ? (uint8_t)((crc << 1) ^ 0x07) : (uint8_t)(crc << 1);
+        }
+    }
+    return crc;
+}
+
+/*
+ * @name    sendBinaryReply
+ * @desc    Send a reply frame back to python
+ * @param   type - reply type (BIN_ACK, BIN_PRESSURES or BIN_NAK)
+ * @param   seq - sequence number of the command being answered
+ * @param   mask - channels the reply applies to
+ * @param   pressures - pressure of each channel in psi, NULL to send zeros
+ * @return  None
+ */
+void sendBinaryReply(uint8_t type, uint8_t seq, uint8_t mask, const float *pressures)
+{
+    uint8_t frame[BIN_REPLY_SIZE];
+    uint32_t now = millis();
+
+    frame[0] = BIN_ARDUINO_SYNC;
+    frame[1] = type;
+    frame[2] = seq;
+    frame[3] = mask;
+    frame[4] = now & 0xFF;
+    frame[5] = (now >> 8) & 0xFF;
+    frame[6] = (now >> 16) & 0xFF;
+    frame[7] = (now >> 24) & 0xFF;
+    for (uint8_t cNum = 0; cNum < NUM_CHANNELS; cNum++)
+    {
+        uint16_t centiPsi = (pressures == NULL) ? 0 : (uint16_t)(pressures[cNum] * 100.0 + 0.5);
+        frame[8 + 2*cNum] = centiPsi & 0xFF;
+        frame[9 + 2*cNum] = (centiPsi >> 8) & 0xFF;
+    }
+    frame[BIN_REPLY_SIZE - 1] = crc8(frame, BIN_REPLY_SIZE - 1);
+
+    Serial.write(frame, BIN_REPLY_SIZE);
+}
+
+/*
+ * @name    handleBinaryCommand
+ * @desc    Handle a binary command frame. Every frame is answered with
+ *          exactly one reply frame carrying the same sequence number.
+ *          Frames with a bad crc or unknown type are answered with BIN_NAK
+ * @param   None
+ * @return  None
+ */
+void handleBinaryCommand(void)
+{
+    uint8_t frame[BIN_COMMAND_SIZE];
+    Serial.readBytes(frame, BIN_COMMAND_SIZE);
+
+    uint8_t type = frame[1];
+    uint8_t seq = frame[2];
+    uint8_t mask = frame[3];
+
+    if (crc8(frame, BIN_COMMAND_SIZE - 1) != frame[BIN_COMMAND_SIZE - 1])
+    {
+        sendBinaryReply(BIN_NAK, seq, mask, NULL);
+        return;
+    }
+
+    float pressures[NUM_CHANNELS];
+    switch (type)
+    {
+        case BIN_SET_PRESSURES:
+            for (uint8_t cNum = 0; cNum < NUM_CHANNELS; cNum++)
+            {
+                if (mask & (1 << cNum))
+                {
+                    uint16_t centiPsi = frame[4 + 2*cNum] | (frame[5 + 2*cNum] << 8);
+                    channels[cNum].desiredPressure = centiPsi / 100.0;
+                }
+            }
+            sendBinaryReply(BIN_ACK, seq, mask, NULL);
+            break;
+
+        case BIN_READ_PRESSURES:
+            for (uint8_t cNum = 0; cNum < NUM_CHANNELS; cNum++)
+            {
+                if (mask & (1 << cNum))
+                {
+                    channels[cNum].currentPressure = get_pressure(mpr, cNum);
+                }
+                pressures[cNum] = channels[cNum].currentPressure;
+            }
+            sendBinaryReply(BIN_PRESSURES, seq, mask, pressures);
+            break;
+
+        case BIN_SELECT_CHANNELS:
+            // Same as the ASCII select command, channels are only ever turned on
+            for (uint8_t cNum = 0; cNum < NUM_CHANNELS; cNum++)
+            {
+                if (mask & (1 << cNum))
+                {
+                    channels[cNum].active = ON;
+                }
+            }
+            sendBinaryReply(BIN_ACK, seq, mask, NULL);
+            break;
+
+        case BIN_STREAM:
+            // First payload field is the stream period in ms, 0 stops streaming.
+            // Acknowledge first so the reply arrives before any telemetry
+            sendBinaryReply(BIN_ACK, seq, mask, NULL);
+            streamPeriodMs = frame[4] | (frame[5] << 8);
+            streamMask = mask;
+            lastStreamMs = millis();
+            break;
+
+        default:
+            sendBinaryReply(BIN_NAK, seq, mask, NULL);
+            break;
+    }
+}
+
 #if defined(LOCAL_PRESSURE_SENSOR_FUNCTIONS)
 /*
  * @name    scanner
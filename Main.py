@@ -8,19 +8,16 @@ from pathlib import Path
 import tkinter as tk
 from tkinter import ttk
 from ttkthemes import ThemedStyle
-from math import sin, pi, sqrt, cos
 import ctypes
-import threading
-from queue import Queue
+from concurrent import futures
 import logging
 from csv_logger import CsvLogger
 import NDI_communication
 import arduino_communcation
+import robot_control
 import numpy as np
 from PIL import Image,  ImageTk
 import time
-from scipy import signal as sg
-import scipy.optimize as sp_opt
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
 
@@ -42,55 +39,95 @@ header = ['date', 'sample_num', 'time_diff', 'z_des', 'x_des', 'z_act', 'x_act',
 csv_logger = CsvLogger(filename='Data Collection/Tracking Curves/data.csv',
                         level=logging.INFO, fmt='%(asctime)s,%(message)s', header=header)
 sample_num = 0          # variable to keep track of the samples for any data collection
-# Init EM Nav and Arduino
-try:
-    ndi = NDI_communication.NDISensor()
-    arduino = arduino_communcation.arduino()
-    arduino.selectChannels(arduino.ON, arduino.ON, arduino.ON)
-except:
-  print("Arduino or NDI sensor not connected")
+def arduinoCommandFailed(name, seq, error):
+    '''
+    Called from the Arduino reader thread when a pipelined command was
+    rejected or never acknowledged
+    '''
+    logging.error("Arduino command %s (seq %d) failed: %s", name, seq, error)
+
+def setupArduino():
+    '''
+    Connect to the Arduino and turn on every channel. Runs on a device setup thread
+    '''
+    board = arduino_communcation.arduino(binary=True)
+    board.selectChannels(board.ON, board.ON, board.ON)
+    # Don't wait for the pressure write of one tick to be acknowledged before
+    # reading the sensors of the next one (needs firmware with binary frames)
+    if board.binaryMode:
+        board.enablePipelining(onError=arduinoCommandFailed)
+        # The pressure loop reads the newest pushed sample instead of asking for one
+        board.startStreaming()
+    return board
+
+def setupNDI():
+    '''
+    Connect to the EM sensor and start streaming so the controllers get the
+    newest position without waiting for a TX round trip. Runs on a device setup thread
+    '''
+    sensor = NDI_communication.NDISensor()
+    sensor.startStreaming()
+    return sensor
+
+# Init EM Nav and Arduino in the background so the GUI comes up right away.
+# The controller threads wait for the devices they use before their first tick
+NDI_DEVICE = "EM Sensor"
+ARDUINO_DEVICE = "Arduino"
+DEVICE_POLL_SEC = 0.1   # controller threads check for ready devices this often while waiting
+ndi = None
+arduino = None
+devices = robot_control.deviceManager()
+devices.connect(NDI_DEVICE, setupNDI)
+devices.connect(ARDUINO_DEVICE, setupArduino)
+
+def waitForDevices(stopEvent, *names):
+    '''
+    Block the calling controller thread until the named devices are ready
+    and return them. Waits in short steps so the controller can still be
+    stopped while a device is connecting, returns None if it was
+    '''
+    while not stopEvent.is_set():
+        try:
+            return devices.wait(*names, timeout=DEVICE_POLL_SEC)
+        except futures.TimeoutError:
+            pass
+    return None
 
 # Parameters for controller
 z_des = 40.0     # stores the desired z position input by user
 z_act = 0.0     # actual z_position from EM sensor
-start_time = 0      # start time for the ramp and sinusoid signals
+start_time = 0      # start time of the reference trajectory, 0 while it isn't running
 time_diff = 0       # time difference betweeen the start and current times
 
 # Parameters for the 3 channel controller
-P_des = np.array([12.25, 12.25, 12.25])     # desired pressure we're sending to the Arduino (c0, c1, c2)
+P_des = np.array([12.25, 12.25, 12.25])     # desired pressure of the open controller (c0, c1, c2), the PID controller starts from it
 P_act = np.array([0.0, 0.0, 0.0])           # actual pressure read from the pressure sensor (c0, c1, c2)
 r_des = np.array([0.0, 0.0])                # desired position of robot in form (x, y)
 r_act = np.array([0.0, 0.0])                # actual position of the robot using EM sensor (x, y)
 k_p = np.array([.03, .03, .03])             # 1X Scale - proportional controller gain for c0, c1, c2
 k_i = np.array([0.01, 0.01, 0.01])          # 2X Scale - integral gain # TODO: figure out how to pass in integral gain and what is best gain value
 k_d = np.array([0.001, 0.001, 0.001])          # Test derivative gain (TODO: figure out if this helps tracking)
-dT = np.array([0.125, 0.125, 0.125])        # time between cycles (seconds) # TODO: find a way to clock the cycles to get this value (may be different between each channel)
-int_sum = np.array([0.0, 0.0, 0.0])         # sum of the integral term # TODO: figure out if this should be a global value
-err_r = np.array([0.0, 0.0])                # error between measured position and actual position
-epsi = np.array([0.0, 0.0, 0.0])            # stores the solution to the force vector algorithm
-epsi_prev = np.array([0.0, 0.0, 0.0])       # modified error in r (after force vector solution) for the previous time step # TODO: figure out if this should be a global value
+dT = np.array([0.125, 0.125, 0.125])        # time between cycles (seconds), measured by the controller every tick
+CONTROL_RATE_HZ = 8                         # rate the open controller runs at
+PRESSURE_RATE_HZ = 50                       # rate the PID controller's pressure loop reads the pressures and streams setpoints to the Arduino
+POSITION_RATE_HZ = 8                        # rate of the PID controller's position loop, the gains were tuned at 0.125 s per cycle. None runs it on every new EM frame (retune the gains first)
+EM_FRAME_RATE_HZ = 40                       # measurement rate of the Aurora, the nominal position loop rate when POSITION_RATE_HZ is None
+MAX_SLEW_PSI_PER_SEC = 20.0                 # fastest the pressure loop moves a setpoint towards the one of the position loop, None jumps
+PRESSURE_TIMEOUT_SEC = 1.0                  # longest the position loop waits for the pressure loop's first read
+FILTER_EM_POSITION = True                   # smooth the EM position with a Kalman filter and predict it ahead, False uses raw positions
+PREDICTION_LEAD_SEC = 0.02                  # time from computing the pressures until they take effect (seconds)
+INTEGRAL_LIMIT = 10.0                       # the integral sum of every channel is kept within +-INTEGRAL_LIMIT to avoid windup
+MIN_PRESSURE = 9.0                          # lower limit of the pressure we are sending into the controller
+channelGeometry = robot_control.ChannelGeometry()   # C0, C1, C2 unit vectors and their precomputed pseudoinverse
 max_pressure = np.array([15.5, 15.2, 15.5])
+# (z, x) reference followed while logging, e.g. robot_control.trajectory.figureEight() or .fromCSV('waypoints.csv')
+reference = robot_control.trajectory.circle(radius=15, period=60)
 
-#thread for controller
-cThread = None
-
-# Queue for inter-thread communication
-commandsFromGUI = Queue()
-
-# Class used for all commands
-class command:
-    def __init__(self, *args):
-        if len(args) == 3:
-            self.id = args[0]
-            self.field1 = args[1]
-            self.field2 = args[2]
-
-        elif len(args) == 4:
-            self.id = args[0]
-            self.field1 = args[1]
-            self.field2 = args[2]
-            self.field3 = args[3]
+#runs the open or the PID controller thread, swapping them keeps the devices connected
+controllers = robot_control.controllerSupervisor()
 
+# Typed commands from the GUI, the controller applies all of them between two ticks
+commandsFromGUI = robot_control.commandBus()
 
 class projectPostition:
     def __init__(self, parent):
@@ -234,24 +271,21 @@ class pidTuningWindow(tk.Frame):
         '''
         Handle setting the gain from the GUI
         '''
-        newCmd = command("EM_Sensor", "setKp", float(self.kpTextEntry.get()))
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setGain('kp', float(self.kpTextEntry.get())))
         self.updateDisplay()
 
     def handleSetKiCommand(self, *args):
         '''
         Handle setting the gain from the GUI
         '''
-        newCmd = command("EM_Sensor", "setKi", float(self.kiTextEntry.get()))
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setGain('ki', float(self.kiTextEntry.get())))
         self.updateDisplay()
 
     def handleSetKdCommand(self, *args):
         '''
         Handle setting the gain from the GUI
         '''
-        newCmd = command("EM_Sensor", "setKd", float(self.kdTextEntry.get()))
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setGain('kd', float(self.kdTextEntry.get())))
         self.updateDisplay()
 
     def updateDisplay(self):
@@ -426,11 +460,15 @@ class controlWindow(tk.Frame):
         self.controllerTypeText = ttk.Label(self, text='No Controller Type Selected')
         self.controllerTypeText.place(relx=362.0/2736,rely=1230/1824, anchor='n')
 
+        #device connection status
+        self.deviceStatusText = ttk.Label(self, text=devices.statusText())
+        self.deviceStatusText.place(relx=40.0/2736,rely=50/1824, anchor='nw')
+
         #position projection
         self.projectionWidget = projectPostition(self.canvas)
 
     def updateDisplay(self, *args):
-        global r_des, r_act, y_des, y_act, int_sum, P_act
+        global r_des, r_act, y_des, y_act, P_act
 
         #update pressure
         self.channel0Text.configure(text = str(round(P_act[0],3)))
@@ -442,6 +480,9 @@ class controlWindow(tk.Frame):
         self.zPosText.configure(text = str(round(r_act[0],3)))
         self.yPosText.configure(text = str(round(z_act,3)))
 
+        #update device status
+        self.deviceStatusText.configure(text = devices.statusText())
+
         #update projection plot
         self.projectionWidget.updatePosition(round(r_act[1],3), round(r_act[0],3))
         self.projectionWidget.plot()
@@ -452,15 +493,13 @@ class controlWindow(tk.Frame):
         '''
         Handle setting the position from the GUI
         '''
-        newCmd = command("EM_Sensor", "setXPosition", float(self.xPosEntry.get()))
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setPosition(1, float(self.xPosEntry.get())))     # r_des[1] is x
 
     def handleSetYPositionCommand(self, *args):
         '''
         Handle setting the position from the GUI
         '''
-        newCmd = command("EM_Sensor", "setYPosition", float(self.yPosEntry.get()))
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setPosition(0, float(self.yPosEntry.get())))     # r_des[0]
 
     def handleSetZPositionCommand(self, *args):
         '''
@@ -472,22 +511,19 @@ class controlWindow(tk.Frame):
         '''
         Handle setting the channel in pressure 0
         '''
-        newCmd = command("Arduino", "setPressure", 0, float(self.channel0Entry.get())) # arduino.channel0
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setPressure(0, float(self.channel0Entry.get()))) # arduino.channel0
 
     def setChannel1(self, *args):
         '''
         Handle setting the channel in pressure 1
         '''
-        newCmd = command("Arduino", "setPressure", 1, float(self.channel1Entry.get())) # arduino.channel1
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setPressure(1, float(self.channel1Entry.get()))) # arduino.channel1
 
     def setChannel2(self, *args):
         '''
         Handle setting the channel in pressure 2
         '''
-        newCmd = command("Arduino", "setPressure", 2, float(self.channel2Entry.get())) # arduino.channel2
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setPressure(2, float(self.channel2Entry.get()))) # arduino.channel2
 
     def handleLoggingCommand(self, status):
         '''
@@ -497,7 +533,7 @@ class controlWindow(tk.Frame):
 
         if (status == "start"):
             logging.getLogger().setLevel(logging.INFO)
-            start_time = time.time()                    # start time for ramp and sinusoid signals
+            start_time = time.time()                    # start time for the reference trajectory
             sample_num = 0
         elif (status == "stop"):
             logging.getLogger().setLevel(logging.WARNING)
@@ -508,63 +544,47 @@ class controlWindow(tk.Frame):
                 pass
 
     def startOpenControl(self):
-        global cThread
-
         #check if their is an active controller
-        if cThread:
-            self.stopPidControl() #close controller
+        if controllers.active:
+            self.disablePidControl()
 
-        #start new controller
-        cThread = openControllerThread('Thread 1')
-        cThread.start()
+        #swap in the new controller, the old one finishes its tick and the devices stay connected
+        switchTime = controllers.swap(openControllerThread('Open controller'))
+        print('Switched to the open controller in {:.1f} ms'.format(1000*switchTime))
         #activate gui
         self.controllerTypeText.configure(text = 'Open Controller Type Selected')
         self.channel0Entry.configure(state="normal")
         self.channel1Entry.configure(state="normal")
         self.channel2Entry.configure(state="normal")
 
-    def stopOpenControl(self):
-        global cThread
-
+    def disableOpenControl(self):
         #disable gui
         self.controllerTypeText.configure(text = 'No Controller Type Selected')
         self.channel0Entry.configure(state="disable")
         self.channel1Entry.configure(state="disable")
         self.channel2Entry.configure(state="disable")
 
-        cThread.raise_exception()
-        cThread.join()
-        time.sleep(0.1)
-
     def startPidControl(self):
-        global cThread
-
         #check if their is an active controller
-        if cThread:
-            self.stopOpenControl() #close controller
+        if controllers.active:
+            self.disableOpenControl()
 
-        #start new controller
-        cThread = pidControllerThread('Thread 1')
-        cThread.start()
+        #swap in the new controller, the old one finishes its tick and the devices stay connected
+        switchTime = controllers.swap(pidControllerThread('PID controller'))
+        print('Switched to the PID controller in {:.1f} ms'.format(1000*switchTime))
         #activate gui
         self.controllerTypeText.configure(text ='PID Controller Type Selected')
         self.xPosEntry.configure(state="normal")
         self.yPosEntry.configure(state="normal")
         self.zPosEntry.configure(state="normal")
 
-    def stopPidControl(self):
-        global cThread
-
+    def disablePidControl(self):
         #disable gui
         self.controllerTypeText.configure(text = 'No Controller Type Selected')
         self.xPosEntry.configure(state="disable")
         self.yPosEntry.configure(state="disable")
         self.zPosEntry.configure(state="disable")
 
-        cThread.raise_exception()
-        cThread.join()
-        time.sleep(0.1)
-
 class App:
     def __init__(self, parent):
         #parent window setup
@@ -589,33 +609,48 @@ class App:
     """
     def setup(self):
         self.controlWindow.startOpenControl()
-        newCmd = command("Arduino", "setPressure", 0, float(max_pressure[0]) # arduino.channel0
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setPressure(0, float(max_pressure[0]))) # arduino.channel0
 
     """
 
 
-class openControllerThread(threading.Thread):
+class openControllerThread(robot_control.controllerThread):
     '''
     Implements proportional controller
     '''
     def __init__(self, name):
-        threading.Thread.__init__(self)
-        self.name = name
+        robot_control.controllerThread.__init__(self, name)
 
     def run(self):
+        global arduino
+
+        # Open control only drives the pressures, so don't wait for the EM sensor
+        try:
+            connected = waitForDevices(self.stopEvent, ARDUINO_DEVICE)
+        except Exception as e:
+            print("Controller not started, Arduino not connected:", e)
+            return
+        if connected is None:
+            return
+        arduino, = connected
+        self.board = arduino
+
+        scheduler = robot_control.fixedRateScheduler(CONTROL_RATE_HZ)
         try:
-            while True:
-                # Look for new commands
-                if (commandsFromGUI.empty() == False):
-                    newCmd = commandsFromGUI.get()
-                    self.handleGUICommand(newCmd)
+            while self.running():
+                # Wakes up right away when the controller is stopped
+                scheduler.wait(self.stopEvent)
+                if not self.running():
+                    break
+
+                # Apply every command sent since the last tick, the last value of each setting wins
+                commandsFromGUI.dispatch(self.handleGUICommand)
 
                 self.three_channel_main()
-                time.sleep(.07)
 
         finally:
-            print('Controller thread teminated')
+            print('Controller thread teminated', scheduler)
+            print('GUI commands', commandsFromGUI)
 
     def three_channel_main(self):
         '''
@@ -632,9 +667,7 @@ class openControllerThread(threading.Thread):
                     P_des[channel] = 17.0
 
             # get the actual pressure from the pressure sensor
-            P_act[0] = arduino.getActualPressure(arduino.channel0)
-            P_act[1] = arduino.getActualPressure(arduino.channel1)
-            P_act[2] = arduino.getActualPressure(arduino.channel2)
+            P_act[:] = arduino.getActualPressures()
 
             # get actual position from EM sensor
             # position = ndi.getPositionInRange()
@@ -645,9 +678,7 @@ class openControllerThread(threading.Thread):
             # self.three_channel_algorithm()
 
             # send the desired pressure into Arduino
-            arduino.sendDesiredPressure(arduino.channel0, float(P_des[0]))
-            arduino.sendDesiredPressure(arduino.channel1, float(P_des[1]))
-            arduino.sendDesiredPressure(arduino.channel2, float(P_des[2]))
+            arduino.sendDesiredPressures(float(P_des[0]), float(P_des[1]), float(P_des[2]))
 
             # Log all control variables if needed / TODO: find out how to re-implement time_diff variable
             # TODO: figure out if logging works with vectors/matrices
@@ -665,140 +696,108 @@ class openControllerThread(threading.Thread):
         '''
         global P_des
 
-        if (newCmd.id == "Arduino"):
-            if (newCmd.field1 == "setPressure"):
-                P_des[newCmd.field2] = newCmd.field3
-                # print("Setting channel " + str(newCmd.field2) + " to " + str(newCmd.field3))
+        if isinstance(newCmd, robot_control.setPressure):
+            P_des[newCmd.channel] = newCmd.pressure
+            # print("Setting channel " + str(newCmd.channel) + " to " + str(newCmd.pressure))
 
 
-    def get_id(self):
-        '''
-        returns id of the respective thread
-        '''
-        if hasattr(self, '_thread_id'):
-            return self._thread_id
-        for id, thread in threading._active.items():
-            if thread is self:
-                return id
-
-    def raise_exception(self):
-        '''
-        raise exception for controller thread
-        '''
-        thread_id = self.get_id()
-        res = ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id,
-              ctypes.py_object(SystemExit))
-        if res > 1:
-            ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, 0)
-            print('Exception raise failure')
 
-class pidControllerThread(threading.Thread):
+class pidControllerThread(robot_control.controllerThread):
     '''
     Implements proportional controller
     '''
     def __init__(self, name):
-        threading.Thread.__init__(self)
-        self.name = name
+        robot_control.controllerThread.__init__(self, name)
+        # Controller state belongs to the thread, starting from the tuned gains
+        self.pid = robot_control.PIDController(3, k_p, k_i, k_d, integralLimit=INTEGRAL_LIMIT,
+                                               lower=MIN_PRESSURE, upper=max_pressure, initialOutput=P_des)
+        self.err_r = np.zeros(2)        # error between desired and actual position (z, x)
+        self.epsi = np.zeros(3)         # channel errors, the solution to the force vector algorithm
 
     def run(self):
-        try:
-            while True:
-                # Look for new commands
-                if (commandsFromGUI.empty() == False):
-                    newCmd = commandsFromGUI.get()
-                    self.handleGUICommand(newCmd)
-
-                # self.one_D_main()
-                self.three_channel_main()
-                time.sleep(.07)
-
-        finally:
-            print('Controller thread teminated')
-
-    def sinusoid_signal(self):
-        '''
-        Sinusoidal input function with regard to position for the 1D channel
-        '''
-        global start_time, z_des, time_diff
-
-        current_time = time.time()
-
-        time_diff = current_time - start_time
-
-        A = 5       # amplitude of the sine signal [mm]
-        C = 60      # offset of the sine function [mm]
-        f = .1     # frequency of the signal [Hz]
+        global arduino, ndi
 
-        z_des = A*sin(2*pi*f*time_diff) + C      # resulting sinusoidal z_des [mm]
-
-    def ramp_signal(self):
-        global start_time, z_des, time_diff
-
-        current_time = time.time()              # current time measured compared to start time
-
-        time_diff = current_time - start_time   # time difference used for the signal
-
-        A = (80 - 50)/2                         # amplitude of the ramp signal
-        C = (80 - 50)/2 + 50                    # shifts the signal up to range of 50 mm to 90 mm
-        T = 30                                # period of the signal in seconds
-
-        z_des = A*sg.sawtooth((2*pi/T)*time_diff, width = 0.5) + C       # ramp signal set as a triangle wave
-
-    def circle_signal(self):
-        global start_time, r_des, time_diff
-
-        current_time = time.time()              # current time compared to start time
-
-        time_diff = current_time - start_time   # time difference used in the signal / TODO: incorporate the data logger into this function
-
-        radius = 15                             # radius of the circle in mm
-
-        T = 60                                  # period of the circle (in seconds)
-        center = np.array([0, 0])           # center of the circle script (z, x)
-
-        # parametric equations that represent circle as a function of time
-        r_des[0] = center[0] + radius*cos((2*pi/T)*time_diff)        # in z
-        r_des[1] = center[1] + radius*sin((2*pi/T)*time_diff)        # in x
-
-    def fig_eight_signal(self):
-        global start_time, r_des, time_diff
-
-        current_time = time.time()              # current time compared to start time
-
-        time_diff = current_time - start_time   # time difference used in the signal / TODO: incorporate the data logger into this function
+        # Needs both devices, so the first tick waits for the slower one
+        try:
+            connected = waitForDevices(self.stopEvent, ARDUINO_DEVICE, NDI_DEVICE)
+        except Exception as e:
+            print("Controller not started, Arduino or NDI sensor not connected:", e)
+            return
+        if connected is None:
+            return
+        arduino, ndi = connected
+        self.board = arduino
+
+        # Cascade: the pressure loop owns the Arduino and streams setpoints at
+        # PRESSURE_RATE_HZ, this thread is the position loop and publishes
+        # new setpoints to it at POSITION_RATE_HZ, each tick on a new EM frame
+        self.pressureLoop = robot_control.pressureLoop(arduino, self.pid.output, PRESSURE_RATE_HZ, lower=MIN_PRESSURE,
+                                                       upper=max_pressure, maxSlew=MAX_SLEW_PSI_PER_SEC)
+        self.pressureLoop.start()
+        self.positionFilter = robot_control.positionFilter() if FILTER_EM_POSITION else None
+        self.positionStats = robot_control.loopStats('position', POSITION_RATE_HZ or EM_FRAME_RATE_HZ)
+        scheduler = robot_control.fixedRateScheduler(POSITION_RATE_HZ) if POSITION_RATE_HZ else None
+        try:
+            while self.running():
+                if scheduler is not None:
+                    scheduler.wait(self.stopEvent)
+                    if not self.running():
+                        break
 
-        radius = 15                             # "radius" of the figure eight in mm
+                # Apply every command sent since the last tick, the last value of each setting wins
+                commandsFromGUI.dispatch(self.handleGUICommand)
 
-        T = 60                                  # period of the figure eight (in seconds)
-        center = np.array([0, 0])           # center of the figure eight script (z, x)
+                # Blocks until the tracker has measured a frame this loop hasn't used yet
+                position = ndi.waitForNextFrame()
 
-        # parametric equations that represent figure eight as a function of time
-        r_des[0] = center[0] + radius*sin((2*pi/T)*time_diff)                                # in z
-        r_des[1] = center[1] + radius*sin((2*pi/T)*time_diff)*cos((2*pi/T)*time_diff)        # in x
+                # Integral and derivative terms use the measured time since the last tick
+                dT[:] = self.positionStats.tick()
+                # self.one_D_main()
+                self.three_channel_main(position)
+                self.positionStats.done()
 
-    def three_channel_main(self):
-        '''
-        main function used in thread to perform 3 channel algorithm
-        '''
-        global time_diff, r_des, r_act, P_des, P_act, csv_logger, sample_num, z_act
+        finally:
+            # The pressure loop finishes its tick before stop() drains the
+            # Arduino, and the open controller takes over from the last
+            # desired pressures
+            self.pressureLoop.stop()
+            P_des[:] = self.pid.output
+            print('Controller thread teminated', self.positionStats, scheduler)
+            print('Pressure loop', self.pressureLoop)
+            print('GUI commands', commandsFromGUI)
+            print('EM tracking', ndi.stats)
+
+    def three_channel_main(self, position):
+        '''
+        main function used in thread to perform 3 channel algorithm on a new EM position
+        '''
+        global time_diff, r_des, r_act, P_act, csv_logger, sample_num, z_act
+        P_des = self.pid.output
+        # newest pressures measured by the pressure loop, no serial round trip.
+        # Raises IOError, ending the controller, if the pressure loop has stopped
+        self.pressureLoop.pressures(out=P_act, timeout=PRESSURE_TIMEOUT_SEC)
         try:
-            # get the actual pressure from the pressure sensor
-            P_act[0] = arduino.getActualPressure(arduino.channel0)
-            P_act[1] = arduino.getActualPressure(arduino.channel1)
-            P_act[2] = arduino.getActualPressure(arduino.channel2)
             # print("P_act", P_act)
 
-            # get actual position from EM sensor
-            position = ndi.getPositionInRange()
-            r_act[1] = position.deltaX          # x dim
-            r_act[0] = position.deltaZ          # y dim
-            z_act = position.deltaZ          # y dim
-            # print("r_act[0]: " + str(r_act[0]) + "r_act[1]: " + str(r_act[1]))
-
-            # perform 3 channel control algorithm
-            self.three_channel_algorithm()
-
-            # send the desired pressure into Arduino
+            if position:
+                delta = position.delta
+                if self.positionFilter is not None:
+                    # Smoothed position of the tip at the time the new pressures take effect
+                    self.positionFilter.update(position.delta, position.frame)
+                    delta = self.positionFilter.predict(position.age() + PREDICTION_LEAD_SEC)
+                r_act[1] = delta[0]          # x dim
+                r_act[0] = delta[2]          # y dim
+                z_act = delta[2]          # y dim
+                # print("r_act[0]: " + str(r_act[0]) + "r_act[1]: " + str(r_act[1]))
+
+                # perform 3 channel control algorithm
+                self.three_channel_algorithm()
+            else:
+                # EM coil out of the field volume, the pressure loop keeps
+                # regulating to the last desired pressures
+                logging.warning("No EM position this tick: %s", position)
+
+            # hand the desired pressures to the pressure loop
             self.sendDesiredPressure()
 
             # Log all control variables if needed / TODO: find out how to re-implement time_diff variable
@@ -818,66 +817,41 @@ class pidControllerThread(threading.Thread):
         '''
         Proportional/PI feedback loop algorithm (vector based solution -- includes dot product and bounded least squares solution)
         '''
-        global r_des, r_act, err_r, P_des, P_act, k_p, k_i, k_d, dT, int_sum, epsi, epsi_prev, start_time
+        global r_des, r_act, P_act, dT, start_time, time_diff
 
         if start_time > 0:
-            self.circle_signal()
+            # Follow the reference trajectory while logging
+            time_diff = time.time() - start_time
+            r_des[:] = reference.sample(time_diff)
 
         # Calculate the error between current and desired positions
-        err_r = r_des - r_act
-        # print("err_r: ", err_r)
+        np.subtract(r_des, r_act, out=self.err_r)
+        # print("err_r: ", self.err_r)
 
         # perform force vector calculations
         self.forceVectorCalc()
 
-        # Calculate the integral sum for integral control
-        int_sum = int_sum + 0.5*(epsi + epsi_prev)*dT               # these are all element-wise operations / TODO: check the matrix math here
-        for i in range(len(int_sum)):                               # checks the integral sum to see if it's in range (hardcoded integral windup)
-            if int_sum[i] > 10:
-                int_sum[i] = 10
-            elif int_sum[i] < -10:
-                int_sum[i] = -10
-
-        # Calculate the derivative term of the controller (TODO: figure out if this term helps tracking)
-        deriv = (epsi - epsi_prev)/dT
-
         # < ------- Feedback controller --------- >
-        del_P_des = k_p*epsi + k_i*(int_sum) + k_d*deriv                     # should be element-wise operations / TODO: check the matrix math here
-        P_des = P_act + del_P_des
-
-        # print("del_P_des: ", del_P_des)
-        # print("P_act: ", P_act)
-        # print("P_des: ", P_des)
-
-        # Check for windup of the integrator
-        # if (P_des >= 13.25) or (P_des <= 9.0):
-        #     P_des = k_p*epsi_z
-
-        # Update the error value for next iteration of epsi_prev
-        epsi_prev = epsi
+        # P_des = P_act + k_p*epsi + k_i*int_sum + k_d*deriv for every channel,
+        # with the integral sum and P_des clipped to their limits (TODO: figure out if the derivative term helps tracking)
+        self.pid.update(self.epsi, P_act, dT)
+        # print("P_des: ", self.pid.output)
 
     def forceVectorCalc(self):
         '''
         calculates the force vector solution for the controller given the error vector and the unit vectors of each channel
         '''
-        global err_r, epsi
-
-        # <----- Bounded least squares implementation ----->
-        # array that contains C1, C2, C3 unit vectors
-        A = np.array([[sqrt(3)/2, -sqrt(3)/2, 0], [1/2, 1/2, -1]])
-
-        # perform unbounded least squares
-        sol = sp_opt.lsq_linear(A, err_r)
-
-        # return the solution to the optimization (m, n, p)
-        epsi = sol.x
+        # <----- Least squares implementation ----->
+        # minimum norm solution (m, n, p) of A @ epsi = err_r using the
+        # pseudoinverse precomputed for the channel unit vectors
+        channelGeometry.solve(self.err_r, out=self.epsi)
         # print("epsi: ", epsi)
 
         # # <----- Dot product method ----->
         # # develop channel unit vectors
-        # C0 = A[:, 0]
-        # C1 = A[:, 1]
-        # C2 = A[:, 2]
+        # C0 = channelGeometry.A[:, 0]
+        # C1 = channelGeometry.A[:, 1]
+        # C2 = channelGeometry.A[:, 2]
 
         # # dot product of error vector along the channel vectors
         # epsi[0] = np.dot(err_r, C0)
@@ -887,22 +861,11 @@ class pidControllerThread(threading.Thread):
 
     def sendDesiredPressure(self):
         '''
-        convert P_des and send this pressure into the Arduino
+        publish P_des to the pressure loop, which streams it to the Arduino
         '''
-        global P_des
-        for i in range(len(P_des)):
-            # TODO: check the range limits for the pressure being sent for the smaller robot
-            if P_des[i] < 9.0:
-                # lower limit of the pressure we are sending into the controller
-                P_des[i] = 9.0
-            elif P_des[i] > max_pressure[i]:
-                # higher limit of the pressure we are sending into the controller
-                P_des[i] = max_pressure[i]
-
-        # send each channel pressure
-        arduino.sendDesiredPressure(arduino.channel0, float(P_des[0]))
-        arduino.sendDesiredPressure(arduino.channel1, float(P_des[1]))
-        arduino.sendDesiredPressure(arduino.channel2, float(P_des[2]))
+        # The controller keeps P_des between MIN_PRESSURE and max_pressure
+        # TODO: check the range limits for the pressure being sent for the smaller robot
+        self.pressureLoop.setSetpoints(self.pid.output)
 
     def handleGUICommand(self, newCmd):
         '''
@@ -911,49 +874,19 @@ class pidControllerThread(threading.Thread):
         '''
         global r_des, k_p, k_i, k_d
 
-        if (newCmd.id == "EM_Sensor"):
-            if (newCmd.field1 == "setXPosition"):
-                r_des[1] = newCmd.field2
-            elif (newCmd.field1 == "setYPosition"):
-                r_des[0] = newCmd.field2
-                logging.debug("\nCommand recieved to set position to ", z_des)
-            elif (newCmd.field1 == "setKp"):
-                k_p[0] = newCmd.field2
-                k_p[1] = newCmd.field2
-                k_p[2] = newCmd.field2
-                logging.debug("\nCommand recieved to set proportional gain to", k_p)
-            elif (newCmd.field1 == "setKi"):
-                k_i[0] = newCmd.field2
-                k_i[1] = newCmd.field2
-                k_i[2] = newCmd.field2
-                logging.debug("\nCommand recieved to set integral gain to", k_i)
-            elif (newCmd.field1 == "setKd"):
-                k_d[0] = newCmd.field2
-                k_d[1] = newCmd.field2
-                k_d[2] = newCmd.field2
-                logging.debug("\nCommand recieved to set integral gain to", k_d)
-
-
-    def get_id(self):
-        '''
-        returns id of the respective thread
-        '''
-        if hasattr(self, '_thread_id'):
-            return self._thread_id
-        for id, thread in threading._active.items():
-            if thread is self:
-                return id
-
-    def raise_exception(self):
-        '''
-        raise exception for controller thread
-        '''
-        thread_id = self.get_id()
-        res = ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id,
-              ctypes.py_object(SystemExit))
-        if res > 1:
-            ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, 0)
-            print('Exception raise failure')
+        if isinstance(newCmd, robot_control.setPosition):
+            r_des[newCmd.axis] = newCmd.position
+            logging.debug("Command recieved to set position %d to %s", newCmd.axis, newCmd.position)
+        elif isinstance(newCmd, robot_control.setGain):
+            gains = {'kp': k_p, 'ki': k_i, 'kd': k_d}[newCmd.term]
+            if newCmd.channel is None:
+                gains[:] = newCmd.value
+            else:
+                gains[newCmd.channel] = newCmd.value
+            self.pid.setGains(**{newCmd.term: gains})
+            logging.debug("Command recieved to set %s to %s", newCmd.term, gains)
+
+
 
 
 def main():
@@ -967,10 +900,11 @@ def main():
     # root.resizable(True, True)
     root.mainloop()
 
-    if cThread:
-        # Kill controller once GUI is exited
-        cThread.raise_exception()
-        cThread.join()
+    # Stop the controller once GUI is exited, it finishes its tick and the
+    # Arduino is vented to the default pressure before the devices close
+    controllers.stop()
+
+    devices.shutdown()
 
 
 if __name__ == '__main__':
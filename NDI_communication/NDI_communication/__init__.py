@@ -6,17 +6,47 @@
  * @brief   Methods to control EM sensor via the NDI capi API
 '''
 
-#TODO: conditional import in class
-import ndicapy
 import atexit
+import time
+import logging
+import threading
+import numpy as np
 import serial.tools.list_ports
 
-from ndicapy import (
-    ndiDeviceName, ndiProbe, NDI_OKAY,
-    ndiOpen, ndiClose, ndiCommand, ndiGetError,
-    ndiErrorString, NDI_115200,
-    NDI_8N1, NDI_NOHANDSHAKE,
-)
+from . import bx
+from . import tx
+from . import streaming
+from . import tracking
+from . import pose
+
+POSITION_TIMEOUT_SEC = 0.1      # getPositionInRange gives up after this long, about 4 Aurora frames
+RETRY_BACKOFF_SEC = 0.001       # first wait before asking again when a tool is missing
+MAX_BACKOFF_SEC = 0.02          # the wait doubles on every retry up to this
+
+# ndicapy is only needed to talk to a real tracker. It is imported when the
+# first NDISensor connects so the package (and SimulatedNDISensor) can be
+# used on machines without it
+ndicapy = None
+
+def loadNdicapy():
+    """ import ndicapy the first time it is needed
+
+    Returns
+    -------
+    module
+        the ndicapy module
+
+    Raises
+    ------
+    ImportError
+        If ndicapy is not installed.
+
+    """
+    global ndicapy
+    if ndicapy is None:
+        import ndicapy as module
+        ndicapy = module
+    return ndicapy
 
 def getPort(deviceName):
     """ use to find port with the given port description
@@ -50,29 +80,49 @@ def getPort(deviceName):
     raise Exception("Could not find device with {} as device name".format(deviceName))
 
 
-# Class used to send cleaned parsed data
-class parsedReply:
-    def __init__(self, deltaX, deltaY, deltaZ):
-        self.deltaX = deltaX
-        self.deltaY = deltaY
-        self.deltaZ = deltaZ
-
-    def getX(self):
-        print(self.deltaX)
-
-    def getY(self):
-        print(self.deltaY)
-
-    def getZ(self):
-        print(self.deltaZ)
+def parsedReply(deltaX, deltaY, deltaZ, hostTime=None):
+    '''
+    Positions are handed out as pose.trackedPose now. This builds one from
+    a relative position the way the old parsedReply class was constructed,
+    for scripts that still do that (puck at the origin, no frame number)
+    '''
+    return pose.trackedPose().set((deltaX, deltaY, deltaZ), (1.0, 0.0, 0.0, 0.0), (0.0, 0.0, 0.0),
+                                  (1.0, 0.0, 0.0, 0.0), time.perf_counter() if hostTime is None else hostTime, None)
 
 class NDISensor:
     #TODO: create better constructor
     #TODO: create deconstructor
 
-    def __init__(self):
+    def __init__(self, binary=False):
         self.name = None
         self.device = None
+        # Port handles that are enabled for tracking, filled in by startTracking
+        self.handles = []
+        # Ask for tool data with binary BX replies instead of ASCII TX
+        self.binary = binary
+        # Rows TX replies are parsed into, reused on every read
+        self.txTools = np.zeros(tx.MAX_HANDLES, dtype=tx.TOOL_DTYPE)
+        # Missing frame, retry and wait counters for monitoring
+        self.stats = tracking.trackingStats()
+        # Frame number the stats counted last, repeated replies of it aren't counted again
+        self.recordedFrame = None
+        # Frame of the last position waitForNextFrame returned
+        self.consumedFrame = None
+        # Positions are filled into these in turn instead of allocating one per frame
+        self.poses = pose.posePool()
+
+        # Streaming. While on, the reader thread owns the device and keeps
+        # replacing self.latestPosition with the newest frame (a single
+        # reference assignment, so readers never take a lock) and adds every
+        # frame to self.history
+        self.streaming = False
+        self.readerThread = None
+        self.stopReader = threading.Event()
+        self.newFrame = threading.Condition()
+        self.streamTools = np.zeros(tx.MAX_HANDLES, dtype=tx.TOOL_DTYPE)
+        self.latestPosition = None
+        self.latestFrame = None
+        self.history = None
 
         self.findPorts()
         self.deviceSetup()
@@ -85,16 +135,18 @@ class NDISensor:
 
     def cleanup(self):
         print("Successfully Disconnected from EM Sensor")
+        self.stopStreaming()
         self.stopTracking()
         self.closeDevice()
 
     def findPorts(self):
+        loadNdicapy()
         port = getPort("NDI")[0]
         port = int(port.replace('COM', '')) - 1 #subtract by one as NDI API starts ports at 0
-        self.name  = ndiDeviceName(port)
-        result = ndiProbe(self.name) #Returns 257 if port not found, otherwise returns 1
+        self.name  = ndicapy.ndiDeviceName(port)
+        result = ndicapy.ndiProbe(self.name) #Returns 257 if port not found, otherwise returns 1
 
-        if result != NDI_OKAY:
+        if result != ndicapy.NDI_OKAY:
             raise IOError(
                 'Could not find any NDI device in '
                 '{} serial port candidates checked. '
@@ -111,33 +163,33 @@ class NDISensor:
     def setupPort(self):
         num_setup_complete = 0
         while(num_setup_complete < 2):
-            To_Free = ndiCommand(self.device, 'PHSR:01')
+            To_Free = self.command('PHSR:01')
 
             if(To_Free == '00'):
-                To_Initialized = ndiCommand(self.device, 'PHSR:02')
+                To_Initialized = self.command('PHSR:02')
 
                 if(To_Initialized == '00'):
-                    To_enable = ndiCommand(self.device, 'PHSR:03')
+                    To_enable = self.command('PHSR:03')
                     if(To_enable == '00'):
                         break
                     else:
                         if(To_enable[2:4] == '0B'):
-                            ndiCommand(self.device, 'PENA:{}{}'.format(To_enable[2:4], 'S'))
+                            self.command('PENA:{}{}'.format(To_enable[2:4], 'S'))
                         else:
-                            ndiCommand(self.device, 'PENA:{}{}'.format(To_enable[2:4], 'D'))
+                            self.command('PENA:{}{}'.format(To_enable[2:4], 'D'))
 
                         print("Initialized EM Sensor Port: ", To_enable[2:4])
-                        # print(ndiCommand(self.device, 'PHINF:{}{}'.format(To_enable[2:4], '0001')))
+                        # print(self.command('PHINF:{}{}'.format(To_enable[2:4], '0001')))
                         num_setup_complete += 1
                 else:
                     #There needs to be ports to be initialized
-                    ndiCommand(self. device, 'PINIT:{}'.format(To_Initialized[2:4]))
+                    self.command('PINIT:{}'.format(To_Initialized[2:4]))
             else:
                 #ports need to be freed
                 print("free ports please")
 
     def deviceSetup(self):
-        self.device = ndiOpen(self.name) #command starts communication to API
+        self.device = ndicapy.ndiOpen(self.name) #command starts communication to API
         if not self.device:
             raise IOError(
                 'Could not connect to NDI device found on '
@@ -147,20 +199,19 @@ class NDISensor:
     #TODO: change to allow diffrent configuration.
     def setCommunication(self):
         # Sets serial communication settings
-        reply = ndiCommand(
-            self.device,
-            'COMM:{:d}{:03d}{:d}'.format(NDI_115200, NDI_8N1, NDI_NOHANDSHAKE)
+        reply = self.command(
+            'COMM:{:d}{:03d}{:d}'.format(ndicapy.NDI_115200, ndicapy.NDI_8N1, ndicapy.NDI_NOHANDSHAKE)
         )
         # print(reply)
 
     def checkCommunication(self):
         #Ensures the system configuuration was determine successfully
-        reply = ndiCommand(self.device, 'INIT:')
-        error = ndiGetError(self.device)
-        if reply.startswith('ERROR') or error != NDI_OKAY:
+        reply = self.command('INIT:')
+        error = ndicapy.ndiGetError(self.device)
+        if reply.startswith('ERROR') or error != ndicapy.NDI_OKAY:
             raise IOError(
                 'Error when sending command: '
-                '{}'.format(ndiErrorString(error))
+                '{}'.format(ndicapy.ndiErrorString(error))
             )
         # print(reply)
 
@@ -168,93 +219,264 @@ class NDISensor:
         '''
         Funciton to start tracking with ports currently set up
         '''
-        reply = ndiCommand(self.device, 'TSTART:')
+        self.handles = self.enabledHandles()
+        reply = self.command('TSTART:')
         if reply == "OKAY":
             print("EM Sensor Tracking Started Successfully")
         else:
             print("ERROR with starting tracker (TSTART)")
 
+    def enabledHandles(self):
+        '''
+        Port handles enabled for tracking, in the order the tracker reports them
+        '''
+        # Reply is the number of handles followed by 2 hex digits of handle
+        # and 3 of handle status for each of them
+        reply = self.command('PHSR:04')
+        numHandles = int(reply[0:2], 16)
+        return [int(reply[2 + 5*i:4 + 5*i], 16) for i in range(numHandles)]
+
     def stopTracking(self):
         '''
         Funciton to stop tracking with ports currently set up
         '''
-        ndiCommand(self.device, 'TSTOP:')
+        self.command('TSTOP:')
+
+    def command(self, text):
+        '''
+        Send a command to the tracker and return its reply
+        '''
+        return ndicapy.ndiCommand(self.device, text)
 
     def closeDevice(self):
         '''
         Close out communication with opened device
         '''
-        ndiClose(self.device)
+        ndicapy.ndiClose(self.device)
 
 
-    def getPositionInRange(self):
+    def getPositionInRange(self, timeout=POSITION_TIMEOUT_SEC, newerThan=None):
         '''
-        Ask EM sensor to give you position until tools are both in range
+        Ask EM sensor to give you position until tools are both in range.
+        Gives up after timeout seconds (never if None) and returns a falsy
+        tracking.outOfVolume instead, so a coil outside the field volume
+        can't hang the control thread. With newerThan set, positions from
+        that frame number are skipped as well (outOfVolume without missing
+        handles if nothing newer came)
         '''
+        start = time.perf_counter()
+        deadline = None if timeout is None else start + timeout
+        backoff = RETRY_BACKOFF_SEC
+        retries = 0
         while True:
             position = self.getPosition()
             # print("getting pos")
-            if position:
-                break
-        return position
+            if position and (newerThan is None or position.frame != newerThan):
+                self.stats.recordRequest(retries, time.perf_counter() - start, False)
+                return position
+
+            now = time.perf_counter()
+            if deadline is not None and now >= deadline:
+                self.stats.recordRequest(retries, now - start, True)
+                return tracking.outOfVolume(self.stats.missingHandles, now - start, retries)
+
+            retries += 1
+            wait = backoff if deadline is None else min(backoff, deadline - now)
+            if self.streaming:
+                # Nothing new until the reader gets the next frame
+                with self.newFrame:
+                    self.newFrame.wait(wait)
+            else:
+                time.sleep(wait)
+            backoff = min(2 * backoff, MAX_BACKOFF_SEC)
 
 
+    def waitForNextFrame(self, timeout=POSITION_TIMEOUT_SEC):
+        '''
+        Position from the first frame after the one this returned last time,
+        so a controller polling faster than the tracker measures never runs
+        twice on the same measurement. Same timeout and outOfVolume result
+        as getPositionInRange
+        '''
+        position = self.getPositionInRange(timeout, self.consumedFrame)
+        if position:
+            self.consumedFrame = position.frame
+        return position
+
     def getPosition(self):
         '''
         Recieve tool transformation from EM sensor
         '''
-        reply = ndiCommand(self.device, 'TX:')
+        if self.streaming:
+            # Newest frame from the reader thread, no round trip to the sensor.
+            # Its age() says how old it is
+            return self.latestPosition
+
+        if self.binary:
+            return self.relativePosition(self.getTransforms())
+
+        reply = self.command('TX:')
         #print(reply)
         return self.parser(reply)
 
-    #TODO: figure out regex for easier debugging
-    def parser(self, reply):
+    def startStreaming(self, capacity=streaming.DEFAULT_CAPACITY):
         '''
-        Handles conversion of raw data from EM sensor into cleaned class
+        Start a background thread that asks for tracking data back to back
+        and keeps the newest frame in self.latestPosition and every frame in
+        self.history. While streaming, getPosition returns immediately
         '''
+        if self.streaming:
+            return
+
+        self.history = streaming.poseHistory(capacity)
+        self.latestPosition = None
+        self.latestFrame = None
+        self.stopReader.clear()
+        self.readerThread = threading.Thread(target=self.readerLoop, name='NDIReader', daemon=True)
+        self.streaming = True
+        self.readerThread.start()
+
+    def stopStreaming(self):
+        '''
+        Stop the reader thread, getPosition talks to the sensor directly again
+        '''
+        if not self.streaming:
+            return
 
-        if 'MISSING' in reply:
-            return None
-
-        numHandles = reply[0:2]
-        # print("numHandles:" + numHandles)
-
-        # <== Handle 1 ==>
-        # EM microsensor in port 1
-        # handle1 = reply[2:4]
-        # print("\nHandle1: " + handle1)
-
-        # Tool positioning
-        Tx1 = float(reply[29:33] + "." + reply[33:35]);
-        if (reply[28] == "-"):
-            Tx1 *= -1
-
-        Ty1 = float(reply[36:40] + "." + reply[40:42]);
-        if (reply[35] == "-"):
-            Ty1 *= -1
-
-        Tz1 = float(reply[43:47] + "." + reply[47:49]);
-        if (reply[42] == "-"):
-            Tz1 *= -1
+        self.stopReader.set()
+        self.readerThread.join()
+        self.readerThread = None
+        self.streaming = False
 
-        # print("\tTx: " + str(Tx) + "\tTy: " + str(Ty) + "\tTz:" + str(Tz))
+    def readerLoop(self):
+        '''
+        Runs on the reader thread while streaming. The tracker measures at a
+        fixed rate (40 Hz for the Aurora), frames already seen are skipped
+        '''
+        failing = False
+        while not self.stopReader.is_set():
+            try:
+                frame, position = self.readFrame()
+            except Exception as e:
+                # Only report the first of a run of failed reads
+                if not failing:
+                    logging.error("EM sensor stream read failed: %s", e)
+                failing = True
+                self.stopReader.wait(streaming.STREAM_POLL_SEC)
+                continue
+            failing = False
+
+            if frame == self.latestFrame:
+                self.stopReader.wait(streaming.STREAM_POLL_SEC)
+                continue
+
+            self.history.append(position.hostTime if position else time.perf_counter(), frame, position)
+            with self.newFrame:
+                self.latestFrame = frame
+                self.latestPosition = position
+                self.newFrame.notify_all()
+
+    def readFrame(self):
+        '''
+        Read one frame from the sensor. Returns (frame number, relative
+        position or None if a tool is missing)
+        '''
+        if self.binary:
+            tools = self.getTransforms()
+            frame = max((tool.frame for tool in tools), default=0)
+            return frame, self.relativePosition(tools)
 
-        # <== Handle 2 ==>
-        # EM puck in port 2
-        # handle2 = reply[71:73];
-        # print("\nHandle2: " + handle2)
+        reply = self.command('TX:')
+        tools, _ = tx.parseTX(reply, self.streamTools)
+        frame = int(tools['frame'].max()) if len(tools) else 0
+        return frame, self.relativeTX(tools)
 
-        # Tool positioning
-        Tx2 = float(reply[99:103] + "." + reply[103:105])
-        if (reply[98] == "-"):
-            Tx2 *= -1
+    def getTransforms(self):
+        '''
+        Full tool data (position, rotation, error, port status and frame
+        number) of every enabled handle from a binary BX reply
+        '''
+        # ndicapy reads and checks the BX reply itself and only hands out the
+        # decoded values, see bx.parseBX for the layout of the raw reply
+        self.command('BX:{:04X}'.format(bx.BX_TRANSFORMS))
+        tools = []
+        for handle in self.handles:
+            transform = ndicapy.ndiGetBXTransform(self.device, handle)
+            if transform == 'DISABLED':
+                tools.append(bx.toolTransform(handle, bx.DISABLED))
+                continue
+            tool = bx.toolTransform(handle, bx.MISSING,
+                                    portStatus=ndicapy.ndiGetBXPortStatus(self.device, handle),
+                                    frame=ndicapy.ndiGetBXFrame(self.device, handle))
+            if transform != 'MISSING':
+                tool.status = bx.VALID
+                tool.quaternion = tuple(transform[0:4])
+                tool.position = tuple(transform[4:7])
+                tool.error = transform[7]
+            tools.append(tool)
+        return tools
+
+    def recordFrame(self, frame, handles, statuses):
+        '''
+        Count a frame in the tracking stats unless it was counted already.
+        The sensor repeats the newest frame until it has measured the next
+        one, and the stream reader polls much faster than that
+        '''
+        if frame == self.recordedFrame:
+            return
+        self.recordedFrame = frame
+        self.stats.recordFrame(handles, statuses)
 
-        Ty2 = float(reply[106:110] + "." + reply[110:112])
-        if (reply[105] == "-"):
-            Ty2 *= -1
+    def relativePosition(self, tools):
+        '''
+        Position of the first tool (EM microsensor) relative to the second
+        (EM puck), None unless both are tracked
+        '''
+        self.recordFrame(max((tool.frame for tool in tools), default=0),
+                         [tool.handle for tool in tools], [tool.status for tool in tools])
+        if len(tools) < 2 or not (tools[0].isValid() and tools[1].isValid()):
+            return None
+        sensor = tools[0]
+        puck = tools[1]
+        if self.poses.latest is not None and self.poses.latest.frame == sensor.frame:
+            # Same measurement as last time
+            return self.poses.latest
+        return self.poses.next().set(sensor.position, sensor.quaternion, puck.position, puck.quaternion,
+                                     time.perf_counter(), sensor.frame)
+
+    def getTools(self):
+        '''
+        Tool data of every handle from a TX reply as a structured array, one
+        row per handle (see tx.TOOL_DTYPE). The array is reused by the next call
+        '''
+        reply = self.command('TX:')
+        tools, _ = tx.parseTX(reply, self.txTools)
+        return tools
 
-        Tz2 = float(reply[113:117] + "." + reply[117:119])
-        if (reply[112] == "-"):
-            Tz2 *= -1
+    def parser(self, reply):
+        '''
+        Handles conversion of raw data from EM sensor into cleaned class
+        '''
+        tools, _ = tx.parseTX(reply, self.txTools)
+        return self.relativeTX(tools)
 
-        return parsedReply((Tx1 - Tx2), (Ty1 - Ty2), (Tz1 - Tz2))
+    def relativeTX(self, tools):
+        '''
+        Position of the first tool relative to the second from parsed TX
+        rows, None unless both are tracked
+        '''
+        self.recordFrame(int(tools['frame'].max()) if len(tools) else 0,
+                         tools['handle'].tolist(), tools['status'].tolist())
+        # EM microsensor in port 1, EM puck in port 2
+        if len(tools) < 2 or tools['status'][0] != bx.VALID or tools['status'][1] != bx.VALID:
+            return None
+        sensor = tools[0]
+        puck = tools[1]
+        if self.poses.latest is not None and self.poses.latest.frame == sensor['frame']:
+            # Same measurement as last time
+            return self.poses.latest
+        return self.poses.next().set(sensor['position'], sensor['quaternion'], puck['position'], puck['quaternion'],
+                                     time.perf_counter(), int(sensor['frame']))
+
+# Imported last, the simulator builds on NDISensor
+from .simulator import SimulatedNDISensor
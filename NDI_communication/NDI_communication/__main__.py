@@ -0,0 +1,50 @@
+'''
+ * @file    NDI_communication/__main__.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Benchmark the EM sensor code against the simulated tracker, or record a real one
+
+    python -m NDI_communication --benchmark 10000               times position reads off the rig
+    python -m NDI_communication --benchmark 10000 --replay rec  same with recorded replies
+    python -m NDI_communication --record rec --seconds 30       records TX replies of the Aurora
+'''
+import argparse
+import atexit
+import time
+from NDI_communication import NDISensor, SimulatedNDISensor
+from NDI_communication.simulator import recordTX
+
+def benchmark(args):
+    """ time getPositionInRange with TX and BX replies and print the tracking statistics """
+    for name, binary in (('TX', False), ('BX', True)):
+        sensor = SimulatedNDISensor(recording=args.replay, binary=binary, dropout=args.dropout,
+                                    noise=args.noise, realtime=False, seed=args.seed)
+        start = time.perf_counter()
+        for _ in range(args.benchmark):
+            sensor.getPositionInRange()
+        elapsed = time.perf_counter() - start
+        print('{:4s} {:10.1f} positions/s'.format(name, args.benchmark / elapsed))
+        print('    ', sensor.stats)
+        sensor.cleanup()
+        atexit.unregister(sensor.cleanup)
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated NDI tracker benchmark and TX recorder')
+    parser.add_argument('--benchmark', type=int, metavar='N', help='read N positions from the simulated tracker')
+    parser.add_argument('--replay', metavar='PATH', help='recording to replay instead of synthesized poses')
+    parser.add_argument('--dropout', type=float, default=0.0, help='chance the sensor coil is missing in a frame')
+    parser.add_argument('--noise', type=float, default=0.0, help='standard deviation of the sensor position (mm)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', metavar='PATH', help='record TX replies of the connected Aurora')
+    parser.add_argument('--seconds', type=float, default=10.0, help='how long to record')
+    args = parser.parse_args()
+
+    if args.record:
+        count = recordTX(NDISensor(), args.record, args.seconds)
+        print('Recorded {} replies to {}'.format(count, args.record))
+    elif args.benchmark:
+        benchmark(args)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
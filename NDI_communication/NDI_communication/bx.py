@@ -0,0 +1,170 @@
+'''
+ * @file    bx.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Decode binary BX tracking replies from the NDI Aurora
+
+    BX returns the same tool data as the ASCII TX command in a fixed
+    binary layout, little-endian throughout:
+
+    Header, 6 bytes
+        start sequence (0xA5C4) | reply length | header crc16
+    Body, reply length bytes
+        number of handles, then for every handle
+            handle | handle status
+            q0 | qx | qy | qz | tx | ty | tz | error     (float32, only if status is VALID)
+            port status (uint32) | frame number (uint32)  (left out if status is DISABLED)
+        system status (uint16)
+    Body crc16, 2 bytes
+
+    Positions are in mm, the rotation is a unit quaternion and error is the
+    RMS error of the fit. The crc is CRC-16/ARC (polynomial 0x8005 reflected,
+    initial value 0) like every other binary NDI reply.
+'''
+import struct
+
+BX_START_SEQUENCE = 0xA5C4
+BX_TRANSFORMS = 0x0001      # reply option for BX:<option> asking for the tool transformations
+
+# Handle status
+VALID = 0x01
+MISSING = 0x02
+DISABLED = 0x04
+
+HEADER = struct.Struct('<HHH')          # start sequence, reply length, header crc
+HANDLE = struct.Struct('<BB')           # handle, handle status
+TRANSFORM = struct.Struct('<8f')        # q0, qx, qy, qz, tx, ty, tz, error
+PORT = struct.Struct('<II')             # port status, frame number
+TRAILER = struct.Struct('<H')           # system status, also the body crc
+
+def _buildCrcTable():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = _buildCrcTable()
+
+def crc16(data, start=0, end=None):
+    """ CRC-16/ARC of data[start:end] as used by NDI binary replies """
+    if end is None:
+        end = len(data)
+    crc = 0
+    for i in range(start, end):
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ data[i]) & 0xFF]
+    return crc
+
+class toolTransform:
+    '''
+    Tracking data of one port handle
+    '''
+    __slots__ = ('handle', 'status', 'quaternion', 'position', 'error', 'portStatus', 'frame')
+
+    def __init__(self, handle, status, quaternion=None, position=None, error=None, portStatus=0, frame=0):
+        self.handle = handle            # port handle number
+        self.status = status            # VALID, MISSING or DISABLED
+        self.quaternion = quaternion    # (q0, qx, qy, qz), None unless VALID
+        self.position = position        # (tx, ty, tz) in mm, None unless VALID
+        self.error = error              # RMS error of the fit (mm), None unless VALID
+        self.portStatus = portStatus    # port status bits, see the Aurora API guide
+        self.frame = frame              # frame number the data was measured in
+
+    def isValid(self):
+        return self.status == VALID
+
+    def __repr__(self):
+        return 'toolTransform(handle={:02X}, status={}, quaternion={}, position={}, error={}, portStatus={:08X}, frame={})'.format(
+            self.handle, self.status, self.quaternion, self.position, self.error, self.portStatus, self.frame)
+
+def parseBX(data):
+    """ decode a BX reply requested with the BX_TRANSFORMS option
+
+    Parameters
+    ----------
+    data : bytes or bytearray
+        the complete reply, starting at the start sequence
+
+    Returns
+    -------
+    tuple
+        (tools, systemStatus) where tools is a list of toolTransform, one
+        per handle in the order of the reply
+
+    Raises
+    ------
+    ValueError
+        If the start sequence, a crc or the length of the reply is wrong.
+
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("BX reply too short ({} bytes)".format(len(data)))
+    start, length, headerCrc = HEADER.unpack_from(data, 0)
+    if start != BX_START_SEQUENCE:
+        raise ValueError("BX reply does not start with 0x{:04X} (got 0x{:04X})".format(BX_START_SEQUENCE, start))
+    if crc16(data, 0, 4) != headerCrc:
+        raise ValueError("BX reply header crc mismatch")
+    end = HEADER.size + length
+    if len(data) < end + TRAILER.size:
+        raise ValueError("BX reply truncated, expected {} bytes, got {}".format(end + TRAILER.size, len(data)))
+    bodyCrc, = TRAILER.unpack_from(data, end)
+    if crc16(data, HEADER.size, end) != bodyCrc:
+        raise ValueError("BX reply body crc mismatch")
+
+    numHandles = data[HEADER.size]
+    offset = HEADER.size + 1
+    tools = []
+    for _ in range(numHandles):
+        handle, status = HANDLE.unpack_from(data, offset)
+        offset += HANDLE.size
+        tool = toolTransform(handle, status)
+        if status == VALID:
+            q0, qx, qy, qz, tx, ty, tz, error = TRANSFORM.unpack_from(data, offset)
+            offset += TRANSFORM.size
+            tool.quaternion = (q0, qx, qy, qz)
+            tool.position = (tx, ty, tz)
+            tool.error = error
+        if status != DISABLED:
+            tool.portStatus, tool.frame = PORT.unpack_from(data, offset)
+            offset += PORT.size
+        tools.append(tool)
+
+    if offset + TRAILER.size != end:
+        raise ValueError("BX reply length {} does not match its {} handles".format(length, numHandles))
+    systemStatus, = TRAILER.unpack_from(data, offset)
+    return tools, systemStatus
+
+def packBX(tools, systemStatus=0):
+    """ build a BX reply, the inverse of parseBX
+
+    Parameters
+    ----------
+    tools : list of toolTransform
+        tool data in the order it should appear in the reply
+    systemStatus : int
+        system status bits
+
+    Returns
+    -------
+    bytearray
+        the complete reply including header and crcs
+
+    """
+    body = bytearray([len(tools)])
+    for tool in tools:
+        body += HANDLE.pack(tool.handle, tool.status)
+        if tool.status == VALID:
+            body += TRANSFORM.pack(*tool.quaternion, *tool.position, tool.error)
+        if tool.status != DISABLED:
+            body += PORT.pack(tool.portStatus, tool.frame)
+    body += TRAILER.pack(systemStatus)
+
+    reply = bytearray(HEADER.pack(BX_START_SEQUENCE, len(body), 0))
+    reply[4:6] = TRAILER.pack(crc16(reply, 0, 4))
+    reply += body
+    reply += TRAILER.pack(crc16(body))
+    return reply
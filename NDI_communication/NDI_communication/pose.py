@@ -0,0 +1,117 @@
+'''
+ * @file    pose.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Preallocated pose type for positions from the NDI sensor
+
+    Every pose lives in a row of a preallocated NumPy record buffer and its
+    arrays are views into that row. NDISensor fills poses from a posePool
+    in turn instead of allocating a new object per frame, so a long session
+    at a high rate doesn't leave garbage behind on every frame. Reading the
+    same frame again returns the same pose. A pose is refilled
+    POSE_POOL_SIZE frames after it was handed out, use copy() to keep one
+    for longer.
+'''
+import time
+import numpy as np
+
+POSE_POOL_SIZE = 16         # poses filled in turn, a pose stays valid for this many frames (0.4 s at 40 Hz)
+
+POSE_DTYPE = np.dtype([
+    ('delta', np.float64, (3,)),            # sensor minus puck position (mm)
+    ('sensorPosition', np.float64, (3,)),   # EM microsensor position in the field generator frame (mm)
+    ('sensorQuaternion', np.float64, (4,)), # q0, qx, qy, qz of the microsensor
+    ('puckPosition', np.float64, (3,)),     # EM puck position in the field generator frame (mm)
+    ('puckQuaternion', np.float64, (4,)),   # q0, qx, qy, qz of the puck
+])
+
+class trackedPose:
+    '''
+    Position of the EM microsensor relative to the puck with the raw tool
+    data it was computed from
+    '''
+    __slots__ = ('record', 'delta', 'sensorPosition', 'sensorQuaternion', 'puckPosition', 'puckQuaternion',
+                 'hostTime', 'frame')
+
+    def __init__(self, record=None):
+        if record is None:
+            record = np.zeros((), dtype=POSE_DTYPE)
+        self.record = record                                # 0-d POSE_DTYPE array the views below point into
+        self.delta = record['delta']
+        self.sensorPosition = record['sensorPosition']
+        self.sensorQuaternion = record['sensorQuaternion']
+        self.puckPosition = record['puckPosition']
+        self.puckQuaternion = record['puckQuaternion']
+        self.hostTime = 0.0     # time.perf_counter() when the reply was received from the sensor
+        self.frame = None       # frame number of the measurement, the same number means the same measurement
+
+    def set(self, sensorPosition, sensorQuaternion, puckPosition, puckQuaternion, hostTime, frame):
+        '''
+        Fill in the pose in place, positions and quaternions can be any sequences
+        '''
+        self.sensorPosition[:] = sensorPosition
+        self.sensorQuaternion[:] = sensorQuaternion
+        self.puckPosition[:] = puckPosition
+        self.puckQuaternion[:] = puckQuaternion
+        np.subtract(self.sensorPosition, self.puckPosition, out=self.delta)
+        self.hostTime = hostTime
+        self.frame = frame
+        return self
+
+    @property
+    def deltaX(self):
+        return self.delta[0]
+
+    @property
+    def deltaY(self):
+        return self.delta[1]
+
+    @property
+    def deltaZ(self):
+        return self.delta[2]
+
+    def getX(self):
+        return self.delta[0]
+
+    def getY(self):
+        return self.delta[1]
+
+    def getZ(self):
+        return self.delta[2]
+
+    def age(self):
+        '''
+        Seconds since the position was received from the sensor
+        '''
+        return time.perf_counter() - self.hostTime
+
+    def copy(self):
+        '''
+        Pose with its own buffer that is never refilled
+        '''
+        pose = trackedPose(self.record.copy())
+        pose.hostTime = self.hostTime
+        pose.frame = self.frame
+        return pose
+
+    def __repr__(self):
+        return 'trackedPose(delta=({:.2f}, {:.2f}, {:.2f}), frame={}, hostTime={:.4f})'.format(
+            self.delta[0], self.delta[1], self.delta[2], self.frame, self.hostTime)
+
+class posePool:
+    '''
+    Fixed set of poses in one record buffer, handed out in turn by next()
+    to a single producer (the thread reading the sensor)
+    '''
+    def __init__(self, size=POSE_POOL_SIZE):
+        self.buffer = np.zeros(size, dtype=POSE_DTYPE)
+        self.poses = [trackedPose(self.buffer[i:i + 1].reshape(())) for i in range(size)]
+        self.index = 0
+        self.latest = None      # pose handed out last
+
+    def next(self):
+        pose = self.poses[self.index]
+        self.index += 1
+        if self.index == len(self.poses):
+            self.index = 0
+        self.latest = pose
+        return pose
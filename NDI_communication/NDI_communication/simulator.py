@@ -0,0 +1,297 @@
+'''
+ * @file    simulator.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Stand-in for the NDI tracker to run and benchmark the controllers off the rig
+
+    SimulatedNDISensor is an NDISensor that answers the tracker commands
+    itself instead of going through ndicapy. Frames either come from a
+    recording or from a kinematic model of the sensor coil, and go through
+    the same TX/BX parsing, streaming and statistics code as a real tracker.
+
+    Recordings are text files with one reply per line as JSON:
+
+        {"time": 0.025, "tx": "02..."}      TX reply as returned by ndiCommand
+        {"time": 0.050, "bx": "c4a5..."}    BX reply as hex
+
+    time is seconds since the recording started. recordTX writes one from
+    a real sensor.
+'''
+import json
+import math
+import bisect
+import random
+import time
+
+from . import NDISensor, bx, tx
+
+FRAME_RATE_HZ = 40.0                # measurement rate of the Aurora
+SENSOR_HANDLE = 0x01                # EM microsensor
+PUCK_HANDLE = 0x02                  # EM puck, the sensor position is reported relative to it
+PUCK_POSITION = (0.0, 0.0, -150.0)  # where the puck sits in the field generator frame (mm)
+IDENTITY = (1.0, 0.0, 0.0, 0.0)     # quaternion of the simulated tools
+FIT_ERROR = 0.3                     # RMS error reported for tracked tools (mm)
+
+def circleMotion(radius=15.0, period=60.0, height=40.0):
+    """ kinematic model of the sensor following a circle like robot_control.trajectory.circle
+
+    Parameters
+    ----------
+    radius : float
+        radius of the circle in the z-x plane (mm)
+    period : float
+        time for one revolution (seconds)
+    height : float
+        constant y offset from the puck (mm)
+
+    Returns
+    -------
+    function
+        maps time since tracking started (seconds) to the (x, y, z)
+        position of the sensor relative to the puck (mm)
+
+    """
+    def motion(t):
+        angle = 2*math.pi*t/period
+        return (radius*math.cos(angle), height, radius*math.sin(angle))
+    return motion
+
+def toolsFromTX(reply):
+    """ decode a TX reply into a list of bx.toolTransform """
+    rows, systemStatus = tx.parseTX(reply)
+    tools = []
+    for row in rows:
+        tool = bx.toolTransform(int(row['handle']), int(row['status']),
+                                portStatus=int(row['portStatus']), frame=int(row['frame']))
+        if tool.isValid():
+            tool.quaternion = tuple(row['quaternion'].tolist())
+            tool.position = tuple(row['position'].tolist())
+            tool.error = float(row['error'])
+        tools.append(tool)
+    return tools, systemStatus
+
+def loadRecording(path):
+    """ read a recording written by recordTX (or in the same format)
+
+    Parameters
+    ----------
+    path : string
+        recording file
+
+    Returns
+    -------
+    list
+        (time, tools, systemStatus) for every recorded reply, tools as a
+        list of bx.toolTransform
+
+    Raises
+    ------
+    ValueError
+        If the file holds no replies or a line is neither TX nor BX.
+
+    """
+    frames = []
+    with open(path) as recording:
+        for number, line in enumerate(recording, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if 'tx' in entry:
+                tools, systemStatus = toolsFromTX(entry['tx'])
+            elif 'bx' in entry:
+                tools, systemStatus = bx.parseBX(bytes.fromhex(entry['bx']))
+            else:
+                raise ValueError("{} line {} is neither a TX nor a BX reply".format(path, number))
+            frames.append((entry['time'], tools, systemStatus))
+    if not frames:
+        raise ValueError("{} holds no replies".format(path))
+    return frames
+
+def recordTX(sensor, path, duration):
+    """ record TX replies of a real sensor for replaying them later
+
+    Parameters
+    ----------
+    sensor : NDISensor
+        connected, tracking sensor (not streaming)
+    path : string
+        recording file to write
+    duration : float
+        how long to record (seconds)
+
+    Returns
+    -------
+    int
+        number of replies recorded, a reply is only kept if it differs
+        from the one before
+
+    """
+    count = 0
+    previous = None
+    start = time.perf_counter()
+    with open(path, 'w') as recording:
+        while True:
+            reply = sensor.command('TX:')
+            now = time.perf_counter() - start
+            if now > duration:
+                return count
+            if reply != previous:
+                recording.write(json.dumps({'time': now, 'tx': reply}) + '\n')
+                previous = reply
+                count += 1
+
+class SimulatedNDISensor(NDISensor):
+    '''
+    Drop-in replacement of NDISensor that needs neither ndicapy nor an
+    Aurora, e.g.
+
+        ndi = SimulatedNDISensor(dropout=0.05, noise=0.2)
+        position = ndi.getPositionInRange()
+
+    Frames are replayed from a recording at their original timestamps, or
+    synthesized from motion at frameRate. With realtime=False every reply
+    is the next frame so benchmarks run as fast as the code allows.
+    Dropout is the chance the sensor coil is MISSING in a frame, noise the
+    standard deviation (mm) added to every axis of its position
+    '''
+    def __init__(self, recording=None, binary=False, frameRate=FRAME_RATE_HZ, dropout=0.0, noise=0.0,
+                 motion=None, realtime=True, loop=True, seed=None):
+        self.recording = loadRecording(recording) if recording else None
+        if self.recording:
+            # Seconds from the first recorded reply to every reply
+            first = self.recording[0][0]
+            self.recordingTimes = [entry[0] - first for entry in self.recording]
+        self.frameRate = frameRate
+        self.dropout = dropout
+        self.noise = noise
+        self.motion = motion if motion is not None else circleMotion()
+        self.realtime = realtime
+        self.loop = loop
+        self.random = random.Random(seed)
+
+        self.startTime = None           # time.perf_counter() of TSTART, None while not tracking
+        self.frameCount = 0             # frames handed out, the frame clock when not realtime
+        self.currentFrame = None        # frame the cached replies belong to
+        self.currentTools = None
+        self.currentReply = None
+        self.bxReply = None             # last BX reply, read back by getTransforms
+
+        NDISensor.__init__(self, binary)
+
+    def findPorts(self):
+        self.name = 'simulated'
+
+    def deviceSetup(self):
+        self.device = self.name
+
+    def checkCommunication(self):
+        self.command('INIT:')
+
+    def setCommunication(self):
+        pass
+
+    def closeDevice(self):
+        self.device = None
+
+    def command(self, text):
+        '''
+        Answer a tracker command like the Aurora would
+        '''
+        if text == 'TX:':
+            return self.reply()
+        if text.startswith('BX:'):
+            self.bxReply = self.reply()
+            return ''
+        if text == 'PHSR:04':
+            # Every handle is enabled, 3 hex digits of handle status each
+            handles = self.toolHandles()
+            return '{:02X}'.format(len(handles)) + ''.join('{:02X}001'.format(handle) for handle in handles)
+        if text.startswith('PHSR:'):
+            # No handles left to free, initialize or enable
+            return '00'
+        if text == 'TSTART:':
+            self.startTime = time.perf_counter()
+            self.frameCount = 0
+            self.currentFrame = None
+        elif text == 'TSTOP:':
+            self.startTime = None
+        return 'OKAY'
+
+    def getTransforms(self):
+        self.command('BX:{:04X}'.format(bx.BX_TRANSFORMS))
+        tools, _ = bx.parseBX(self.bxReply)
+        return tools
+
+    def toolHandles(self):
+        if self.recording:
+            return [tool.handle for tool in self.recording[0][1]]
+        return [SENSOR_HANDLE, PUCK_HANDLE]
+
+    def reply(self):
+        '''
+        TX or BX reply of the current frame, built once per frame
+        '''
+        if self.startTime is None:
+            raise IOError("Simulated tracker is not tracking, send TSTART: first")
+
+        if self.realtime:
+            elapsed = time.perf_counter() - self.startTime
+            frame = int(elapsed * self.frameRate)
+        else:
+            frame = self.frameCount
+            self.frameCount += 1
+
+        if self.recording:
+            if self.realtime:
+                frame, tools, systemStatus = self.replayedFrame(elapsed)
+            else:
+                _, tools, systemStatus = self.recording[frame % len(self.recording)]
+        else:
+            tools, systemStatus = None, 0
+
+        if frame != self.currentFrame:
+            if tools is None:
+                tools = self.synthesizedTools(frame)
+            tools = self.disturb(tools)
+            self.currentFrame = frame
+            self.currentTools = tools
+            self.currentReply = bx.packBX(tools, systemStatus) if self.binary else tx.formatTX(tools, systemStatus)
+        return self.currentReply
+
+    def replayedFrame(self, elapsed):
+        '''
+        Newest recorded frame at elapsed seconds, (index, tools, systemStatus)
+        '''
+        duration = self.recordingTimes[-1]
+        laps = 0
+        if self.loop and duration > 0:
+            laps, elapsed = divmod(elapsed, duration)
+        index = max(bisect.bisect_right(self.recordingTimes, elapsed) - 1, 0)
+        _, tools, systemStatus = self.recording[index]
+        return int(laps) * len(self.recording) + index, tools, systemStatus
+
+    def synthesizedTools(self, frame):
+        x, y, z = self.motion(frame / self.frameRate)
+        puck = PUCK_POSITION
+        return [
+            bx.toolTransform(SENSOR_HANDLE, bx.VALID, IDENTITY, (puck[0] + x, puck[1] + y, puck[2] + z),
+                             FIT_ERROR, frame=frame),
+            bx.toolTransform(PUCK_HANDLE, bx.VALID, IDENTITY, puck, FIT_ERROR, frame=frame),
+        ]
+
+    def disturb(self, tools):
+        '''
+        Copy of tools with dropout and noise applied to the sensor coil
+        '''
+        if not self.dropout and not self.noise:
+            return tools
+        tools = [bx.toolTransform(tool.handle, tool.status, tool.quaternion, tool.position,
+                                  tool.error, tool.portStatus, tool.frame) for tool in tools]
+        sensor = tools[0]
+        if not sensor.isValid():
+            return tools
+        if self.random.random() < self.dropout:
+            sensor.status = bx.MISSING
+            sensor.quaternion = sensor.position = sensor.error = None
+        elif self.noise:
+            sensor.position = tuple(value + self.random.gauss(0.0, self.noise) for value in sensor.position)
+        return tools
@@ -0,0 +1,61 @@
+'''
+ * @file    streaming.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Ring buffer for poses streamed from the NDI sensor
+'''
+import threading
+import numpy as np
+
+DEFAULT_CAPACITY = 4096     # Number of frames kept, about 100 seconds at the Aurora's 40 Hz
+STREAM_POLL_SEC = 0.002     # Wait this long before asking again when the tracker has no new frame yet
+
+# Column layout of every frame
+HOST_TIME = 0               # time.perf_counter() when python received the frame (seconds)
+FRAME = 1                   # frame number reported by the tracker
+POSITION = 2                # first position column, sensor minus puck deltaX, deltaY, deltaZ (mm)
+NUM_COLUMNS = POSITION + 3
+
+class poseHistory:
+    '''
+    Preallocated ring buffer of timestamped relative positions. One thread
+    (the stream reader) appends, any number of threads read. Frames where
+    a tool was missing are stored with NaN positions. Once the buffer is
+    full the oldest frames are overwritten
+    '''
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.frames = np.zeros((capacity, NUM_COLUMNS))
+        self.count = 0                          # total frames ever appended
+        self.lock = threading.Lock()
+
+    def append(self, hostTime, frame, position):
+        '''
+        Store a new frame, position is a pose.trackedPose or None if a tool was missing
+        '''
+        with self.lock:
+            row = self.frames[self.count % self.capacity]
+            row[HOST_TIME] = hostTime
+            row[FRAME] = frame
+            if position is None:
+                row[POSITION:] = np.nan
+            else:
+                row[POSITION:] = position.delta
+            self.count += 1
+
+    def history(self, numFrames=None):
+        '''
+        Returns a copy of the newest numFrames frames (all stored frames by
+        default) in chronological order
+        '''
+        # Same wraparound as telemetryBuffer.history in arduino_communcation.
+        # The two packages are installed separately and only share numpy, so
+        # a fix to one of them belongs in the other as well
+        with self.lock:
+            stored = min(self.count, self.capacity)
+            if numFrames is None or numFrames > stored:
+                numFrames = stored
+            end = self.count % self.capacity
+            start = end - numFrames
+            if start >= 0:
+                return self.frames[start:end].copy()
+            return np.concatenate((self.frames[start:], self.frames[:end]))
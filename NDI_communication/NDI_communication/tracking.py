@@ -0,0 +1,122 @@
+'''
+ * @file    tracking.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Tracking statistics of the NDI sensor and the out of volume result
+'''
+import threading
+from .bx import VALID, DISABLED
+
+class outOfVolume:
+    '''
+    Returned by getPositionInRange when the tools were not all tracked
+    before the timeout, e.g. the EM coil left the field volume. It is
+    falsy like the None getPosition returns, so "if position:" checks
+    keep working
+    '''
+    __slots__ = ('missingHandles', 'waited', 'retries')
+
+    def __init__(self, missingHandles, waited, retries):
+        self.missingHandles = missingHandles    # handles that were not VALID in the last frame
+        self.waited = waited                    # seconds spent waiting for a position
+        self.retries = retries                  # positions asked for after the first
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'outOfVolume(missingHandles={}, waited={:.3f}, retries={})'.format(
+            ['{:02X}'.format(handle) for handle in self.missingHandles], self.waited, self.retries)
+
+class toolStats:
+    '''
+    Frame counters of one port handle
+    '''
+    __slots__ = ('handle', 'frames', 'missing', 'disabled', 'consecutiveMissing', 'maxConsecutiveMissing')
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.frames = 0                 # frames the handle was reported in
+        self.missing = 0                # frames it was MISSING
+        self.disabled = 0               # frames it was DISABLED
+        self.consecutiveMissing = 0     # frames it has been missing for in a row, 0 while tracked
+        self.maxConsecutiveMissing = 0  # longest run of missing frames
+
+class trackingStats:
+    '''
+    Per tool missing frame counters and retry/wait counters of
+    getPositionInRange. Updated from the controller and stream reader
+    threads, read with snapshot() from anywhere (e.g. the GUI)
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.tools = {}
+            self.missingHandles = ()    # handles not VALID in the newest frame
+            self.requests = 0           # calls of getPositionInRange
+            self.retries = 0            # extra positions asked for because a tool was missing
+            self.timeouts = 0           # calls that gave up and returned outOfVolume
+            self.waitTime = 0.0         # total seconds spent waiting for both tools
+            self.maxWait = 0.0          # longest single wait (seconds)
+
+    def recordFrame(self, handles, statuses):
+        '''
+        Count one frame, handles and statuses are matching sequences
+        '''
+        missingHandles = []
+        with self.lock:
+            for handle, status in zip(handles, statuses):
+                tool = self.tools.get(handle)
+                if tool is None:
+                    tool = self.tools[handle] = toolStats(handle)
+                tool.frames += 1
+                if status == VALID:
+                    tool.consecutiveMissing = 0
+                    continue
+                missingHandles.append(handle)
+                if status == DISABLED:
+                    tool.disabled += 1
+                else:
+                    tool.missing += 1
+                    tool.consecutiveMissing += 1
+                    if tool.consecutiveMissing > tool.maxConsecutiveMissing:
+                        tool.maxConsecutiveMissing = tool.consecutiveMissing
+            self.missingHandles = tuple(missingHandles)
+
+    def recordRequest(self, retries, waited, timedOut):
+        '''
+        Count one call of getPositionInRange
+        '''
+        with self.lock:
+            self.requests += 1
+            self.retries += retries
+            self.waitTime += waited
+            if waited > self.maxWait:
+                self.maxWait = waited
+            if timedOut:
+                self.timeouts += 1
+
+    def snapshot(self):
+        '''
+        Copy of every counter as a dict, tools keyed by handle
+        '''
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'retries': self.retries,
+                'timeouts': self.timeouts,
+                'waitTime': self.waitTime,
+                'maxWait': self.maxWait,
+                'missingHandles': self.missingHandles,
+                'tools': {handle: {name: getattr(tool, name) for name in toolStats.__slots__}
+                          for handle, tool in self.tools.items()},
+            }
+
+    def __repr__(self):
+        with self.lock:
+            tools = ', '.join('{:02X}: {}/{} missing'.format(handle, tool.missing, tool.frames)
+                              for handle, tool in sorted(self.tools.items()))
+            return 'trackingStats(requests={}, retries={}, timeouts={}, waitTime={:.3f}, maxWait={:.3f}, tools=[{}])'.format(
+                self.requests, self.retries, self.timeouts, self.waitTime, self.maxWait, tools)
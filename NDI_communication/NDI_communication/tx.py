@@ -0,0 +1,263 @@
+'''
+ * @file    tx.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Parse ASCII TX tracking replies from the NDI Aurora
+
+    A TX reply (reply option 0001) starts with the number of handles as 2
+    hex digits, followed by one line per handle and the system status:
+
+    valid       handle | q0 qx qy qz | tx ty tz | error | port status | frame | LF
+    missing     handle | MISSING | port status | frame | LF
+    disabled    handle | DISABLED | LF
+                system status (4 hex digits)
+
+    handle, port status and frame are hex (2, 8 and 8 digits). The
+    quaternion and error are a sign and 5 digits with the decimal point
+    after the first (+0.1234 is '+01234'), positions are a sign and 6 digits
+    with the decimal point before the last 2 ('-0123.45' is '-012345').
+
+    Tools are returned in a NumPy structured array with one row per handle
+    (see TOOL_DTYPE). parseTXBatch decodes many recorded replies at once,
+    formatTX builds a reply (e.g. for the simulated tracker).
+'''
+import numpy as np
+from .bx import VALID, MISSING, DISABLED
+
+MAX_HANDLES = 8             # rows preallocated for a single reply
+
+TOOL_DTYPE = np.dtype([
+    ('handle', np.uint8),
+    ('status', np.uint8),               # VALID, MISSING or DISABLED, 0 for rows past the last handle
+    ('quaternion', np.float64, (4,)),   # q0, qx, qy, qz
+    ('position', np.float64, (3,)),     # tx, ty, tz (mm)
+    ('error', np.float64),              # RMS error of the fit (mm)
+    ('portStatus', np.uint32),
+    ('frame', np.uint32),
+])
+
+# Field widths of a valid handle line, in characters
+QUATERNION_WIDTH = 6
+POSITION_WIDTH = 7
+ERROR_WIDTH = 6
+HEX_WIDTH = 8
+HANDLE_WIDTH = 2
+TRANSFORM_WIDTH = 4 * QUATERNION_WIDTH + 3 * POSITION_WIDTH + ERROR_WIDTH
+
+# Length of each kind of handle line including the line feed
+VALID_LENGTH = HANDLE_WIDTH + TRANSFORM_WIDTH + 2 * HEX_WIDTH + 1
+MISSING_LENGTH = HANDLE_WIDTH + len('MISSING') + 2 * HEX_WIDTH + 1
+DISABLED_LENGTH = HANDLE_WIDTH + len('DISABLED') + 1
+
+QUATERNION_SCALE = 1e-4
+POSITION_SCALE = 1e-2
+ERROR_SCALE = 1e-4
+
+def layout(reply):
+    """ where every handle line of a TX reply starts
+
+    Parameters
+    ----------
+    reply : string
+        TX reply as returned by ndiCommand
+
+    Returns
+    -------
+    tuple
+        (handles, systemStatusOffset) where handles is a tuple of
+        (offset, status) for every handle line
+
+    Raises
+    ------
+    ValueError
+        If the reply is shorter than its handle count says.
+
+    """
+    numHandles = int(reply[0:2], 16)
+    offset = 2
+    handles = []
+    for _ in range(numHandles):
+        if reply.startswith('MISSING', offset + HANDLE_WIDTH):
+            status, length = MISSING, MISSING_LENGTH
+        elif reply.startswith('DISABLED', offset + HANDLE_WIDTH):
+            status, length = DISABLED, DISABLED_LENGTH
+        else:
+            status, length = VALID, VALID_LENGTH
+        handles.append((offset, status))
+        offset += length
+    if len(reply) < offset:
+        raise ValueError("TX reply too short for {} handles ({} characters)".format(numHandles, len(reply)))
+    return tuple(handles), offset
+
+def _signed(text, start, width):
+    value = int(text[start + 1:start + width])
+    return -value if text[start] == '-' else value
+
+def parseTX(reply, out=None):
+    """ parse a TX reply with any number of handles
+
+    Parameters
+    ----------
+    reply : string
+        TX reply as returned by ndiCommand
+    out : numpy array of TOOL_DTYPE
+        preallocated rows to write into, allocated with MAX_HANDLES rows if
+        not given. Must have at least one row per handle
+
+    Returns
+    -------
+    tuple
+        (tools, systemStatus) where tools is a view of the first rows of
+        out, one row per handle in the order of the reply
+
+    """
+    handles, statusOffset = layout(reply)
+    if out is None:
+        out = np.zeros(max(MAX_HANDLES, len(handles)), dtype=TOOL_DTYPE)
+    elif len(out) < len(handles):
+        raise ValueError("TX reply has {} handles, only {} rows to write them to".format(len(handles), len(out)))
+
+    nan = float('nan')
+    for row, (offset, status) in enumerate(handles):
+        handle = int(reply[offset:offset + HANDLE_WIDTH], 16)
+        field = offset + HANDLE_WIDTH
+        if status == VALID:
+            quaternion = []
+            for _ in range(4):
+                quaternion.append(_signed(reply, field, QUATERNION_WIDTH) * QUATERNION_SCALE)
+                field += QUATERNION_WIDTH
+            position = []
+            for _ in range(3):
+                position.append(_signed(reply, field, POSITION_WIDTH) * POSITION_SCALE)
+                field += POSITION_WIDTH
+            error = _signed(reply, field, ERROR_WIDTH) * ERROR_SCALE
+            field += ERROR_WIDTH
+        else:
+            quaternion = (nan, nan, nan, nan)
+            position = (nan, nan, nan)
+            error = nan
+            if status == MISSING:
+                field += len('MISSING')
+        if status != DISABLED:
+            portStatus = int(reply[field:field + HEX_WIDTH], 16)
+            frame = int(reply[field + HEX_WIDTH:field + 2 * HEX_WIDTH], 16)
+        else:
+            portStatus = frame = 0
+        # Assign the whole row at once, much cheaper than field by field
+        out[row] = (handle, status, quaternion, position, error, portStatus, frame)
+
+    systemStatus = int(reply[statusOffset:statusOffset + 4], 16)
+    return out[:len(handles)], systemStatus
+
+def formatTX(tools, systemStatus=0):
+    """ build a TX reply, the inverse of parseTX
+
+    Parameters
+    ----------
+    tools : list of bx.toolTransform
+        tool data in the order it should appear in the reply
+    systemStatus : int
+        system status bits
+
+    Returns
+    -------
+    string
+        the reply as ndiCommand returns it
+
+    """
+    lines = ['{:02X}'.format(len(tools))]
+    for tool in tools:
+        lines.append('{:02X}'.format(tool.handle))
+        if tool.status == DISABLED:
+            lines.append('DISABLED\n')
+            continue
+        if tool.status == VALID:
+            for value in tool.quaternion:
+                lines.append('{:+06d}'.format(int(round(value / QUATERNION_SCALE))))
+            for value in tool.position:
+                lines.append('{:+07d}'.format(int(round(value / POSITION_SCALE))))
+            lines.append('{:+06d}'.format(int(round(tool.error / ERROR_SCALE))))
+        else:
+            lines.append('MISSING')
+        lines.append('{:08X}{:08X}\n'.format(tool.portStatus, tool.frame))
+    lines.append('{:04X}'.format(systemStatus))
+    return ''.join(lines)
+
+# Value of every ASCII character as a hex digit, used by the batch decoder
+_HEX_VALUES = np.zeros(256, dtype=np.uint64)
+for _digit in '0123456789':
+    _HEX_VALUES[ord(_digit)] = ord(_digit) - ord('0')
+for _digit in 'ABCDEF':
+    _HEX_VALUES[ord(_digit)] = ord(_digit) - ord('A') + 10
+    _HEX_VALUES[ord(_digit.lower())] = ord(_digit) - ord('A') + 10
+
+def _signedColumns(chars, start, width, scale):
+    digits = chars[:, start + 1:start + width].astype(np.int64) - ord('0')
+    weights = 10 ** np.arange(width - 2, -1, -1, dtype=np.int64)
+    values = (digits @ weights) * scale
+    return np.where(chars[:, start] == ord('-'), -values, values)
+
+def _hexColumns(chars, start, width):
+    weights = 16 ** np.arange(width - 1, -1, -1, dtype=np.uint64)
+    return _HEX_VALUES[chars[:, start:start + width]] @ weights
+
+def parseTXBatch(replies):
+    """ parse many recorded TX replies at once
+
+    Replies with the same layout (same handles missing or disabled) are
+    decoded together with array operations instead of one at a time.
+
+    Parameters
+    ----------
+    replies : sequence of string
+        TX replies, e.g. read back from a log file
+
+    Returns
+    -------
+    tuple
+        (tools, systemStatus) where tools is a TOOL_DTYPE array of shape
+        (len(replies), most handles in any reply) and systemStatus an array
+        with one value per reply. Rows past the last handle of a reply have
+        status 0
+
+    """
+    layouts = [layout(reply) for reply in replies]
+    numHandles = max((len(handles) for handles, _ in layouts), default=0)
+    tools = np.zeros((len(replies), numHandles), dtype=TOOL_DTYPE)
+    systemStatus = np.zeros(len(replies), dtype=np.uint16)
+
+    groups = {}
+    for index, replyLayout in enumerate(layouts):
+        groups.setdefault(replyLayout, []).append(index)
+
+    for (handles, statusOffset), indices in groups.items():
+        indices = np.array(indices)
+        # One row of characters per reply, all replies in a group line up
+        chars = np.frombuffer(''.join(replies[i][:statusOffset + 4] for i in indices).encode('ascii'),
+                              dtype=np.uint8).reshape(len(indices), statusOffset + 4)
+        systemStatus[indices] = _hexColumns(chars, statusOffset, 4)
+        for row, (offset, status) in enumerate(handles):
+            column = tools[indices, row]
+            column['handle'] = _hexColumns(chars, offset, HANDLE_WIDTH)
+            column['status'] = status
+            field = offset + HANDLE_WIDTH
+            if status == VALID:
+                for i in range(4):
+                    column['quaternion'][:, i] = _signedColumns(chars, field, QUATERNION_WIDTH, QUATERNION_SCALE)
+                    field += QUATERNION_WIDTH
+                for i in range(3):
+                    column['position'][:, i] = _signedColumns(chars, field, POSITION_WIDTH, POSITION_SCALE)
+                    field += POSITION_WIDTH
+                column['error'] = _signedColumns(chars, field, ERROR_WIDTH, ERROR_SCALE)
+                field += ERROR_WIDTH
+            else:
+                column['quaternion'] = np.nan
+                column['position'] = np.nan
+                column['error'] = np.nan
+                if status == MISSING:
+                    field += len('MISSING')
+            if status != DISABLED:
+                column['portStatus'] = _hexColumns(chars, field, HEX_WIDTH)
+                column['frame'] = _hexColumns(chars, field + HEX_WIDTH, HEX_WIDTH)
+            tools[indices, row] = column
+
+    return tools, systemStatus
@@ -15,7 +15,7 @@ setuptools.setup(
         description=DESCRIPTION,
         long_description=LONG_DESCRIPTION,
         packages=setuptools.find_packages(),
-        install_requires=['ndicapi==3.2.8', 'pyserial==3.5'], # add any additional packages that
+        install_requires=['ndicapi==3.2.8', 'pyserial==3.5', 'numpy'], # add any additional packages that
         # needs to be installed along with your package. Eg: 'caer'
 
         keywords=['python'],
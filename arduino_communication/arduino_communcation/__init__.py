@@ -4,19 +4,27 @@
  * @brief   Methods to control Arduino communication
 '''
 import time
+import threading
+import numpy as np
+from concurrent import futures
 import serial as pys
 import atexit
 import logging
 import serial.tools.list_ports
+from . import protocol
+from . import telemetry
 
 
-SETUP_WAIT_TIME_SEC = 10         # Forcing python to wait 10 seconds before asking the Arduino if connection
-                                 # is complete. We want to avoid using the serial line while pressure sensors
-                                 # Are being initialized on the arduino side. TODO: Determine if value can be decreased
-SETUP_COMPLETE_MSG_LENGTH = 23   # Message length for confirmation sent back by Arduino
+SETUP_TIMEOUT_SEC = 10           # Longest time to wait for the Arduino to report that setup is complete
+SETUP_POLL_SEC = 0.05            # Read timeout while waiting for the setup message
+RESET_PULSE_SEC = 0.05           # How long DTR is held low to reset the Arduino
+SETUP_COMPLETE_MSG = "Arduino Setup Complete" # Confirmation sent back by Arduino once it is initialized
 MSG_RECIEVED_BY_ARDUINO = "rx"   # Message sent back from Arduino when it has processed a serial message from Python
-MSG_RECIEVED_BY_ARDUINO_LENGTH = 4 # Number of bytes expected when Arduino is sending back a confirmation
+DEFAULT_TIMEOUT_SEC = 1.0        # Longest time a read waits for the Arduino to reply before giving up
+DEFAULT_STREAM_RATE_HZ = 100     # Default rate the Arduino pushes pressure samples at in streaming mode
+DEFAULT_PIPELINE_WINDOW = 8      # Default number of commands that can wait for an acknowledgement at once
 DEFAULT_PRESSURE_PSI = 12.25    # Pressure near atmospheric in psi, with implied decimal after 2
+ALL_CHANNELS_HEADER = "ca"       # Header for commands that apply to every channel at once
 
 def getPort(deviceName):
     """ use to find port with the given port description
@@ -49,8 +57,57 @@ def getPort(deviceName):
 
     raise Exception("Could not find device with {} as device name".format(deviceName))
 
-class arduino:
+def pressureToCommand(desiredPressure):
+    """ convert a pressure into the 4 digit body used by the Arduino
+
+    Parameters
+    ----------
+    desiredPressure : float
+        pressure in psi
+
+    Returns
+    -------
+    string
+        pressure rounded to 2 decimal points with the decimal removed and
+        zero padded to 4 digits, e.g. 9.5 -> '0950' and 12.25 -> '1225'
+
+    """
+    return '{:04d}'.format(int(round(desiredPressure * 100)))
+
+class ArduinoTimeoutError(IOError):
+    """ Raised when the Arduino does not reply before the serial timeout """
+    pass
+
+class latencyCounter:
+    '''
+    Keeps running statistics of how long a type of serial transaction
+    takes, from writing the command until the full reply was read
+    '''
+    __slots__ = ('count', 'timeouts', 'total', 'max', 'last')
+
     def __init__(self):
+        self.count = 0          # number of completed transactions
+        self.timeouts = 0       # number of transactions that timed out
+        self.total = 0.0        # sum of all latencies (seconds)
+        self.max = 0.0          # worst latency seen (seconds)
+        self.last = 0.0         # latency of the most recent transaction (seconds)
+
+    def record(self, latency):
+        self.count += 1
+        self.total += latency
+        self.last = latency
+        if latency > self.max:
+            self.max = latency
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def __repr__(self):
+        return 'latencyCounter(count={}, timeouts={}, mean={:.6f}, max={:.6f}, last={:.6f})'.format(
+            self.count, self.timeouts, self.mean(), self.max, self.last)
+
+class arduino:
+    def __init__(self, timeout=DEFAULT_TIMEOUT_SEC, binary=False, port=None, reset=False):
         # Used for indicating which channels are on and off
         self.ON = "1"
         self.OFF = "0"
@@ -65,7 +122,51 @@ class arduino:
         self.c1_enabled = self.OFF
         self.c2_enabled = self.OFF
 
+        # Serial port to open. Found with getPort when not given, pass one
+        # explicitly to attach to e.g. the arduino_simulator pseudo-terminal
+        self.port = port
+
+        # Toggle DTR after opening the port so the Arduino always starts from
+        # a fresh reset instead of relying on the reset most boards do on open
+        self.resetOnConnect = reset
+        # Seconds from opening the port until the Arduino was ready, set by startCommunication
+        self.startupDuration = None
+
+        # Latency statistics for each type of command, keyed by command name
+        self.latency = {}
+
+        # Binary framing (see protocol.py) is only used if it was requested
+        # and the firmware reports that it supports it in startCommunication
+        self.binaryRequested = binary
+        self.binaryMode = False
+        self.protocolVersion = 0
+        self.sequence = 0
+        self.txFrame = bytearray(protocol.COMMAND_FRAME.size)
+
+        # Streaming and pipelining. While either is on, the reader thread owns
+        # the input side of the serial port: telemetry frames go into
+        # self.telemetry and replies complete the matching entry of
+        # self.pending, which maps sequence number -> (future, name, start, deadline)
+        self.streaming = False
+        self.telemetry = None
+        self.readerThread = None
+        self.stopReader = threading.Event()
+        self.latestSample = np.zeros(telemetry.PRESSURE + protocol.NUM_CHANNELS)
+        self.pipelined = False
+        self.pending = {}
+        self.pendingLock = threading.Lock()
+        self.windowSize = DEFAULT_PIPELINE_WINDOW
+        self.window = threading.BoundedSemaphore(DEFAULT_PIPELINE_WINDOW)
+        self.onError = None
+
+        # Only one command can be in flight at a time, so serialize callers
+        # that share this connection from different threads
+        self.lock = threading.RLock()
+
+        # Reads block inside pyserial for at most timeout seconds instead
+        # of polling in_waiting, so we don't burn a core waiting for replies
         self.ser = pys.Serial()
+        self.ser.timeout = timeout
         self.startCommunication()
 
         atexit.register(self.close)
@@ -73,84 +174,509 @@ class arduino:
     def startCommunication(self):
         # Open Serial to Arduino
         self.ser.baudrate = 115200
-        self.ser.port = getPort('Arduino')[0]
+        self.ser.port = self.port if self.port else getPort('Arduino')[0]
+        start = time.perf_counter()
         self.ser.open()
         if (self.ser.is_open != True):
             print("Could not open serial")
             quit()
 
-        # Give time for Arduino to use serial line to setup pressure sensors
+        if self.resetOnConnect and not self.resetBoard():
+            print("Could not reset Arduino with DTR, waiting for it to finish setup")
+
+        # The Arduino uses the serial line while it sets up the pressure
+        # sensors, so wait for it to say it is done before sending anything
         print("Waiting for Arduino Initialization...")
-        time.sleep(SETUP_WAIT_TIME_SEC)
-        while True:
-            if(self.ser.in_waiting >= SETUP_COMPLETE_MSG_LENGTH):
-                arduinoSetup = self.ser.readline().decode('utf-8')
+        self.waitForSetup(start + SETUP_TIMEOUT_SEC)
+        self.startupDuration = time.perf_counter() - start
+        print("Arduino Serial Established in {:.2f} s".format(self.startupDuration))
+
+        self.negotiateProtocol()
+
+    def resetBoard(self):
+        '''
+        Reset the Arduino by pulsing DTR and throw away anything it sent
+        before the reset. Returns False if the port has no DTR line (e.g. a
+        pseudo-terminal), in which case nothing is discarded
+        '''
+        try:
+            self.ser.dtr = False
+            time.sleep(RESET_PULSE_SEC)
+            self.ser.dtr = True
+        except (OSError, pys.SerialException):
+            return False
+        self.ser.reset_input_buffer()
+        return True
+
+    def waitForSetup(self, deadline):
+        '''
+        Poll for the setup complete message until deadline (a
+        time.perf_counter() value). Raises ArduinoTimeoutError if it does
+        not arrive in time
+        '''
+        timeout = self.ser.timeout
+        self.ser.timeout = SETUP_POLL_SEC
+        line = b''
+        try:
+            while time.perf_counter() < deadline:
+                # A short timeout can split a line, so keep the pieces until the newline
+                line += self.ser.readline()
+                if not line.endswith(b'\n'):
+                    continue
+                arduinoSetup = line.decode('utf-8', errors='replace').rstrip()
+                line = b''
                 print(arduinoSetup)
-                if(arduinoSetup.rstrip() == "Arduino Setup Complete"):
-                    print("Arduino Serial Established")
-                    break
-        
+                if arduinoSetup == SETUP_COMPLETE_MSG:
+                    return
+        finally:
+            self.ser.timeout = timeout
+        raise ArduinoTimeoutError("Arduino did not finish setup within {} s".format(SETUP_TIMEOUT_SEC))
+
+    def negotiateProtocol(self):
+        '''
+        Ask the firmware which protocol version it speaks and switch to
+        binary frames if they were requested and are supported
+        '''
+        reply = self.transact('negotiateProtocol', protocol.VERSION_QUERY)
+        if reply.startswith(protocol.VERSION_REPLY_PREFIX):
+            self.protocolVersion = int(reply[len(protocol.VERSION_REPLY_PREFIX):])
+        elif reply == MSG_RECIEVED_BY_ARDUINO:
+            # Older firmware only knows the ASCII protocol
+            self.protocolVersion = 0
+        else:
+            raise IOError("Unexpected reply from Arduino to protocol query: '{}'".format(reply))
+
+        self.binaryMode = self.binaryRequested and self.protocolVersion >= protocol.PROTOCOL_VERSION
+        if self.binaryRequested and not self.binaryMode:
+            print("Arduino firmware does not support binary frames, using ASCII protocol")
+
+    def transact(self, name, message):
+        '''
+        Write a command to the Arduino and block until its one line reply
+        arrives. Raises ArduinoTimeoutError if the full reply does not
+        arrive within the serial timeout. The round trip time is recorded
+        in self.latency[name]
+        '''
+        if self.readerThread is not None:
+            raise IOError("ASCII commands cannot be used while streaming or pipelining")
+
+        counter = self.latencyCounterFor(name)
+        with self.lock:
+            start = time.perf_counter()
+            self.ser.write(message.encode('utf-8'))
+            reply = self.ser.readline()
+            if not reply.endswith(b'\n'):
+                counter.timeouts += 1
+                raise ArduinoTimeoutError(
+                    "Arduino did not reply to '{}' within {} seconds (received {})".format(message, self.ser.timeout, reply))
+            counter.record(time.perf_counter() - start)
+
+        return reply.decode('utf-8').rstrip()
+
+    def transactWithAck(self, name, message):
+        '''
+        Write a command to the Arduino and wait for the confirmation
+        '''
+        reply = self.transact(name, message)
+        if reply != MSG_RECIEVED_BY_ARDUINO:
+            raise IOError("Unexpected reply from Arduino to '{}': '{}'".format(message, reply))
+
+    def transactBinary(self, name, frameType, mask, pressures=(0.0, 0.0, 0.0), values=None):
+        '''
+        Binary equivalent of transact. Sends one command frame and blocks
+        until its reply frame arrives. Returns the decoded reply as
+        (frameType, seq, mask, millis, pressures). If values is given it is
+        sent as the raw uint16 payload instead of pressures
+        '''
+        if self.readerThread is not None:
+            # The reader thread owns the input, wait for it to match the reply
+            return self.submitBinary(name, frameType, mask, pressures, values).result()
+
+        counter = self.latencyCounterFor(name)
+        with self.lock:
+            seq = self.packFrame(frameType, mask, pressures, values)
+
+            start = time.perf_counter()
+            self.ser.write(self.txFrame)
+            data = self.ser.read(protocol.REPLY_FRAME.size)
+            if len(data) < protocol.REPLY_FRAME.size:
+                counter.timeouts += 1
+                raise ArduinoTimeoutError(
+                    "Arduino did not reply to binary {} within {} seconds (received {})".format(name, self.ser.timeout, data))
+            try:
+                reply = protocol.unpackReply(data)
+            except ValueError as e:
+                # Drop whatever is left so the next frame starts in sync
+                self.ser.reset_input_buffer()
+                raise IOError("Corrupted reply from Arduino to binary {}: {}".format(name, e))
+            counter.record(time.perf_counter() - start)
+
+        if reply[0] == protocol.FRAME_NAK:
+            raise IOError("Arduino rejected binary {} (seq {})".format(name, seq))
+        if reply[1] != seq:
+            raise IOError("Arduino replied to seq {} while waiting for seq {}".format(reply[1], seq))
+
+        return reply
+
+    def latencyCounterFor(self, name):
+        counter = self.latency.get(name)
+        if counter is None:
+            counter = self.latency[name] = latencyCounter()
+        return counter
+
+    def packFrame(self, frameType, mask, pressures, values):
+        '''
+        Build the next command frame in self.txFrame and return its
+        sequence number. Must be called with self.lock held
+        '''
+        seq = self.sequence
+        self.sequence = (seq + 1) & 0xFF
+        if values is None:
+            protocol.packCommand(self.txFrame, frameType, seq, mask, pressures)
+        else:
+            protocol.packCommandRaw(self.txFrame, frameType, seq, mask, values)
+        return seq
+
+    def submitBinary(self, name, frameType, mask, pressures=(0.0, 0.0, 0.0), values=None):
+        '''
+        Write a command frame without waiting for its reply. Returns a
+        concurrent.futures.Future that the reader thread completes with the
+        decoded reply, or fails with IOError on a NAK and ArduinoTimeoutError
+        if no reply arrives within the serial timeout. Blocks only while the
+        window of outstanding commands is full
+        '''
+        if self.readerThread is None:
+            raise IOError("Commands can only be submitted while the reader thread is running")
+
+        if not self.window.acquire(timeout=self.ser.timeout):
+            self.latencyCounterFor(name).timeouts += 1
+            raise ArduinoTimeoutError(
+                "{} commands to the Arduino are still waiting for a reply".format(self.windowSize))
+
+        future = futures.Future()
+        future.add_done_callback(self.releaseWindow)
+        with self.lock:
+            seq = self.packFrame(frameType, mask, pressures, values)
+            start = time.perf_counter()
+            with self.pendingLock:
+                self.pending[seq] = (future, name, start, start + self.ser.timeout)
+            self.ser.write(self.txFrame)
+
+        return future
+
+    def releaseWindow(self, future):
+        self.window.release()
+
+    def enablePipelining(self, window=DEFAULT_PIPELINE_WINDOW, onError=None):
+        '''
+        Stop waiting for acknowledgements. sendDesiredPressure(s) and
+        selectChannels write their frame and return a Future right away, and
+        the reader thread matches the acknowledgements by sequence number.
+        At most window commands can be outstanding. onError(name, seq, error)
+        is called from the reader thread for every command that was rejected
+        or timed out
+        '''
+        if not self.binaryMode:
+            raise IOError("Pipelining requires binary mode, create the arduino with binary=True")
+        if window >= 128:
+            raise ValueError("Pipeline window must be below 128 so sequence numbers stay unique")
+
+        with self.lock:
+            self.windowSize = window
+            self.window = threading.BoundedSemaphore(window)
+            self.onError = onError
+            self.startReader()
+            self.pipelined = True
+
+    def disablePipelining(self):
+        '''
+        Wait for every outstanding command and go back to stop-and-wait
+        '''
+        if not self.pipelined:
+            return
+
+        self.pipelined = False
+        self.flush()
+        if not self.streaming:
+            self.stopReaderThread()
+
+    def flush(self, timeout=None):
+        '''
+        Block until every outstanding command has been acknowledged, rejected
+        or timed out. Returns False if some are still pending after timeout
+        '''
+        with self.pendingLock:
+            outstanding = [entry[0] for entry in self.pending.values()]
+        notDone = futures.wait(outstanding, timeout).not_done
+        return len(notDone) == 0
+
+    def startReader(self):
+        if self.readerThread is not None:
+            return
+        self.stopReader.clear()
+        self.readerThread = threading.Thread(target=self.readerLoop, name='arduinoReader', daemon=True)
+        self.readerThread.start()
+
+    def stopReaderThread(self):
+        if self.readerThread is None:
+            return
+        self.stopReader.set()
+        self.ser.cancel_read()
+        self.readerThread.join()
+        self.readerThread = None
+
+        # Anything still pending can't be answered anymore
+        self.expirePending(float('inf'))
+
+    def startStreaming(self, rateHz=DEFAULT_STREAM_RATE_HZ, capacity=telemetry.DEFAULT_CAPACITY):
+        '''
+        Ask the Arduino to push the pressure of every enabled channel at
+        rateHz and start a background thread that decodes the samples into
+        self.telemetry. While streaming, getActualPressure(s) return the
+        newest sample without touching the serial line. The real rate is
+        capped by how long one pass of the firmware control loop takes
+        '''
+        if not self.binaryMode:
+            raise IOError("Streaming requires binary mode, create the arduino with binary=True")
+        if self.streaming:
+            return
+
+        self.telemetry = telemetry.telemetryBuffer(capacity, protocol.NUM_CHANNELS)
+        periodMs = max(1, int(round(1000.0 / rateHz)))
+        self.startReader()
+        try:
+            self.transactBinary('startStreaming', protocol.FRAME_STREAM, self.enabledMask(), values=(periodMs, 0, 0))
+        except Exception:
+            # Not streaming, stopStreaming() would never shut the reader down
+            if not self.pipelined:
+                self.stopReaderThread()
+            raise
+        self.streaming = True
+
+    def stopStreaming(self):
+        '''
+        Stop the Arduino from streaming and shut down the reader thread
+        unless it is still needed for pipelining
+        '''
+        if not self.streaming:
+            return
+
+        try:
+            # No more samples are sent once this is acknowledged
+            self.transactBinary('stopStreaming', protocol.FRAME_STREAM, 0, values=(0, 0, 0))
+        finally:
+            self.streaming = False
+            if not self.pipelined:
+                self.stopReaderThread()
+
+    def readerLoop(self):
+        '''
+        Runs on the reader thread while streaming or pipelining. Splits the
+        incoming bytes into reply frames, resynchronizing on the sync byte
+        after corrupted data, and expires commands that were never answered
+        '''
+        frameSize = protocol.REPLY_FRAME.size
+        rxBuffer = bytearray()
+        while not self.stopReader.is_set():
+            # Take everything that is waiting, or block until at least one
+            # byte arrives. stopReaderThread cancels the read to wake us up
+            rxBuffer += self.ser.read(self.ser.in_waiting or 1)
+
+            while len(rxBuffer) >= frameSize:
+                if rxBuffer[0] != protocol.ARDUINO_SYNC:
+                    syncIndex = rxBuffer.find(protocol.ARDUINO_SYNC)
+                    del rxBuffer[:syncIndex if syncIndex > 0 else len(rxBuffer)]
+                    continue
+                try:
+                    reply = protocol.unpackReply(rxBuffer)
+                except ValueError:
+                    # Skip the bad sync byte and look for the next frame
+                    del rxBuffer[0]
+                    continue
+                del rxBuffer[:frameSize]
+                self.handleReply(reply)
+
+            if self.pending:
+                self.expirePending(time.perf_counter())
+
+    def handleReply(self, reply):
+        '''
+        Sort a frame decoded by the reader thread into the telemetry
+        buffer or complete the command it acknowledges
+        '''
+        if reply[0] == protocol.FRAME_TELEMETRY:
+            self.telemetry.append(time.perf_counter(), reply[3] / 1000.0, reply[4])
+            return
+
+        with self.pendingLock:
+            entry = self.pending.pop(reply[1], None)
+        if entry is None:
+            # Reply to a command that already timed out
+            return
+
+        future, name, start, deadline = entry
+        counter = self.latencyCounterFor(name)
+        if reply[0] == protocol.FRAME_NAK:
+            self.failCommand(future, name, reply[1], IOError("Arduino rejected binary {} (seq {})".format(name, reply[1])))
+        else:
+            counter.record(time.perf_counter() - start)
+            future.set_result(reply)
+
+    def expirePending(self, now):
+        '''
+        Fail every outstanding command whose deadline is before now
+        '''
+        with self.pendingLock:
+            expired = [seq for seq, entry in self.pending.items() if entry[3] <= now]
+            entries = [(seq, self.pending.pop(seq)) for seq in expired]
+        for seq, (future, name, start, deadline) in entries:
+            self.latencyCounterFor(name).timeouts += 1
+            self.failCommand(future, name, seq, ArduinoTimeoutError(
+                "Arduino did not reply to binary {} within {} seconds".format(name, self.ser.timeout)))
+
+    def failCommand(self, future, name, seq, error):
+        future.set_exception(error)
+        if self.onError is not None:
+            try:
+                self.onError(name, seq, error)
+            except Exception:
+                logging.exception("Error callback for Arduino command {} failed".format(name))
+
+    def latestPressures(self):
+        '''
+        Returns the newest streamed sample as a row of telemetry.telemetryBuffer.
+        Only blocks if no sample has arrived yet
+        '''
+        if self.telemetry.count == 0 and not self.telemetry.waitForSample(self.ser.timeout):
+            raise ArduinoTimeoutError("No pressure samples streamed by the Arduino within {} seconds".format(self.ser.timeout))
+        return self.telemetry.latest(self.latestSample)
+
+    def enabledMask(self):
+        '''
+        returns the channel mask of the channels turned on with selectChannels
+        '''
+        return protocol.channelMask(self.c0_enabled == self.ON, self.c1_enabled == self.ON, self.c2_enabled == self.ON)
+
     def getActualPressure(self, channelNum):
-        '''     
+        '''
         Obtains actual pressure from pressure sensor
         '''
+        if self.streaming:
+            return float(self.latestPressures()[telemetry.PRESSURE + channelNum])
+
+        if self.binaryMode:
+            reply = self.transactBinary('getActualPressure', protocol.FRAME_READ_PRESSURES, 1 << channelNum)
+            return reply[4][channelNum]
+
         readPressure = 'c{}{}'.format(channelNum, "read")
-        self.ser.write(readPressure.encode('utf-8'))
-        while True:
-            if(self.ser.in_waiting > 4):
-                P_act = float(self.ser.readline().decode('utf-8'))  # convert pressures from string to float
-                break
+        P_act = float(self.transact('getActualPressure', readPressure))  # convert pressures from string to float
 
         return P_act
 
-    def sendDesiredPressure(self, channelNum, desiredPressure):
+    def getActualPressures(self):
         '''
-        convert desiredPressure and send this pressure into the Arduino
+        Obtains the actual pressure of every enabled channel with one
+        request to the Arduino. Returns a numpy array ordered by channel
+        number that only contains the enabled channels
         '''
+        if self.streaming:
+            sample = self.latestPressures()
+            mask = self.enabledMask()
+            return np.array([sample[telemetry.PRESSURE + c] for c in range(protocol.NUM_CHANNELS) if mask & (1 << c)])
 
-        # Turn float pressure into strings of right format to send to Adruino
-        desiredPressure = round(desiredPressure, 2) # round desired pressure to 2 decimal points
-        lessThanTen = False                         # checks to see if the P_des is less than 10
+        if self.binaryMode:
+            mask = self.enabledMask()
+            reply = self.transactBinary('getActualPressures', protocol.FRAME_READ_PRESSURES, mask)
+            return np.array([reply[4][c] for c in range(protocol.NUM_CHANNELS) if mask & (1 << c)])
 
-        if desiredPressure < 10.0:
-            lessThanTen = True
+        readPressures = '{}{}'.format(ALL_CHANNELS_HEADER, "read")
+        reply = self.transact('getActualPressures', readPressures)
 
-        command = str(desiredPressure)     # turn float into a string
-        command = command.replace('.', '') # Remove decimal before sending over serial
+        # Arduino sends the pressures back as a comma separated line
+        P_act = np.array(reply.split(','), dtype=float)
+        if len(P_act) != self.numEnabledChannels():
+            raise Exception("Expected {} pressures from Arduino but got '{}'".format(self.numEnabledChannels(), reply))
 
-        # append leading zero to pressures less than 10 psi
-        if lessThanTen:
-            command = '0' + command
+        return P_act
 
-        # add following zero if we are missing the second decimal point
-        if len(command) == 3:
-            command = command + '0'
+    def numEnabledChannels(self):
+        '''
+        returns the number of channels turned on with selectChannels
+        '''
+        return [self.c0_enabled, self.c1_enabled, self.c2_enabled].count(self.ON)
+
+    def sendDesiredPressure(self, channelNum, desiredPressure):
+        '''
+        convert desiredPressure and send this pressure into the Arduino.
+        When pipelining, returns a Future instead of waiting for the ack
+        '''
+        if self.binaryMode:
+            pressures = [0.0] * protocol.NUM_CHANNELS
+            pressures[channelNum] = desiredPressure
+            if self.pipelined:
+                return self.submitBinary('sendDesiredPressure', protocol.FRAME_SET_PRESSURES, 1 << channelNum, pressures)
+            self.transactBinary('sendDesiredPressure', protocol.FRAME_SET_PRESSURES, 1 << channelNum, pressures)
+            return
 
         # Send over desired pressure to Arduino
-        sendPressure = 'c{}{}'.format(channelNum, command)
+        sendPressure = 'c{}{}'.format(channelNum, pressureToCommand(desiredPressure))
         # print("Writing command to arduino: ", sendPressure.encode('utf-8'))
-        self.ser.write(sendPressure.encode('utf-8'))
-        while True:
-            if (self.ser.in_waiting == MSG_RECIEVED_BY_ARDUINO_LENGTH):
-                if ((self.ser.readline().decode('utf-8')).rstrip() == MSG_RECIEVED_BY_ARDUINO):
-                    break
+        self.transactWithAck('sendDesiredPressure', sendPressure)
+
+    def sendDesiredPressures(self, p0, p1, p2):
+        '''
+        Send the desired pressure of all three channels in a single frame.
+        The Arduino only acknowledges once, so this costs one serial round
+        trip instead of three calls to sendDesiredPressure. When pipelining,
+        returns a Future instead of waiting for the ack
+        '''
+        if self.binaryMode:
+            if self.pipelined:
+                return self.submitBinary('sendDesiredPressures', protocol.FRAME_SET_PRESSURES, 0b111, (p0, p1, p2))
+            self.transactBinary('sendDesiredPressures', protocol.FRAME_SET_PRESSURES, 0b111, (p0, p1, p2))
+            return
+
+        sendPressures = '{}{}{}{}'.format(ALL_CHANNELS_HEADER, pressureToCommand(p0),
+                                          pressureToCommand(p1), pressureToCommand(p2))
+        self.transactWithAck('sendDesiredPressures', sendPressures)
 
     def selectChannels(self, c0_status, c1_status, c2_status):
+        '''
+        Turn channels on with arduino.ON. When pipelining, returns a Future
+        instead of waiting for the ack
+        '''
         self.c0_enabled = c0_status
         self.c1_enabled = c1_status
         self.c2_enabled = c2_status
 
+        if self.binaryMode:
+            if self.pipelined:
+                return self.submitBinary('selectChannels', protocol.FRAME_SELECT_CHANNELS, self.enabledMask())
+            self.transactBinary('selectChannels', protocol.FRAME_SELECT_CHANNELS, self.enabledMask())
+            return
+
         command = 'sc{}{}{}0'.format(self.c0_enabled, self.c1_enabled, self.c2_enabled)
         # print("Writing command to arduino: ", command.encode('utf-8'))
-        self.ser.write(command.encode('utf-8'))
-        while True:
-            if (self.ser.in_waiting == MSG_RECIEVED_BY_ARDUINO_LENGTH):
-                if ((self.ser.readline().decode('utf-8')).rstrip() == MSG_RECIEVED_BY_ARDUINO):
-                    break
+        self.transactWithAck('selectChannels', command)
+
+    def vent(self, pressure=DEFAULT_PRESSURE_PSI, timeout=None):
+        '''
+        Wait for every outstanding command, then set all three channels to
+        pressure (near atmospheric by default) and wait for the Arduino to
+        acknowledge it. Returns False if commands were still outstanding
+        after timeout
+        '''
+        drained = self.flush(timeout)
+        pending = self.sendDesiredPressures(pressure, pressure, pressure)
+        if pending is not None:
+            pending.result(timeout)
+        return drained
 
     def close(self):
         # Send command to reset to default pressure before terminating
         print("Closing Arduino Connection")
+        self.stopStreaming()
+        self.disablePipelining()
         if self.c0_enabled:
             self.sendDesiredPressure(self.channel0, DEFAULT_PRESSURE_PSI)
         if self.c1_enabled:
@@ -0,0 +1,169 @@
+'''
+ * @file    protocol.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Binary framing used between python and pressure_feedback_algorithm.ino
+
+    Every frame is fixed size and little-endian so it can be built with
+    struct.pack_into and decoded with struct.unpack_from.
+
+    Command frame (python -> Arduino), 11 bytes
+        sync (0xA5) | type | seq | channel mask | p0 | p1 | p2 | crc8
+    Reply frame (Arduino -> python), 15 bytes
+        sync (0x5A) | type | seq | channel mask | millis | p0 | p1 | p2 | crc8
+
+    Pressures are uint16 in centi-psi (12.25 psi -> 1225). Bit n of the
+    channel mask selects channel n. The crc8 (polynomial 0x07) covers every
+    byte of the frame before it. Replies echo the sequence number of the
+    command they answer.
+
+    Once streaming is started with FRAME_STREAM (p0 holds the period in ms,
+    0 stops it) the Arduino also pushes FRAME_TELEMETRY reply frames on its
+    own. Their sequence number is a free running sample counter.
+'''
+import struct
+
+PROTOCOL_VERSION = 1        # Version reported by firmware that understands binary frames
+VERSION_QUERY = "sc000v"    # ASCII query for the protocol version. Firmware without binary support
+                            # treats it as a select command that enables nothing and replies "rx"
+VERSION_REPLY_PREFIX = "v"  # Firmware with binary support replies "v<PROTOCOL_VERSION>"
+
+HOST_SYNC = 0xA5            # First byte of every command frame
+ARDUINO_SYNC = 0x5A         # First byte of every reply frame
+
+# Command frame types
+FRAME_SET_PRESSURES = 0x01
+FRAME_READ_PRESSURES = 0x02
+FRAME_SELECT_CHANNELS = 0x03
+FRAME_STREAM = 0x04
+
+# Reply frame types
+FRAME_ACK = 0x81
+FRAME_PRESSURES = 0x82
+FRAME_TELEMETRY = 0x83
+FRAME_NAK = 0xFF
+
+NUM_CHANNELS = 3
+MAX_CENTI_PSI = 0xFFFF
+
+COMMAND_FRAME = struct.Struct('<BBBB3HB')
+REPLY_FRAME = struct.Struct('<BBBBI3HB')
+
+def _buildCrcTable():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ 0x07) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+CRC8_TABLE = _buildCrcTable()
+
+def crc8(data, length=None):
+    """ crc8 (polynomial 0x07, initial value 0) of the first length bytes of data
+
+    Parameters
+    ----------
+    data : bytes or bytearray
+        frame to check
+    length : int
+        number of bytes to include, defaults to all of data
+
+    Returns
+    -------
+    int
+        crc of the data
+
+    """
+    if length is None:
+        length = len(data)
+    crc = 0
+    for i in range(length):
+        crc = CRC8_TABLE[crc ^ data[i]]
+    return crc
+
+def toCentiPsi(pressure):
+    """ convert a pressure in psi into the uint16 sent over the wire """
+    centiPsi = int(round(pressure * 100))
+    if centiPsi < 0:
+        return 0
+    if centiPsi > MAX_CENTI_PSI:
+        return MAX_CENTI_PSI
+    return centiPsi
+
+def channelMask(c0_enabled, c1_enabled, c2_enabled):
+    """ build a channel mask from one truthy flag per channel """
+    return (1 if c0_enabled else 0) | (2 if c1_enabled else 0) | (4 if c2_enabled else 0)
+
+def packCommand(frame, frameType, seq, mask, pressures=(0.0, 0.0, 0.0)):
+    """ build a command frame in place
+
+    Parameters
+    ----------
+    frame : bytearray
+        buffer of at least COMMAND_FRAME.size bytes that is overwritten
+    frameType : int
+        one of the FRAME_* command types
+    seq : int
+        sequence number (0-255) echoed back by the Arduino
+    mask : int
+        channel mask the command applies to
+    pressures : sequence of float
+        pressure in psi for each channel, ignored by the Arduino unless
+        frameType is FRAME_SET_PRESSURES
+
+    Returns
+    -------
+    bytearray
+        the same frame that was passed in
+
+    """
+    return packCommandRaw(frame, frameType, seq, mask,
+                          (toCentiPsi(pressures[0]), toCentiPsi(pressures[1]), toCentiPsi(pressures[2])))
+
+def packCommandRaw(frame, frameType, seq, mask, values):
+    """ build a command frame in place from the raw uint16 payload
+
+    Same as packCommand, but values are written to the three payload
+    fields as is. Used by commands whose payload is not a pressure,
+    e.g. the stream period of FRAME_STREAM.
+    """
+    COMMAND_FRAME.pack_into(frame, 0, HOST_SYNC, frameType, seq & 0xFF, mask,
+                            values[0], values[1], values[2], 0)
+    frame[COMMAND_FRAME.size - 1] = crc8(frame, COMMAND_FRAME.size - 1)
+    return frame
+
+def unpackReply(data, offset=0):
+    """ decode a reply frame
+
+    Parameters
+    ----------
+    data : bytes or bytearray
+        buffer holding the frame
+    offset : int
+        index of the sync byte in data
+
+    Returns
+    -------
+    tuple
+        (frameType, seq, mask, millis, pressures) where pressures is a tuple
+        of the pressure of each channel in psi
+
+    Raises
+    ------
+    ValueError
+        If the frame does not start with the sync byte or the crc does not match.
+
+    """
+    sync, frameType, seq, mask, millis, p0, p1, p2, crc = REPLY_FRAME.unpack_from(data, offset)
+    if sync != ARDUINO_SYNC:
+        raise ValueError("Reply frame does not start with sync byte (got 0x{:02X})".format(sync))
+    expected = 0
+    for i in range(offset, offset + REPLY_FRAME.size - 1):
+        expected = CRC8_TABLE[expected ^ data[i]]
+    if crc != expected:
+        raise ValueError("Reply frame crc mismatch (got 0x{:02X}, expected 0x{:02X})".format(crc, expected))
+    return (frameType, seq, mask, millis, (p0 / 100.0, p1 / 100.0, p2 / 100.0))
@@ -0,0 +1,77 @@
+'''
+ * @file    telemetry.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Ring buffer for pressure samples streamed by the Arduino
+'''
+import threading
+import numpy as np
+
+DEFAULT_CAPACITY = 4096     # Number of samples kept, about 40 seconds at 100 Hz
+
+# Column layout of every sample
+HOST_TIME = 0               # time.perf_counter() when python decoded the sample (seconds)
+ARDUINO_TIME = 1            # millis() on the Arduino when the sample was sent (seconds)
+PRESSURE = 2                # first pressure column, one column per channel (psi)
+
+class telemetryBuffer:
+    '''
+    Preallocated ring buffer of timestamped pressure samples. One thread
+    (the serial reader) appends, any number of threads read. Once the
+    buffer is full the oldest samples are overwritten
+    '''
+    def __init__(self, capacity=DEFAULT_CAPACITY, numChannels=3):
+        self.capacity = capacity
+        self.numChannels = numChannels
+        self.samples = np.zeros((capacity, PRESSURE + numChannels))
+        self.count = 0                          # total samples ever appended
+        self.lock = threading.Lock()
+        self.firstSample = threading.Event()    # set once a sample is available
+
+    def append(self, hostTime, arduinoTime, pressures):
+        '''
+        Store a new sample, overwriting the oldest one if the buffer is full
+        '''
+        with self.lock:
+            row = self.samples[self.count % self.capacity]
+            row[HOST_TIME] = hostTime
+            row[ARDUINO_TIME] = arduinoTime
+            row[PRESSURE:] = pressures
+            self.count += 1
+        self.firstSample.set()
+
+    def latest(self, out=None):
+        '''
+        Copy the newest sample into out (allocated if not given) and return
+        it. Returns None if nothing has been received yet
+        '''
+        with self.lock:
+            if self.count == 0:
+                return None
+            if out is None:
+                return self.samples[(self.count - 1) % self.capacity].copy()
+            out[:] = self.samples[(self.count - 1) % self.capacity]
+        return out
+
+    def history(self, numSamples=None):
+        '''
+        Returns a copy of the newest numSamples samples (all stored samples
+        by default) in chronological order
+        '''
+        # Same wraparound as poseHistory.history in NDI_communication.
+        # The two packages are installed separately and only share numpy, so
+        # a fix to one of them belongs in the other as well
+        with self.lock:
+            stored = min(self.count, self.capacity)
+            if numSamples is None or numSamples > stored:
+                numSamples = stored
+            end = self.count % self.capacity
+            start = end - numSamples
+            if start >= 0:
+                return self.samples[start:end].copy()
+            return np.concatenate((self.samples[start:], self.samples[:end]))
+
+    def waitForSample(self, timeout=None):
+        '''
+        Block until the first sample has arrived. Returns False on timeout
+        '''
+        return self.firstSample.wait(timeout)
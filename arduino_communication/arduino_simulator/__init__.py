@@ -0,0 +1,501 @@
+'''
+ * @file    arduino_simulator/__init__.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Stand-in for the control board running pressure_feedback_algorithm.ino
+
+    The simulator opens a pseudo-terminal and answers on it exactly like the
+    firmware does, so arduino_communcation.arduino can attach to it with
+    arduino(port=simulator.port) on any Linux machine. Supported:
+        - "Arduino Setup Complete" once setup has finished after every open
+          of the port (the real board resets when the port is opened)
+        - c{n}read, c{n}{pppp}, caread, ca{pppp}{pppp}{pppp}, sc{abc}0 and
+          the sc000v protocol query, with the same replies as the firmware
+        - binary frames from arduino_communcation.protocol, including streaming
+    Channel pressures follow the same bang-bang state machine as the firmware.
+    The inflate/deflate rates come from the fill time measurements in
+    Data_Storage/PWM_Valve_Test at the duty cycles the firmware uses. Replies
+    can be delayed by a configurable serial latency plus random jitter.
+    Everything random is drawn from a seeded generator so runs are repeatable.
+'''
+import os
+import sys
+import tty
+import errno
+import select
+import struct
+import ctypes
+import random
+import threading
+import time
+from collections import deque
+import numpy as np
+from arduino_communcation import protocol
+
+SETUP_COMPLETE_MSG = b"Arduino Setup Complete\r\n"
+NUM_CHANNELS = 3
+DEFAULT_PRESSURE = 12.25            # Same as the firmware, also the pressure every channel starts at
+PRESSURE_TOLERANCE = 0.03           # Bang-bang tolerances, see pressure_feedback_algorithm.ino
+PRESSURE_HOLD_TOLERANCE = 0.05
+POSITIVE_SOLENOID_DUTY_CYCLE = 65   # Duty cycles used by the firmware (%)
+NEGATIVE_SOLENOID_DUTY_CYCLE = 35
+FILL_PRESSURE_RANGE = (12.25, 16.0) # Pressure swing (psi) a measured fill/empty time corresponds to
+PRESSURE_LIMITS = (9.0, 17.0)       # The channel pressure never leaves this range (psi)
+CLIENT_POLL_SEC = 0.01              # How often to check for a client while nobody has the port open
+
+# inotify events used to see clients open and close the port
+IN_CLOSE_WRITE = 0x08
+IN_CLOSE_NOWRITE = 0x10
+IN_OPEN = 0x20
+INOTIFY_EVENT = struct.Struct('iIII')   # wd, mask, cookie, len (name follows, unused here)
+
+# Fill time measurements, taken with a 5 ms solenoid cycle (the cycle time the firmware uses)
+FILL_TIMES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Data_Storage', 'PWM_Valve_Test')
+INFLATE_TIMES_FILE = os.path.join(FILL_TIMES_DIR, '5 ms Cycle Time Inflate.csv')
+DEFLATE_TIMES_FILE = os.path.join(FILL_TIMES_DIR, '5 ms Cycle Time Deflate.csv')
+
+# Channel states
+INFLATE = 0
+HOLD = 1
+DEFLATE = 2
+
+def loadFillTimes(path, column):
+    """ read fill times from one of the files in Data_Storage/PWM_Valve_Test
+
+    Parameters
+    ----------
+    path : string
+        csv file with lines like 'Start of Trial, 65, Inflate(ms), 5625, Deflate(ms), 2854'
+    column : string
+        'Inflate' or 'Deflate', which of the two times to keep
+
+    Returns
+    -------
+    dict
+        duty cycle (%) -> fill time (ms)
+
+    """
+    index = 3 if column == 'Inflate' else 5
+    times = {}
+    with open(path) as f:
+        for line in f:
+            fields = [field.strip() for field in line.split(',')]
+            if len(fields) >= 6:
+                times[float(fields[1])] = float(fields[index])
+    return times
+
+# Inflate times keyed by positive solenoid duty cycle, deflate times by negative duty cycle (%)
+INFLATE_TIMES_MS = loadFillTimes(INFLATE_TIMES_FILE, 'Inflate')
+DEFLATE_TIMES_MS = loadFillTimes(DEFLATE_TIMES_FILE, 'Deflate')
+
+def openClientWatch(path):
+    """ watch path for opens and closes with inotify
+
+    Returns the inotify file descriptor, or None where inotify is not
+    available. Without it the simulator falls back to noticing closes on
+    the next read, which misses a client that closes and immediately
+    reopens the port
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, path.encode(), IN_OPEN | IN_CLOSE_WRITE | IN_CLOSE_NOWRITE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def readClientEvents(fd):
+    """ returns the masks of every inotify event waiting on fd, oldest first """
+    try:
+        data = os.read(fd, 4096)
+    except BlockingIOError:
+        return []
+    masks = []
+    offset = 0
+    while offset < len(data):
+        _, mask, _, nameLength = INOTIFY_EVENT.unpack_from(data, offset)
+        masks.append(mask)
+        offset += INOTIFY_EVENT.size + nameLength
+    return masks
+
+def fillRate(times, dutyCycle, pressureRange=FILL_PRESSURE_RANGE):
+    """ pressure change per second at a duty cycle, interpolated from measured fill times """
+    duties = sorted(times)
+    fillTimeSec = np.interp(dutyCycle, duties, [times[d] for d in duties]) / 1000.0
+    return (pressureRange[1] - pressureRange[0]) / fillTimeSec
+
+class simulatedChannel:
+    __slots__ = ('active', 'state', 'currentPressure', 'desiredPressure')
+
+    def __init__(self):
+        self.active = False
+        self.state = HOLD
+        self.currentPressure = DEFAULT_PRESSURE
+        self.desiredPressure = DEFAULT_PRESSURE
+
+class arduinoSimulator:
+    '''
+    Simulated control board behind a pseudo-terminal. Use as
+
+        with arduinoSimulator(latency=0.002) as sim:
+            board = arduino_communcation.arduino(port=sim.port)
+    '''
+    def __init__(self, latency=0.0, jitter=0.0, setupTime=0.5, loopPeriod=0.01, sensorNoise=0.0, seed=0,
+                 inflateTimes=INFLATE_TIMES_MS, deflateTimes=DEFLATE_TIMES_MS,
+                 inflateDuty=POSITIVE_SOLENOID_DUTY_CYCLE, deflateDuty=NEGATIVE_SOLENOID_DUTY_CYCLE):
+        self.latency = latency          # fixed delay before every reply (seconds)
+        self.jitter = jitter            # extra uniformly distributed delay (seconds)
+        self.setupTime = setupTime      # time from opening the port to the setup complete message (seconds)
+        self.loopPeriod = loopPeriod    # duration of one pass of the firmware loop (seconds)
+        self.sensorNoise = sensorNoise  # standard deviation of the pressure readings (psi)
+        self.random = random.Random(seed)
+        self.inflateRate = fillRate(inflateTimes, inflateDuty)
+        self.deflateRate = fillRate(deflateTimes, deflateDuty)
+
+        self.master = None
+        self.port = None
+        self.watch = None
+        self.clients = 0                # number of times the port is currently open
+        self.thread = None
+        self.running = threading.Event()
+        self.connected = False
+        self.pendingInput = b''
+        self.outgoing = deque()        # (release time, bytes) waiting to be written
+        self.lastRelease = 0.0
+        self.resetBoard()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        '''
+        Open the pseudo-terminal and start simulating. Returns the port
+        name to hand to arduino(port=...)
+        '''
+        self.master, slave = os.openpty()
+        self.port = os.ttyname(slave)
+        tty.setraw(slave)
+        # Close our end of the slave so we can tell when a client opens it
+        os.close(slave)
+        os.set_blocking(self.master, False)
+        self.watch = openClientWatch(self.port)
+
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name='arduinoSimulator', daemon=True)
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.master is not None:
+            os.close(self.master)
+            self.master = None
+        if self.watch is not None:
+            os.close(self.watch)
+            self.watch = None
+
+    def resetBoard(self):
+        '''
+        Same state as the firmware right after a reset
+        '''
+        self.channels = [simulatedChannel() for _ in range(NUM_CHANNELS)]
+        self.rxBuffer = bytearray()
+        self.booted = False
+        self.bootTime = time.perf_counter() + self.setupTime
+        self.streamPeriod = 0.0
+        self.streamMask = 0
+        self.streamSeq = 0
+        self.lastStream = 0.0
+        self.outgoing.clear()
+
+    def run(self):
+        nextTick = time.perf_counter()
+        while self.running.is_set():
+            if not self.connected:
+                if self.watch is not None:
+                    readable, _, _ = select.select([self.watch], [], [], CLIENT_POLL_SEC)
+                    if readable:
+                        self.handleClientEvents()
+                elif self.pollClient():
+                    self.connect()
+                else:
+                    time.sleep(CLIENT_POLL_SEC)
+                if self.connected:
+                    nextTick = time.perf_counter()
+                continue
+
+            now = time.perf_counter()
+            wakeUp = nextTick
+            if self.outgoing:
+                wakeUp = min(wakeUp, self.outgoing[0][0])
+            if not self.booted:
+                wakeUp = min(wakeUp, self.bootTime)
+            watched = [self.master] if self.watch is None else [self.master, self.watch]
+            readable, _, _ = select.select(watched, [], [], max(0.0, wakeUp - now))
+            if self.watch in readable:
+                self.handleClientEvents()
+                if not self.connected:
+                    continue
+                if not self.booted:
+                    # Reopened, start the loop over with the new client
+                    nextTick = time.perf_counter()
+            if self.master in readable and not self.receive():
+                continue
+
+            now = time.perf_counter()
+            if not self.booted and now >= self.bootTime:
+                self.booted = True
+                self.send(SETUP_COMPLETE_MSG, delayed=False)
+            if self.booted and now >= nextTick:
+                self.loop(now)
+                nextTick += self.loopPeriod
+                if nextTick < now:
+                    nextTick = now + self.loopPeriod
+            self.flush(now)
+
+    def connect(self):
+        '''
+        A client opened the port, which resets the real board
+        '''
+        self.connected = True
+        self.resetBoard()
+        self.rxBuffer += self.pendingInput
+        self.pendingInput = b''
+
+    def handleClientEvents(self):
+        for mask in readClientEvents(self.watch):
+            if mask & IN_OPEN:
+                self.clients += 1
+                self.connect()
+            elif mask & (IN_CLOSE_WRITE | IN_CLOSE_NOWRITE):
+                self.clients = max(0, self.clients - 1)
+                if self.clients == 0:
+                    self.connected = False
+
+    def pollClient(self):
+        '''
+        Reading the master end fails with EIO while nobody has the slave open
+        and would block once a client has opened it
+        '''
+        try:
+            self.pendingInput = os.read(self.master, 1024)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            if e.errno == errno.EIO:
+                return False
+            raise
+        return True
+
+    def receive(self):
+        '''
+        Read whatever the client sent. Returns False if the client closed the port
+        '''
+        try:
+            data = os.read(self.master, 1024)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            if e.errno == errno.EIO:
+                # Nobody has the port open. With inotify the close event
+                # says so as well, and may be followed by a reopen
+                if self.watch is None:
+                    self.connected = False
+                return False
+            raise
+        self.rxBuffer += data
+        return True
+
+    def send(self, data, delayed=True):
+        '''
+        Queue a reply. Replies leave in order, like on a real serial line
+        '''
+        release = time.perf_counter()
+        if delayed:
+            release += self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+        release = max(release, self.lastRelease)
+        self.lastRelease = release
+        self.outgoing.append((release, bytes(data)))
+
+    def flush(self, now):
+        while self.outgoing and self.outgoing[0][0] <= now:
+            try:
+                os.write(self.master, self.outgoing[0][1])
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno == errno.EIO:
+                    # The client is gone, so are the replies it was waiting for
+                    self.outgoing.clear()
+                    if self.watch is None:
+                        self.connected = False
+                    return
+                raise
+            self.outgoing.popleft()
+
+    def readPressure(self, cNum):
+        pressure = self.channels[cNum].currentPressure
+        if self.sensorNoise:
+            pressure += self.random.gauss(0.0, self.sensorNoise)
+        return pressure
+
+    def loop(self, now):
+        '''
+        One pass of the firmware loop: handle at most one command, update
+        the active channels and push telemetry if it is due
+        '''
+        if self.rxBuffer:
+            if self.rxBuffer[0] == protocol.HOST_SYNC:
+                if len(self.rxBuffer) >= protocol.COMMAND_FRAME.size:
+                    self.handleBinaryCommand()
+            elif len(self.rxBuffer) >= 6:
+                self.handleCommand()
+
+        for channel in self.channels:
+            if channel.active:
+                self.updateChannel(channel)
+
+        if self.streamPeriod > 0 and now - self.lastStream >= self.streamPeriod:
+            self.lastStream = now
+            pressures = [self.readPressure(c) for c in range(NUM_CHANNELS)]
+            self.sendBinaryReply(protocol.FRAME_TELEMETRY, self.streamSeq, self.streamMask, pressures)
+            self.streamSeq = (self.streamSeq + 1) & 0xFF
+
+    def updateChannel(self, channel):
+        '''
+        Same state transitions as the firmware, then move the pressure at
+        the measured inflate/deflate rate for one loop period
+        '''
+        p = channel.currentPressure
+        target = channel.desiredPressure
+        inBand = (target - PRESSURE_TOLERANCE) <= p <= (target + PRESSURE_TOLERANCE)
+        if channel.state == INFLATE:
+            if inBand:
+                channel.state = HOLD
+            elif p >= target + PRESSURE_HOLD_TOLERANCE:
+                channel.state = DEFLATE
+        elif channel.state == HOLD:
+            if p <= target - PRESSURE_HOLD_TOLERANCE:
+                channel.state = INFLATE
+            elif p > target + PRESSURE_HOLD_TOLERANCE:
+                channel.state = DEFLATE
+        else:
+            if inBand:
+                channel.state = HOLD
+            elif p <= target - PRESSURE_HOLD_TOLERANCE:
+                channel.state = INFLATE
+
+        if channel.state == INFLATE:
+            p += self.inflateRate * self.loopPeriod
+        elif channel.state == DEFLATE:
+            p -= self.deflateRate * self.loopPeriod
+        channel.currentPressure = min(max(p, PRESSURE_LIMITS[0]), PRESSURE_LIMITS[1])
+
+    def handleCommand(self):
+        '''
+        ASCII commands, see handleCommand in the firmware
+        '''
+        header = bytes(self.rxBuffer[:2])
+        if header == b'ca':
+            body = bytes(self.rxBuffer[2:6])
+            if body != b'read' and len(self.rxBuffer) < 14:
+                # Firmware blocks in Serial.readBytes for the rest of the frame
+                return
+            if body == b'read':
+                del self.rxBuffer[:6]
+                values = ['{:.2f}'.format(self.readPressure(c)) for c in range(NUM_CHANNELS) if self.channels[c].active]
+                self.send((','.join(values) + '\r\n').encode('utf-8'))
+            else:
+                bodies = bytes(self.rxBuffer[2:14])
+                del self.rxBuffer[:14]
+                for cNum in range(NUM_CHANNELS):
+                    self.channels[cNum].desiredPressure = self.bodyToPressure(bodies[4*cNum:4*cNum + 4])
+                self.send(b'rx\r\n')
+            return
+
+        if header == b'sc':
+            body = bytes(self.rxBuffer[2:6])
+            del self.rxBuffer[:6]
+            if body[3:4] == b'v':
+                self.send('v{}\r\n'.format(protocol.PROTOCOL_VERSION).encode('utf-8'))
+                return
+            for cNum in range(NUM_CHANNELS):
+                if body[cNum:cNum + 1] == b'1':
+                    self.channels[cNum].active = True
+            self.send(b'rx\r\n')
+            return
+
+        if header not in (b'c0', b'c1', b'c2'):
+            # Firmware only consumes the header of an unknown command
+            del self.rxBuffer[:2]
+            self.send(b'CMD ERROR\r\n')
+            return
+
+        cNum = header[1] - ord('0')
+        body = bytes(self.rxBuffer[2:6])
+        del self.rxBuffer[:6]
+        if body == b'read':
+            self.send('{:.2f}\r\n'.format(self.readPressure(cNum)).encode('utf-8'))
+        else:
+            self.channels[cNum].desiredPressure = self.bodyToPressure(body)
+            self.send(b'rx\r\n')
+
+    def bodyToPressure(self, body):
+        # Firmware builds "XX.XX" and uses String.toFloat, which gives 0 for garbage
+        try:
+            return float(body[:2] + b'.' + body[2:4])
+        except ValueError:
+            return 0.0
+
+    def handleBinaryCommand(self):
+        '''
+        Binary commands, see handleBinaryCommand in the firmware
+        '''
+        frame = bytes(self.rxBuffer[:protocol.COMMAND_FRAME.size])
+        del self.rxBuffer[:protocol.COMMAND_FRAME.size]
+        _, frameType, seq, mask, v0, v1, v2, crc = protocol.COMMAND_FRAME.unpack(frame)
+
+        if protocol.crc8(frame, protocol.COMMAND_FRAME.size - 1) != crc:
+            self.sendBinaryReply(protocol.FRAME_NAK, seq, mask)
+            return
+
+        if frameType == protocol.FRAME_SET_PRESSURES:
+            for cNum, value in enumerate((v0, v1, v2)):
+                if mask & (1 << cNum):
+                    self.channels[cNum].desiredPressure = value / 100.0
+            self.sendBinaryReply(protocol.FRAME_ACK, seq, mask)
+        elif frameType == protocol.FRAME_READ_PRESSURES:
+            pressures = [self.readPressure(c) for c in range(NUM_CHANNELS)]
+            self.sendBinaryReply(protocol.FRAME_PRESSURES, seq, mask, pressures)
+        elif frameType == protocol.FRAME_SELECT_CHANNELS:
+            for cNum in range(NUM_CHANNELS):
+                if mask & (1 << cNum):
+                    self.channels[cNum].active = True
+            self.sendBinaryReply(protocol.FRAME_ACK, seq, mask)
+        elif frameType == protocol.FRAME_STREAM:
+            self.sendBinaryReply(protocol.FRAME_ACK, seq, mask)
+            self.streamPeriod = v0 / 1000.0
+            self.streamMask = mask
+            self.lastStream = time.perf_counter()
+        else:
+            self.sendBinaryReply(protocol.FRAME_NAK, seq, mask)
+
+    def sendBinaryReply(self, frameType, seq, mask, pressures=(0.0, 0.0, 0.0)):
+        millis = int(time.perf_counter() * 1000) & 0xFFFFFFFF
+        frame = bytearray(protocol.REPLY_FRAME.pack(
+            protocol.ARDUINO_SYNC, frameType, seq, mask, millis,
+            protocol.toCentiPsi(pressures[0]), protocol.toCentiPsi(pressures[1]), protocol.toCentiPsi(pressures[2]), 0))
+        frame[-1] = protocol.crc8(frame, protocol.REPLY_FRAME.size - 1)
+        self.send(frame)
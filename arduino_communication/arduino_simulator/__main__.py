@@ -0,0 +1,61 @@
+'''
+ * @file    arduino_simulator/__main__.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Run the Arduino simulator from the command line
+
+    python -m arduino_simulator                   prints the port and runs until Ctrl-C
+    python -m arduino_simulator --benchmark 500   times the driver against the simulator
+'''
+import argparse
+import atexit
+import time
+from arduino_simulator import arduinoSimulator
+
+def benchmark(sim, numCommands):
+    """ time every driver mode against the simulator and print the latency counters """
+    import arduino_communcation
+
+    for name, binary, pipelined in (('ascii', False, False), ('binary', True, False), ('pipelined', True, True)):
+        board = arduino_communcation.arduino(binary=binary, port=sim.port)
+        board.selectChannels(board.ON, board.ON, board.ON)
+        if pipelined:
+            board.enablePipelining()
+        start = time.perf_counter()
+        for i in range(numCommands):
+            p = 12.25 + (i % 100) / 100.0
+            board.sendDesiredPressures(p, p, p)
+            if not pipelined:
+                board.getActualPressures()
+        if pipelined:
+            board.flush()
+        elapsed = time.perf_counter() - start
+        print('{:10s} {:8.1f} commands/s'.format(name, numCommands / elapsed))
+        for counter, value in board.latency.items():
+            print('    {:24s} {}'.format(counter, value))
+        board.close()
+        atexit.unregister(board.close)
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated pressure control board on a pseudo-terminal')
+    parser.add_argument('--latency', type=float, default=0.0, help='reply delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random reply delay in seconds')
+    parser.add_argument('--setup-time', type=float, default=0.5, help='time from opening the port to the setup message')
+    parser.add_argument('--noise', type=float, default=0.0, help='standard deviation of the pressure readings (psi)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--benchmark', type=int, metavar='N', help='send N commands in every driver mode and exit')
+    args = parser.parse_args()
+
+    with arduinoSimulator(latency=args.latency, jitter=args.jitter, setupTime=args.setup_time,
+                          sensorNoise=args.noise, seed=args.seed) as sim:
+        if args.benchmark:
+            benchmark(sim, args.benchmark)
+            return
+        print('Simulated Arduino on', sim.port)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == '__main__':
+    main()
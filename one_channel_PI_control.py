@@ -6,17 +6,13 @@
 '''
 import NDI_communication
 import arduino_communcation
-import threading
-from queue import Queue
-import ctypes
+import robot_control
 import time
 from tkinter import *
 from tkinter import ttk
 from ttkthemes import ThemedStyle
 import logging
 from csv_logger import CsvLogger
-from math import sin, pi
-from scipy import signal as sg
 
 # Data Collection
 logging.basicConfig(filename = 'data.log', level = logging.WARNING,
@@ -35,29 +31,21 @@ except:
 # Parameters for controller
 z_des = 40.0        # stores the desired z position input by user
 z_act = 0.0         # actual z_position from EM sensor
-k_p = .012          # proportional controller gain
 P_act = 0.0         # actual pressure read from the pressure sensor
-P_des = 12.0        # desired pressure we're sending to the Arduino
-dT = 0.125          # time between cycles (seconds)
-int_sum = 0.0       # sum of the integral term
-epsi_z_prev = 0.0   # error in z for the previous time step
-k_i = 0.012         # integral gain
-start_time = 0      # start time for the ramp and sinusoid signals
+dT = 0.125          # time between cycles (seconds), measured by the scheduler every tick
+CONTROL_RATE_HZ = 8 # rate the controller thread runs at, the gains were tuned at 0.125 s per cycle
+start_time = 0      # start time of the reference trajectory, 0 while it isn't running
+# z reference followed while logging, e.g. robot_control.trajectory.sinusoid(amplitude=5, offset=60, frequency=.1)
+reference = robot_control.trajectory.triangle(low=50, high=80, period=30)
 time_diff = 0       # time difference betweeen the start and current times
 
-# Queue for inter-thread communication (between GUI thread and controller thread)
-commandsFromGUI = Queue()
+# PI controller of channel 0: P_des = P_act + k_p*epsi_z + k_i*int_sum with
+# int_sum capped to +-3 to prevent windup and P_des kept within 9.0 to 13.25
+pid = robot_control.PIDController(1, kp=.012, ki=.012, integralLimit=3.0, lower=9.0, upper=13.25, initialOutput=12.0)
 
-# Class used for all commands
-class command:
-    '''
-    Basic command format to be used in the queue. We pass along
-    id's and any other important info in field1 and field2
-    '''
-    def __init__(self, id, field1, field2):
-        self.id = id
-        self.field1 = field1
-        self.field2 = field2
+# Typed commands from the GUI thread to the controller thread. The
+# controller applies everything that arrived since its last tick at once
+commandsFromGUI = robot_control.commandBus()
 
 class GUI:
     '''
@@ -144,45 +132,40 @@ class GUI:
 
 
     def left_key(self, *args):
-        newCmd = command("EM_Sensor", "adjustPosition", .5)
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.adjustPosition(0, .5))
 
     def right_key(self, *args):
-        newCmd = command("EM_Sensor", "adjustPosition", -.5)
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.adjustPosition(0, -.5))
 
     def GUI_handleSetPositionCommand(self, *args):
         '''
         Handle setting the position from the GUI
         '''
-        newCmd = command("EM_Sensor", "setPosition", float(self.position_entry.get()))
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setPosition(0, float(self.position_entry.get())))
 
     def GUI_handleSetKpCommand(self, *args):
         '''
         Handle setting the gain from the GUI
         '''
-        newCmd = command("EM_Sensor", "setKp", float(self.kp_entry.get()))
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setGain('kp', float(self.kp_entry.get())))
 
     def GUI_handleSetKiCommand(self, *args):
         '''
         Handle setting the gain from the GUI
         '''
-        newCmd = command("EM_Sensor", "setKi", float(self.ki_entry.get()))
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setGain('ki', float(self.ki_entry.get())))
 
     def GUI_handleDataDisplay(self, *args):
         '''
         Display control algorithm parameters to the GUI
         '''
-        global z_des, z_act, P_des, P_act
+        global z_des, z_act, P_act
 
         self.z_des_label.configure(text = "Z desired: " + str(round(z_des,3)))
         self.z_act_label.configure(text = "Z actual: " + str(round(z_act,3)))
-        self.p_des_label.configure(text = "P desired: " + str(round(P_des,3)))
+        self.p_des_label.configure(text = "P desired: " + str(round(pid.output[0],3)))
         self.p_act_label.configure(text = "P actual: " + str(round(P_act,3)))
-        self.int_sum_label.configure(text = "int_sum: " + str(round(int_sum,3)))
+        self.int_sum_label.configure(text = "int_sum: " + str(round(pid.integral[0],3)))
 
     def GUI_handleLoggingCommand(self, status):
         '''
@@ -192,7 +175,7 @@ class GUI:
 
         if (status == "start"):
             logging.getLogger().setLevel(logging.INFO)
-            start_time = time.time()                    # start time for ramp and sinusoid signals
+            start_time = time.time()                    # start time for the reference trajectory
         elif (status == "stop"):
             logging.getLogger().setLevel(logging.WARNING)
             start_time = 0
@@ -201,63 +184,38 @@ class GUI:
             with open('data.log', 'w'):
                 pass
 
-class controllerThread(threading.Thread):
+class controllerThread(robot_control.controllerThread):
     '''
     Implements proportional controller
     '''
     def __init__(self, name):
-        threading.Thread.__init__(self)
-        self.name = name
+        robot_control.controllerThread.__init__(self, name)
 
     def run(self):
         '''
         Infinite loop for controller until turned off.
         Continues to look for new commands from the GUI.
         '''
+        global dT
+        self.board = arduino
+        scheduler = robot_control.fixedRateScheduler(CONTROL_RATE_HZ)
         try:
-            while True:
-                # Look for new commands
-                if (commandsFromGUI.empty() == False):
-                    newCmd = commandsFromGUI.get()
-                    self.handleGUICommand(newCmd)
+            while self.running():
+                # Integral term uses the measured time since the last tick,
+                # wakes up right away when the controller is stopped
+                dT = scheduler.wait(self.stopEvent)
+                if not self.running():
+                    break
+
+                # Apply every command sent since the last tick, a burst of
+                # arrow keys adds up to one move of z_des
+                commandsFromGUI.dispatch(self.handleGUICommand)
 
                 self.one_D_main()
-                time.sleep(.07)
 
         finally:
-            print('Controller thread teminated')
-
-    def sinusoid_signal(self):
-        '''
-        Sinusoidal input function with regard to position for the 1D channel
-        '''
-        global start_time, z_des, time_diff
-
-        current_time = time.time()
-
-        time_diff = current_time - start_time
-
-        A = 5       # amplitude of the sine signal [mm]
-        C = 60      # offset of the sine function [mm]
-        f = .1     # frequency of the signal [Hz]
-
-        z_des = A*sin(2*pi*f*time_diff) + C      # resulting sinusoidal z_des [mm]
-
-    def ramp_signal(self):
-        '''
-        Ramp input function with regard to position for the 1D channel
-        '''
-        global start_time, z_des, time_diff
-
-        current_time = time.time()              # current time measured compared to start time
-
-        time_diff = current_time - start_time   # time difference used for the signal
-
-        A = (80 - 50)/2                         # amplitude of the ramp signal
-        C = (80 - 50)/2 + 50                    # shifts the signal up to range of 50 mm to 90 mm
-        T = 30                                # period of the signal in seconds
-
-        z_des = A*sg.sawtooth((2*pi/T)*time_diff, width = 0.5) + C       # ramp signal set as a triangle wave
+            print('Controller thread teminated', scheduler)
+            print('GUI commands', commandsFromGUI)
 
     def one_D_main(self):
         '''
@@ -268,43 +226,41 @@ class controllerThread(threading.Thread):
         # get the actual pressure from the pressure sensor
         P_act = arduino.getActualPressure(arduino.channel0)
 
-        # get actual position from EM sensor
-        position = ndi.getPositionInRange()
-        z_act = position.deltaX
+        # get actual position from EM sensor, always from a frame not used before
+        position = ndi.waitForNextFrame()
+        if position:
+            z_act = position.deltaX
 
-        # perform 1D proportional control
-        self.one_D_algorithm()
+            # perform 1D proportional control
+            self.one_D_algorithm()
+        else:
+            # EM coil out of the field volume, keep sending the last
+            # desired pressure so the pressure loop stays alive
+            logging.warning("No EM position this tick: %s", position)
 
         # send the desired pressure into Arduino
         self.sendDesiredPressure()
 
         # Log all control variables if needed
-        logging.info('%.3f,%.3f,%.3f,%.3f,%.3f,%.3f,%.3f' % (time_diff, z_des, z_act, P_des, P_act, k_p, k_i))
+        logging.info('%.3f,%.3f,%.3f,%.3f,%.3f,%.3f,%.3f' % (time_diff, z_des, z_act, pid.output[0], P_act, pid.kp[0], pid.ki[0]))
         if logging.getLogger().getEffectiveLevel() == logging.INFO:
-            csv_logger.info('%.3f,%.3f,%.3f,%.3f,%.3f,%.3f,%.3f' % (time_diff, z_des, z_act, P_des, P_act, k_p, k_i))
+            csv_logger.info('%.3f,%.3f,%.3f,%.3f,%.3f,%.3f,%.3f' % (time_diff, z_des, z_act, pid.output[0], P_act, pid.kp[0], pid.ki[0]))
 
     def one_D_algorithm(self):
         '''
         Proportional feedback loop algorithm (includes our method and Shalom's del P)
         '''
-        global z_des, z_act, P_des, P_act, k_p, dT, int_sum, epsi_z_prev, k_i, start_time
+        global z_des, z_act, P_act, dT, start_time, time_diff
 
-        # If user has started logging, start the ramp signal. You could
-        # also run the sinusoid here if you would like.
+        # If user has started logging, follow the reference trajectory
+        # (a ramp unless reference was changed at the top of the file)
         if start_time > 0:
-            self.ramp_signal()
-            # self.sinusoid_signal()
+            time_diff = time.time() - start_time
+            z_des = float(reference.sample(time_diff)[0])
 
         # Calculate the error between current and desired positions
         epsi_z = z_des - z_act
 
-        # Calculate the integral sum and cap it to prevent windup
-        int_sum = int_sum + 0.5*(epsi_z + epsi_z_prev)*dT
-        if int_sum > 3:
-            int_sum = 3
-        elif int_sum < -3:
-            int_sum = -3
-
         # We have several ideas implemented here. We found our delta pressure
         # controller to be the best performing of all of them. We think this is due
         # to the slow response time of our controller
@@ -314,8 +270,9 @@ class controllerThread(threading.Thread):
         # P_des = k_p*epsi_z + k_i*int_sum
 
         # < ------- Our feedback method --------- >
-        del_P_des = k_p * epsi_z + k_i*(int_sum)
-        P_des = P_act + del_P_des
+        # P_des = P_act + k_p*epsi_z + k_i*int_sum, the controller integrates
+        # epsi_z and caps the integral sum to prevent windup
+        pid.update(epsi_z, P_act, dT)
 
         # < -------- Shalom delta P method ------- >
         # Figure out how to utilize del_P_act instead of P_des (on Arduino side?)
@@ -323,24 +280,14 @@ class controllerThread(threading.Thread):
         # P_des = P_o + del_P_des
         # del_P_act = P_des - P_act
 
-        # Update the error value for next iteration of epsi_z_prev
-        epsi_z_prev = epsi_z
-
     def sendDesiredPressure(self):
         '''
         convert P_des and send this pressure into the Arduino
         '''
-        global P_des
         # Safety check so we don't the arduino a super high or low pressure!
-        # it will blow up if you have the wrong bounds
-        if P_des < 9.0:
-            # lower limit of the pressure we are sending into the controller
-            P_des = 9.0
-        elif P_des > 13.25:
-            # higher limit of the pressure we are sending into the controller
-            P_des = 13.25
-
-        arduino.sendDesiredPressure(arduino.channel0, P_des)
+        # it will blow up if you have the wrong bounds. The controller keeps
+        # P_des between 9.0 and 13.25
+        arduino.sendDesiredPressure(arduino.channel0, float(pid.output[0]))
 
 
     def handleGUICommand(self, newCmd):
@@ -348,43 +295,18 @@ class controllerThread(threading.Thread):
         Function to handle commands from the GUI.
         Takes place on controller thread
         '''
-        global z_des, k_p, k_i
-
-        if (newCmd.id == "EM_Sensor"):
-            if (newCmd.field1 == "adjustPosition"):
-                z_des += newCmd.field2
-            elif (newCmd.field1 == "setPosition"):
-                z_des = newCmd.field2
-                logging.debug("\nCommand recieved to set position to ", z_des)
-            elif (newCmd.field1 == "setKp"):
-                k_p = newCmd.field2
-                logging.debug("\nCommand recieved to set proportional gain to", k_p)
-            elif (newCmd.field1 == "setKi"):
-                k_i = newCmd.field2
-                logging.debug("\nCommand recieved to set integral gain to", k_i)
-
-
-    def get_id(self):
-        '''
-        returns id of the respective thread
-        '''
-        if hasattr(self, '_thread_id'):
-            return self._thread_id
-        for id, thread in threading._active.items():
-            if thread is self:
-                return id
+        global z_des
+
+        if isinstance(newCmd, robot_control.adjustPosition):
+            z_des += newCmd.delta
+        elif isinstance(newCmd, robot_control.setPosition):
+            z_des = newCmd.position
+            logging.debug("Command recieved to set position to %s", z_des)
+        elif isinstance(newCmd, robot_control.setGain):
+            pid.setGains(**{newCmd.term: newCmd.value})
+            logging.debug("Command recieved to set %s to %s", newCmd.term, newCmd.value)
 
 
-    def raise_exception(self):
-        '''
-        raise exception for controller thread
-        '''
-        thread_id = self.get_id()
-        res = ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id,
-              ctypes.py_object(SystemExit))
-        if res > 1:
-            ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, 0)
-            print('Exception raise failure')
 
 
 def main():
@@ -403,9 +325,9 @@ def main():
     GUI(root)
     root.mainloop()
 
-    # Kill controller once GUI is exited
-    cThread.raise_exception()
-    cThread.join()
+    # Stop the controller once GUI is exited, it finishes its tick and the
+    # Arduino is vented to the default pressure
+    cThread.stop()
 
 if __name__ == "__main__":
     main()
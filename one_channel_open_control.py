@@ -7,10 +7,7 @@
 '''
 import NDI_communication
 import arduino_communcation
-import threading
-from queue import Queue
-import ctypes
-import time
+import robot_control
 import serial as pys
 from tkinter import *
 from tkinter import ttk
@@ -21,18 +18,8 @@ try:
     arduino = arduino_communcation.arduino()
 except:
   print("Arduino or NDI sensor not connected")
-# Queue for inter-thread communication
-commandsFromGUI = Queue()
-
-class command:
-    '''
-    Basic command format to be used in the queue. We pass along
-    id's and any other important info in field1 and field2
-    '''
-    def __init__(self, id, field1, field2):
-        self.id = id
-        self.field1 = field1
-        self.field2 = field2
+# Typed commands from the GUI thread to the controller thread
+commandsFromGUI = robot_control.commandBus()
 
 
 # <===================== Building GUI =====================>
@@ -46,8 +33,7 @@ def GUI_handleArduinoCommand():
     Handling Arduino related commands from GUI
     '''
     global arduino_entry
-    newCmd = command("Arduino", float(arduino_entry.get()), 0)
-    commandsFromGUI.put(newCmd)
+    commandsFromGUI.put(robot_control.setPressure(0, float(arduino_entry.get())))
 
 labelText=StringVar()
 labelText.set("Enter desired pressure [psi]:")
@@ -61,51 +47,47 @@ arduino_entry.pack()
 ttk.Button(root, text= "Send",width= 10, command=GUI_handleArduinoCommand).pack(pady=20)
 
 def GUI_handlePressureRead():
-    newCmd = command("Arduino", "read", 0)
-    commandsFromGUI.put(newCmd)
+    commandsFromGUI.put(robot_control.readPressure())
 
 ttk.Button(root, text= "Read Pressure from Arduino",width= 30, command=GUI_handlePressureRead).pack(pady=20)
 
 # Handling EM Sensor = realted commands from GUI
 def GUI_handleEMcommand():
-    newCmd = command("EM_Sensor", 0, 0)
-    commandsFromGUI.put(newCmd)
+    commandsFromGUI.put(robot_control.readPosition())
 
 ttk.Button(root, text= "Read Position from EM Sensor",width= 30, command=GUI_handleEMcommand).pack(pady=20)
 # <==========================================================>
 
-class controllerThread(threading.Thread):
+class controllerThread(robot_control.controllerThread):
     '''
     Implements open controller for 1D control
     '''
     def __init__(self, name):
-        threading.Thread.__init__(self)
-        self.name = name
+        robot_control.controllerThread.__init__(self, name)
 
     def handleGUICommand(self, newCmd):
         '''
         Function to handle commands from the GUI.
         Takes place on controller thread
         '''
-        if (newCmd.id == "Arduino"):
-            global ser
-            if (newCmd.field1 == "read"):
-                P_act = arduino.getActualPressure()
-                print("Current Pressure: ", P_act)
-            else:
-                P_des = newCmd.field1
-
-                if P_des < 9.0:
-                    # lower limit of the pressure we are sending into the controller
-                    P_des = 9.0
-                elif P_des > 13.25:
-                    # higher limit of the pressure we are sending into the controller
-                    P_des = 13.25
-
-                print("Setting pressure to : ", P_des)
-                arduino.sendDesiredPressure(P_des)
-
-        elif (newCmd.id == "EM_Sensor"):
+        if isinstance(newCmd, robot_control.readPressure):
+            P_act = arduino.getActualPressure()
+            print("Current Pressure: ", P_act)
+
+        elif isinstance(newCmd, robot_control.setPressure):
+            P_des = newCmd.pressure
+
+            if P_des < 9.0:
+                # lower limit of the pressure we are sending into the controller
+                P_des = 9.0
+            elif P_des > 13.25:
+                # higher limit of the pressure we are sending into the controller
+                P_des = 13.25
+
+            print("Setting pressure to : ", P_des)
+            arduino.sendDesiredPressure(P_des)
+
+        elif isinstance(newCmd, robot_control.readPosition):
             print("controller wants to read position")
             global ndi
             while True:
@@ -118,33 +100,18 @@ class controllerThread(threading.Thread):
         '''
         target function of the thread class
         '''
+        self.board = arduino
         try:
-            while True:
-                if (commandsFromGUI.empty() == False):
-                    newCmd = commandsFromGUI.get()
-                    self.handleGUICommand(newCmd)
-                    time.sleep(.07)
+            while self.running():
+                # Apply every command sent since the last tick, the last pressure wins
+                commandsFromGUI.dispatch(self.handleGUICommand)
+                self.stopEvent.wait(.07)
 
         finally:
-            # global ser
+            # The Arduino stays open until stop() has vented it
             print('Controller thread teminated')
-            ser.close()
-
-    def get_id(self):
-        # returns id of the respective thread
-        if hasattr(self, '_thread_id'):
-            return self._thread_id
-        for id, thread in threading._active.items():
-            if thread is self:
-                return id
-
-    def raise_exception(self):
-        thread_id = self.get_id()
-        res = ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id,
-              ctypes.py_object(SystemExit))
-        if res > 1:
-            ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, 0)
-            print('Exception raise failure')
+            print('GUI commands', commandsFromGUI)
+
 
 def main():
     '''
@@ -158,9 +125,9 @@ def main():
     # Designate main thread for GUI
     root.mainloop()
 
-    # Kill controller once GUI is excited
-    t1.raise_exception()
-    t1.join()
+    # Stop the controller once GUI is exited, it finishes handling its
+    # command and the Arduino is vented to the default pressure
+    t1.stop()
 
 if __name__ == "__main__":
     main()
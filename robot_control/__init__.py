@@ -0,0 +1,22 @@
+'''
+ * @file    robot_control/__init__.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Pieces shared by Main.py and the control scripts
+'''
+from . import cascade
+from . import commands
+from . import devices
+from . import filtering
+from . import geometry
+from . import lifecycle
+from . import pid
+from . import scheduler
+from . import trajectory
+from .cascade import loopStats, pressureLoop
+from .commands import commandBus, setPressure, setPosition, adjustPosition, setGain, readPressure, readPosition
+from .devices import deviceManager
+from .filtering import positionFilter
+from .geometry import ChannelGeometry
+from .lifecycle import controllerThread, controllerSupervisor
+from .pid import PIDController
+from .scheduler import fixedRateScheduler
@@ -0,0 +1,225 @@
+'''
+ * @file    cascade.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Fast pressure loop under the EM position loop
+
+    The firmware regulates every channel to its desired pressure within
+    PRESSURE_TOLERANCE on every pass of its loop, so the fastest pressure
+    regulator is already on the Arduino. What held it back was the host:
+    one loop read the pressures, read the EM position, computed and wrote,
+    so new setpoints only went out as fast as the tracker was polled.
+
+    pressureLoop owns the Arduino on its own thread at its own rate. Every
+    tick it takes the newest pressures (from the telemetry stream when the
+    board streams, otherwise with one read) and moves the setpoints sent
+    to the firmware towards the ones the position loop published last,
+    at most maxSlew psi per second. The position loop runs once per EM frame,
+    reads the pressures from the pressure loop without touching the serial
+    line and publishes its new setpoints with setSetpoints().
+
+    Both loops keep a loopStats with the rate they actually achieved and
+    how long their ticks took.
+'''
+import threading
+import time
+import logging
+import numpy as np
+
+from .scheduler import fixedRateScheduler
+
+PRESSURE_RATE_HZ = 50           # rate setpoints are streamed to the Arduino and its pressures are read
+MAX_SLEW_PSI_PER_SEC = 20.0     # fastest change of a setpoint sent to the Arduino, steps of the position loop are spread over several ticks
+LATE_FACTOR = 1.5               # a tick that came more than this many periods after the previous one is counted as late
+STOP_TIMEOUT_SEC = 1.0          # longest stop() waits for the pressure loop thread to finish
+
+class loopStats:
+    '''
+    Achieved rate and tick timing of one loop, e.g.
+
+        stats = loopStats('position', 40)
+        while True:
+            dt = stats.tick()
+            ...
+            stats.done()
+    '''
+    def __init__(self, name, rateHz):
+        self.name = name
+        self.rateHz = rateHz
+        self.period = 1.0 / rateHz
+        self.reset()
+
+    def reset(self):
+        self.firstTick = None   # time.perf_counter() of the first tick
+        self.lastTick = None    # time.perf_counter() of the latest tick
+        self.ticks = 0
+        self.late = 0           # ticks more than LATE_FACTOR periods after the previous one
+        self.maxPeriod = 0.0    # longest time between two ticks (seconds)
+        self.busy = 0.0         # total time from tick() to done() (seconds)
+        self.maxBusy = 0.0      # longest time from tick() to done() (seconds)
+
+    def tick(self):
+        '''
+        Mark the start of a tick. Returns the time since the previous tick
+        started (one period for the first tick)
+        '''
+        now = time.perf_counter()
+        dt = self.period
+        if self.lastTick is None:
+            self.firstTick = now
+        else:
+            dt = now - self.lastTick
+            self.maxPeriod = max(self.maxPeriod, dt)
+            if dt > LATE_FACTOR*self.period:
+                self.late += 1
+        self.lastTick = now
+        self.ticks += 1
+        return dt
+
+    def done(self):
+        '''
+        Mark the end of the work of the current tick
+        '''
+        busy = time.perf_counter() - self.lastTick
+        self.busy += busy
+        self.maxBusy = max(self.maxBusy, busy)
+
+    def achievedRate(self):
+        if self.ticks < 2:
+            return 0.0
+        return (self.ticks - 1) / (self.lastTick - self.firstTick)
+
+    def __repr__(self):
+        meanBusy = self.busy / self.ticks if self.ticks else 0.0
+        return 'loopStats({}: rate={:.1f}/{} Hz, ticks={}, late={}, maxPeriod={:.4f}, meanBusy={:.6f}, maxBusy={:.6f})'.format(
+            self.name, self.achievedRate(), self.rateHz, self.ticks, self.late, self.maxPeriod, meanBusy, self.maxBusy)
+
+class pressureLoop(threading.Thread):
+    '''
+    Inner loop of the cascade, streams setpoints to the Arduino at rateHz, e.g.
+
+        pressures = pressureLoop(arduino, initial=P_des, lower=9.0, upper=max_pressure)
+        pressures.start()
+        ...
+        pressures.pressures(out=P_act)      # newest measured pressures
+        pressures.setSetpoints(P_des)       # from the position loop
+        ...
+        pressures.stop()
+
+    Only this thread talks to the Arduino while it runs. maxSlew=None sends
+    every published setpoint in one step
+    '''
+    def __init__(self, board, initial, rateHz=PRESSURE_RATE_HZ, lower=-np.inf, upper=np.inf,
+                 maxSlew=MAX_SLEW_PSI_PER_SEC):
+        threading.Thread.__init__(self, name='pressureLoop', daemon=True)
+        self.board = board
+        self.rateHz = rateHz
+        self.maxSlew = maxSlew
+        self.lower = np.array(lower, dtype=float)
+        self.upper = np.array(upper, dtype=float)
+
+        self.target = np.array(initial, dtype=float)        # setpoints published by the position loop
+        self.commanded = self.target.copy()                 # setpoints last sent to the Arduino
+        self.actual = np.zeros_like(self.target)            # newest measured pressures
+        self.step = np.zeros_like(self.target)
+        self.scratch = np.zeros_like(self.target)
+        self.lock = threading.Lock()                        # guards target, actual and published
+        self.stopEvent = threading.Event()
+        self.ready = threading.Event()                      # set once the first pressures were read
+        self.error = None                                   # exception that ended the loop, if any
+        self.synced = False                                 # whether the Arduino was sent setpoints yet
+
+        # Statistics
+        self.stats = loopStats('pressure', rateHz)
+        self.sends = 0                  # setpoint frames written to the Arduino
+        self.published = 0              # setSetpoints calls of the position loop
+        self.publishTime = None         # time.perf_counter() of the latest setSetpoints
+        self.maxSetpointAge = 0.0       # longest a published setpoint waited to be sent (seconds)
+        self.maxTrackingError = 0.0     # largest |commanded - actual| of any channel at the start of a tick (psi)
+
+    def setSetpoints(self, pressures):
+        '''
+        Publish new desired pressures, the loop sends them on its next ticks
+        '''
+        with self.lock:
+            np.clip(pressures, self.lower, self.upper, out=self.target)
+            self.published += 1
+            self.publishTime = time.perf_counter()
+
+    def pressures(self, out=None, timeout=None):
+        '''
+        Newest measured pressures, copied into out if given. Waits up to
+        timeout for the first read after start(), raises IOError if there
+        is none by then or the loop has stopped on an error
+        '''
+        if not self.ready.wait(timeout):
+            raise IOError("Pressure loop has not read any pressures within {} seconds".format(timeout))
+        if self.error is not None:
+            raise IOError("Pressure loop stopped: {}".format(self.error))
+        with self.lock:
+            if out is None:
+                return self.actual.copy()
+            out[:] = self.actual
+            return out
+
+    def stop(self, timeout=STOP_TIMEOUT_SEC):
+        '''
+        Ask the loop to finish its tick and wait for it
+        '''
+        self.stopEvent.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+    def run(self):
+        scheduler = fixedRateScheduler(self.rateHz)
+        try:
+            while not self.stopEvent.is_set():
+                dt = scheduler.wait(self.stopEvent)
+                if self.stopEvent.is_set():
+                    break
+                self.stats.tick()
+                self.tick(dt)
+                self.stats.done()
+        except Exception as e:
+            self.error = e
+            logging.exception("Pressure loop stopped")
+        finally:
+            self.stopEvent.set()
+            # Wake up pressures() even if the first read failed, it raises self.error then
+            self.ready.set()
+            print('Pressure loop terminated', scheduler)
+
+    def tick(self, dt):
+        actual = self.board.getActualPressures()
+        with self.lock:
+            self.actual[:] = actual
+            np.subtract(self.target, self.commanded, out=self.step)
+            publishTime = self.publishTime
+            self.publishTime = None
+        self.ready.set()
+
+        if self.synced:
+            # How far the firmware is from the setpoints it has been regulating to
+            np.subtract(self.commanded, self.actual, out=self.scratch)
+            np.abs(self.scratch, out=self.scratch)
+            self.maxTrackingError = max(self.maxTrackingError, float(self.scratch.max()))
+
+            # Nothing new from the position loop, the firmware keeps
+            # regulating to the setpoints it already has
+            if not self.step.any():
+                return
+            if self.maxSlew is not None:
+                limit = self.maxSlew*dt
+                np.clip(self.step, -limit, limit, out=self.step)
+        # The first setpoints go out in one step, the Arduino may still hold
+        # whatever it was sent before the loop started
+        self.commanded += self.step
+        self.synced = True
+
+        self.board.sendDesiredPressures(float(self.commanded[0]), float(self.commanded[1]), float(self.commanded[2]))
+        self.sends += 1
+        if publishTime is not None:
+            self.maxSetpointAge = max(self.maxSetpointAge, time.perf_counter() - publishTime)
+
+    def __repr__(self):
+        return 'pressureLoop({}, sends={}, published={}, maxSetpointAge={:.4f}, maxTrackingError={:.3f})'.format(
+            self.stats, self.sends, self.published, self.maxSetpointAge, self.maxTrackingError)
@@ -0,0 +1,242 @@
+'''
+ * @file    commands.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Commands from the GUI to the controller thread
+
+    The GUI puts typed messages on a commandBus. Once per tick, before the
+    control step, the controller drains everything that arrived since the
+    previous tick and applies it in one go. Messages that change the same
+    setting (same key) are merged first: the last setpoint or gain of a
+    channel wins, and position adjustments add up. A burst of typing then
+    takes effect on the next tick, and no control cycle runs on a value
+    that was already replaced.
+
+    The bus keeps the queue depth it found and the time from put() until
+    a command was applied.
+'''
+import queue
+import time
+
+class guiCommand:
+    '''
+    Base of the GUI messages. Messages with the same key change the same
+    setting and are merged by merge()
+    '''
+    __slots__ = ('sentTime',)
+
+    def __init__(self):
+        self.sentTime = 0.0     # time.perf_counter() when the GUI put the message on the bus
+
+    @property
+    def key(self):
+        return type(self)
+
+    def merge(self, older):
+        '''
+        Message that has the effect of older followed by this one, keeping
+        the time the first of them was sent. By default the newer one wins
+        '''
+        self.sentTime = older.sentTime
+        return self
+
+class setPressure(guiCommand):
+    '''
+    Desired pressure of one channel for the open controller
+    '''
+    __slots__ = ('channel', 'pressure')
+
+    def __init__(self, channel, pressure):
+        guiCommand.__init__(self)
+        self.channel = channel
+        self.pressure = pressure    # psi
+
+    @property
+    def key(self):
+        return (setPressure, self.channel)
+
+    def __repr__(self):
+        return 'setPressure({}, {})'.format(self.channel, self.pressure)
+
+class setPosition(guiCommand):
+    '''
+    Desired position along one axis, axis is the index into the
+    controller's desired position (r_des is (z, x))
+    '''
+    __slots__ = ('axis', 'position')
+
+    def __init__(self, axis, position):
+        guiCommand.__init__(self)
+        self.axis = axis
+        self.position = position    # mm
+
+    @property
+    def key(self):
+        return (setPosition, self.axis)
+
+    def __repr__(self):
+        return 'setPosition({}, {})'.format(self.axis, self.position)
+
+class adjustPosition(guiCommand):
+    '''
+    Move the desired position along one axis by delta
+    '''
+    __slots__ = ('axis', 'delta')
+
+    def __init__(self, axis, delta):
+        guiCommand.__init__(self)
+        self.axis = axis
+        self.delta = delta          # mm
+
+    @property
+    def key(self):
+        # Same setting as setPosition so the order of the two is kept
+        return (setPosition, self.axis)
+
+    def merge(self, older):
+        if isinstance(older, setPosition):
+            merged = setPosition(self.axis, older.position + self.delta)
+        else:
+            merged = adjustPosition(self.axis, older.delta + self.delta)
+        merged.sentTime = older.sentTime
+        return merged
+
+    def __repr__(self):
+        return 'adjustPosition({}, {})'.format(self.axis, self.delta)
+
+class setGain(guiCommand):
+    '''
+    Controller gain, term is 'kp', 'ki' or 'kd'. channel None sets every channel
+    '''
+    __slots__ = ('term', 'value', 'channel')
+
+    def __init__(self, term, value, channel=None):
+        if term not in ('kp', 'ki', 'kd'):
+            raise ValueError("Unknown gain '{}', expected kp, ki or kd".format(term))
+        guiCommand.__init__(self)
+        self.term = term
+        self.value = value
+        self.channel = channel
+
+    @property
+    def key(self):
+        return (setGain, self.term, self.channel)
+
+    def __repr__(self):
+        return 'setGain({}, {}, channel={})'.format(self.term, self.value, self.channel)
+
+class readPressure(guiCommand):
+    '''
+    Ask the controller to print the measured pressure, a burst prints once
+    '''
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'readPressure()'
+
+class readPosition(guiCommand):
+    '''
+    Ask the controller to print the EM position, a burst prints once
+    '''
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'readPosition()'
+
+class commandBus:
+    '''
+    Messages from the GUI thread to the controller thread, e.g.
+
+        commandsFromGUI = commandBus()
+        commandsFromGUI.put(setGain('kp', 0.03))                # GUI thread
+        commandsFromGUI.dispatch(self.handleGUICommand)         # controller thread, between ticks
+    '''
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.pending = {}       # key -> merged message, in the order the keys were last changed
+        self.batch = []         # messages handed out by the last drain()
+
+        # Statistics
+        self.received = 0       # messages taken off the queue
+        self.applied = 0        # merged messages applied by dispatch()
+        self.coalesced = 0      # messages merged into a later one with the same key
+        self.lastDepth = 0      # messages drained by the last drain()
+        self.maxDepth = 0
+        self.totalLatency = 0.0 # sum of the put() to applied times, from the first of the merged messages (seconds)
+        self.maxLatency = 0.0
+
+    def put(self, message):
+        '''
+        Send a message to the controller, safe to call from any thread
+        '''
+        message.sentTime = time.perf_counter()
+        self.queue.put(message)
+
+    def depth(self):
+        '''
+        Messages waiting to be drained right now
+        '''
+        return self.queue.qsize()
+
+    def drain(self):
+        """ take every waiting message off the queue and merge the ones with the same key
+
+        Returns
+        -------
+        list
+            merged messages in the order their settings were last
+            changed, the bus reuses the list on the next drain()
+
+        """
+        self.pending.clear()
+        depth = 0
+        while True:
+            try:
+                message = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            depth += 1
+            older = self.pending.pop(message.key, None)
+            if older is not None:
+                message = message.merge(older)
+                self.coalesced += 1
+            self.pending[message.key] = message
+
+        self.received += depth
+        self.lastDepth = depth
+        self.maxDepth = max(self.maxDepth, depth)
+        self.batch.clear()
+        self.batch.extend(self.pending.values())
+        return self.batch
+
+    def dispatch(self, handle):
+        """ apply everything the GUI sent since the last tick, call between ticks
+
+        Parameters
+        ----------
+        handle : function
+            called with every merged message, in order
+
+        Returns
+        -------
+        int
+            number of merged messages applied
+
+        """
+        batch = self.drain()
+        if not batch:
+            return 0
+        for message in batch:
+            handle(message)
+
+        now = time.perf_counter()
+        for message in batch:
+            latency = now - message.sentTime
+            self.totalLatency += latency
+            self.maxLatency = max(self.maxLatency, latency)
+        self.applied += len(batch)
+        return len(batch)
+
+    def __repr__(self):
+        meanLatency = self.totalLatency / self.applied if self.applied else 0.0
+        return 'commandBus(received={}, applied={}, coalesced={}, maxDepth={}, meanLatency={:.4f}, maxLatency={:.4f})'.format(
+            self.received, self.applied, self.coalesced, self.maxDepth, meanLatency, self.maxLatency)
@@ -0,0 +1,95 @@
+'''
+ * @file    devices.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Bring up the EM sensor and the Arduino in parallel
+'''
+import threading
+from concurrent import futures
+
+# Device states shown in the GUI
+CONNECTING = "connecting..."
+READY = "ready"
+FAILED = "failed"
+
+class deviceManager:
+    '''
+    Opens every device on its own worker thread so slow setups (the NDI
+    port handle loop, the Arduino setup handshake) overlap and nothing
+    blocks the GUI. Each device gets a future that completes once it is
+    ready, so code that needs a device only waits for that one
+    '''
+    def __init__(self):
+        self.executor = futures.ThreadPoolExecutor(thread_name_prefix='deviceSetup')
+        self.futures = {}       # device name -> future resolving to the device object
+        self.status = {}        # device name -> CONNECTING, READY or FAILED
+        self.errors = {}        # device name -> exception raised while connecting
+        self.lock = threading.Lock()
+
+    def connect(self, name, setup, *args, **kwargs):
+        '''
+        Start setting up a device in the background. setup(*args, **kwargs)
+        must return the ready device. Returns the device's future
+        '''
+        with self.lock:
+            self.status[name] = CONNECTING
+            future = self.executor.submit(setup, *args, **kwargs)
+            self.futures[name] = future
+        future.add_done_callback(lambda f: self.setupDone(name, f))
+        return future
+
+    def setupDone(self, name, future):
+        with self.lock:
+            if future.cancelled():
+                self.status[name] = FAILED
+                return
+            error = future.exception()
+            if error is None:
+                self.status[name] = READY
+            else:
+                self.status[name] = FAILED
+                self.errors[name] = error
+        if error is not None:
+            print("Could not connect to {}: {}".format(name, error))
+
+    def ready(self, name):
+        '''
+        Future that completes with the device once it is set up
+        '''
+        return self.futures[name]
+
+    def isReady(self, name):
+        future = self.futures.get(name)
+        return future is not None and future.done() and not future.cancelled() and future.exception() is None
+
+    def get(self, name, timeout=None):
+        '''
+        Block until the device is set up and return it. Re-raises the error
+        from the setup if it failed
+        '''
+        return self.futures[name].result(timeout)
+
+    def wait(self, *names, timeout=None):
+        '''
+        Block until all of the named devices are set up, which takes as long
+        as the slowest of them, and return them in the same order
+        '''
+        pending = [self.futures[name] for name in names]
+        done, notDone = futures.wait(pending, timeout)
+        if notDone:
+            raise futures.TimeoutError("Devices not ready after {} s: {}".format(
+                timeout, ", ".join(name for name in names if not self.futures[name].done())))
+        return tuple(future.result() for future in pending)
+
+    def statusText(self):
+        '''
+        One line summary of every device, e.g. for a status label
+        '''
+        with self.lock:
+            return "   ".join("{}: {}".format(name, state) for name, state in self.status.items())
+
+    def shutdown(self):
+        '''
+        Drop setups that have not started yet. Setups already running are
+        left to finish, their devices clean up on exit
+        '''
+        self.executor.shutdown(wait=False, cancel_futures=True)
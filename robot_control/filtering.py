@@ -0,0 +1,135 @@
+'''
+ * @file    filtering.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Constant velocity Kalman filter for the EM positions
+
+    Every filtered value (e.g. deltaX, deltaY, deltaZ of the sensor, or the
+    positions of several tools) is a position with its own velocity, driven
+    by white noise acceleration and measured with white noise. All values
+    share the same model, so their covariances are identical and one 2 x 2
+    covariance is propagated for all of them. The positions and velocities
+    are the two rows of a 2 x n state and every step is a handful of NumPy
+    operations on preallocated arrays.
+
+    Measurements are tied to tracker frames, so the time between updates is
+    always a whole number of frame periods. The transition and process
+    noise matrices for every gap up to MAX_GAP_FRAMES are computed once up
+    front. After a longer gap (coil out of the field volume) the filter
+    starts over from the next measurement.
+'''
+import numpy as np
+
+FRAME_PERIOD_SEC = 1 / 40       # measurement period of the Aurora
+MAX_GAP_FRAMES = 20             # restart the filter if more frames than this were missed
+MEASUREMENT_STD = 0.25          # noise of a single EM position (mm)
+ACCELERATION_STD = 20.0         # spectral density of the acceleration noise (mm/s^2), larger follows faster
+INITIAL_VELOCITY_STD = 50.0     # uncertainty of the velocity when the filter (re)starts (mm/s)
+
+class positionFilter:
+    '''
+    Smooths EM positions and predicts them ahead, e.g.
+
+        emFilter = positionFilter()
+        emFilter.update(position.delta, position.frame)
+        delta = emFilter.predict(time.perf_counter() - position.hostTime + lead)
+    '''
+    def __init__(self, numValues=3, framePeriod=FRAME_PERIOD_SEC, measurementStd=MEASUREMENT_STD,
+                 accelerationStd=ACCELERATION_STD, maxGap=MAX_GAP_FRAMES):
+        self.numValues = numValues
+        self.framePeriod = framePeriod
+        self.measurementVariance = measurementStd**2
+        self.maxGap = maxGap
+
+        # Transition F and process noise Q for a gap of k frames, index k
+        self.transition = np.zeros((maxGap + 1, 2, 2))
+        self.processNoise = np.zeros((maxGap + 1, 2, 2))
+        q = accelerationStd**2
+        for k in range(1, maxGap + 1):
+            dt = k*framePeriod
+            self.transition[k] = ((1.0, dt), (0.0, 1.0))
+            self.processNoise[k] = ((q*dt**3/3, q*dt**2/2), (q*dt**2/2, q*dt))
+        self.initialCovariance = np.array(((self.measurementVariance, 0.0), (0.0, INITIAL_VELOCITY_STD**2)))
+
+        self.state = np.zeros((2, numValues))           # row 0 positions, row 1 velocities (mm/s)
+        self.covariance = self.initialCovariance.copy()
+        self.gain = np.zeros(2)
+        self.innovation = np.zeros(numValues)
+        self.predicted = np.zeros(numValues)            # returned by predict()
+        self.scratch = np.zeros((2, numValues))
+        self.scratchCovariance = np.zeros((2, 2))
+        self.frame = None                               # frame of the last measurement, None before the first
+
+    def reset(self):
+        self.frame = None
+
+    def update(self, measurement, frame):
+        """ add the measurement of a new frame
+
+        Parameters
+        ----------
+        measurement : array of numValues floats
+            measured positions
+        frame : int
+            tracker frame number of the measurement
+
+        Returns
+        -------
+        numpy array
+            filtered positions at the time of the frame (a view of the
+            state, overwritten by the next update). A frame that was
+            already added leaves the state as it is
+
+        """
+        gap = None if self.frame is None else frame - self.frame
+        if gap == 0:
+            # Same frame again, it is already in the state
+            return self.state[0]
+        if gap is None or gap < 0 or gap > self.maxGap:
+            # First measurement, the frame counter went back (tracking
+            # restarted), or too long without one to trust the state
+            self.state[0] = measurement
+            self.state[1] = 0.0
+            self.covariance[:] = self.initialCovariance
+            self.frame = frame
+            return self.state[0]
+        self.frame = frame
+
+        # Predict: x = F x, P = F P F' + Q
+        F = self.transition[gap]
+        np.dot(F, self.state, out=self.scratch)
+        self.state, self.scratch = self.scratch, self.state
+        np.dot(F, self.covariance, out=self.scratchCovariance)
+        np.dot(self.scratchCovariance, F.T, out=self.covariance)
+        self.covariance += self.processNoise[gap]
+
+        # Correct with H = [1 0]: K = P H' / (H P H' + R), x += K (z - H x), P -= K H P
+        np.divide(self.covariance[:, 0], self.covariance[0, 0] + self.measurementVariance, out=self.gain)
+        np.subtract(measurement, self.state[0], out=self.innovation)
+        self.state[0] += self.gain[0]*self.innovation
+        self.state[1] += self.gain[1]*self.innovation
+        np.outer(self.gain, self.covariance[0], out=self.scratchCovariance)
+        self.covariance -= self.scratchCovariance
+        return self.state[0]
+
+    def predict(self, horizon):
+        """ positions horizon seconds after the last measured frame
+
+        Parameters
+        ----------
+        horizon : float
+            how far ahead to predict (seconds), e.g. the age of the last
+            position plus the time until the next pressure takes effect
+
+        Returns
+        -------
+        numpy array
+            predicted positions (overwritten by the next predict)
+
+        """
+        np.multiply(self.state[1], horizon, out=self.predicted)
+        self.predicted += self.state[0]
+        return self.predicted
+
+    @property
+    def velocity(self):
+        return self.state[1]
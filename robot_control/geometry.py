@@ -0,0 +1,134 @@
+'''
+ * @file    geometry.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Map a position error onto the channels of the robot
+
+    Each channel pushes the tip along a fixed unit vector in the (z, x)
+    plane. Stacking them as columns gives the 2 x n matrix A used by the
+    force vector calculation, which finds the channel effort epsi with
+    A @ epsi = err_r. With 3 channels in a plane the system has infinitely
+    many solutions, and the unbounded least squares answer is the minimum
+    norm one, pinv(A) @ err_r. The pseudoinverse only depends on the
+    geometry, so it is computed once here instead of on every tick.
+'''
+from math import sqrt, radians, sin, cos
+import itertools
+import numpy as np
+
+# Unit vectors of channels 0, 1 and 2 (columns) of the three channel robot
+THREE_CHANNEL_DIRECTIONS = ((sqrt(3)/2, -sqrt(3)/2, 0.0),
+                            (1/2, 1/2, -1.0))
+
+class ChannelGeometry:
+    '''
+    Precomputed solver for the channel effort of a robot geometry
+    '''
+    def __init__(self, directions=THREE_CHANNEL_DIRECTIONS):
+        self.A = np.array(directions, dtype=float)      # 2 x numChannels, one unit vector per column
+        self.numChannels = self.A.shape[1]
+        self.pinv = np.linalg.pinv(self.A)              # numChannels x 2
+        self.gram = self.A.T @ self.A                   # used by the bounded solver for gradients
+
+        # Pseudoinverse of every subset of the columns for the bounded solver,
+        # keyed by the tuple of channels that are free to move
+        self.subsetPinv = {}
+        channels = range(self.numChannels)
+        for size in range(1, self.numChannels + 1):
+            for free in itertools.combinations(channels, size):
+                self.subsetPinv[free] = np.linalg.pinv(self.A[:, free])
+
+    @classmethod
+    def fromAngles(cls, degrees):
+        '''
+        Geometry with one channel per angle (degrees, measured from the z
+        axis of the (z, x) plane towards x), fromAngles([30, 150, 270]) is
+        the three channel robot
+        '''
+        angles = [radians(angle) for angle in degrees]
+        return cls(([cos(angle) for angle in angles], [sin(angle) for angle in angles]))
+
+    def solve(self, err, out=None):
+        """ minimum norm channel effort for a position error
+
+        Parameters
+        ----------
+        err : array of 2 floats
+            position error (z, x)
+        out : numpy array of numChannels floats
+            where to write the result, allocated if not given
+
+        Returns
+        -------
+        numpy array
+            channel effort, same as scipy.optimize.lsq_linear(A, err).x
+
+        """
+        return np.dot(self.pinv, err, out=out)
+
+    def solveBounded(self, err, lower, upper, out=None, maxIterations=None):
+        """ channel effort for a position error with every channel kept in [lower, upper]
+
+        Active set solver: start from the unbounded solution, pin channels
+        that leave their bounds to the bound and re-solve for the others
+        with the precomputed pseudoinverse of the free columns. A pinned
+        channel is released again when the gradient shows the residual
+        would shrink by moving it back inside. Gives the same residual as
+        scipy.optimize.lsq_linear(A, err, bounds=(lower, upper)), and
+        prefers the minimum norm answer when several solutions fit exactly.
+
+        Parameters
+        ----------
+        err : array of 2 floats
+            position error (z, x)
+        lower, upper : float or array of numChannels floats
+            bounds on the effort of each channel
+        out : numpy array of numChannels floats
+            where to write the result, allocated if not given
+        maxIterations : int
+            upper limit on active set changes, 2 * numChannels + 1 by default
+
+        Returns
+        -------
+        numpy array
+            bounded channel effort
+
+        """
+        err = np.asarray(err, dtype=float)
+        lower = np.broadcast_to(np.asarray(lower, dtype=float), (self.numChannels,))
+        upper = np.broadcast_to(np.asarray(upper, dtype=float), (self.numChannels,))
+        if out is None:
+            out = np.empty(self.numChannels)
+        if maxIterations is None:
+            maxIterations = 2 * self.numChannels + 1
+
+        np.dot(self.pinv, err, out=out)
+        if np.all(out >= lower) and np.all(out <= upper):
+            return out
+
+        # Pin the most violated channel first, one at a time
+        pinned = np.zeros(self.numChannels, dtype=bool)
+        for _ in range(maxIterations):
+            below = lower - out
+            above = out - upper
+            violation = np.maximum(below, above)
+            violation[pinned] = 0.0
+            worst = int(np.argmax(violation))
+            if violation[worst] > 0.0:
+                out[worst] = lower[worst] if below[worst] > 0.0 else upper[worst]
+                pinned[worst] = True
+            else:
+                # Feasible, release a pinned channel whose gradient points back inside
+                gradient = self.gram @ out - self.A.T @ err
+                release = pinned & (((out <= lower) & (gradient < 0.0)) | ((out >= upper) & (gradient > 0.0)))
+                if not release.any():
+                    break
+                pinned[int(np.argmax(np.abs(gradient) * release))] = False
+
+            free = tuple(np.flatnonzero(~pinned))
+            if not free:
+                break
+            residual = err - self.A[:, pinned] @ out[pinned]
+            out[list(free)] = self.subsetPinv[free] @ residual
+
+        np.clip(out, lower, upper, out=out)
+        return out
@@ -0,0 +1,159 @@
+'''
+ * @file    lifecycle.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Stop and swap controller threads without interrupting their I/O
+
+    Controller threads used to be killed by injecting SystemExit with
+    PyThreadState_SetAsyncExc. That could land halfway through a serial
+    transaction and leave the Arduino waiting for the rest of a command.
+
+    A controllerThread instead checks its stop event between ticks, and
+    every wait inside a tick either is short or wakes up on the event, so
+    a tick is never cut off. stop() sets the event and waits a bounded time
+    for the thread to finish its tick. Only then does it touch the Arduino
+    from the calling thread. It waits for any pipelined commands still in
+    flight and, when shutting down, vents every channel to the default
+    pressure.
+
+    controllerSupervisor runs one controller at a time. Swapping stops the
+    active controller without venting and starts the next one on the same
+    device handles, so a switch takes about one tick of the old controller.
+'''
+import threading
+import time
+import logging
+
+STOP_TIMEOUT_SEC = 1.0      # longest stop() waits for a controller to finish its tick
+DRAIN_TIMEOUT_SEC = 0.5     # longest stop() waits for pipelined Arduino commands still in flight
+
+class controllerThread(threading.Thread):
+    '''
+    Base of the controller threads, e.g.
+
+        class openController(controllerThread):
+            def run(self):
+                self.board = arduino
+                while self.running():
+                    ...
+
+        controller = openController('Open controller')
+        controller.start()
+        ...
+        controller.stop()
+
+    Waits inside a tick should be short or use self.stopEvent (e.g.
+    scheduler.wait(self.stopEvent) or self.stopEvent.wait(seconds)) so
+    stop() doesn't have to wait for them
+    '''
+    def __init__(self, name):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.stopEvent = threading.Event()
+        self.board = None       # Arduino the controller drives, drained and vented by stop() once the thread is done
+
+    def running(self):
+        return not self.stopEvent.is_set()
+
+    def stop(self, vent=True, timeout=STOP_TIMEOUT_SEC):
+        """ ask the controller to stop after its current tick and wait for it
+
+        Parameters
+        ----------
+        vent : bool
+            command the default pressure on every channel once the
+            controller has stopped, False leaves the pressures where they
+            are (e.g. for the next controller to take over)
+        timeout : float
+            longest time to wait for the thread to finish (seconds)
+
+        Returns
+        -------
+        bool
+            False if the thread is still running after timeout, the
+            Arduino is left alone then so two threads never write to it
+
+        """
+        self.stopEvent.set()
+        if threading.current_thread() is self:
+            return False
+        if self.is_alive():
+            self.join(timeout)
+        if self.is_alive():
+            logging.error("Controller %s did not stop within %.3f s, leaving the Arduino alone", self.name, timeout)
+            return False
+
+        if self.board is not None:
+            try:
+                drained = self.board.vent(timeout=DRAIN_TIMEOUT_SEC) if vent else self.board.flush(DRAIN_TIMEOUT_SEC)
+                if not drained:
+                    logging.error("Arduino commands of controller %s still in flight after %.3f s",
+                                  self.name, DRAIN_TIMEOUT_SEC)
+            except Exception:
+                logging.exception("Venting the Arduino after controller %s failed", self.name)
+        return True
+
+class controllerSupervisor:
+    '''
+    Runs at most one controllerThread at a time, e.g.
+
+        controllers = controllerSupervisor()
+        controllers.swap(openControllerThread('Open controller'))
+        controllers.swap(pidControllerThread('PID controller'))
+        controllers.stop()
+    '''
+    def __init__(self, timeout=STOP_TIMEOUT_SEC):
+        self.timeout = timeout
+        self.active = None          # controller running now
+        self.lock = threading.Lock()
+        self.switches = 0
+        self.lastSwitchSec = 0.0    # how long the last swap took (seconds)
+        self.maxSwitchSec = 0.0
+
+    def swap(self, controller):
+        """ stop the active controller, leaving the pressures as they are, and start controller
+
+        Parameters
+        ----------
+        controller : controllerThread
+            controller to run next, not started yet
+
+        Returns
+        -------
+        float
+            seconds the switch took
+
+        Raises
+        ------
+        IOError
+            If the active controller doesn't stop in time. The new one isn't
+            started then since both would drive the Arduino.
+
+        """
+        start = time.perf_counter()
+        with self.lock:
+            if self.active is not None:
+                if not self.active.stop(vent=False, timeout=self.timeout):
+                    raise IOError("Controller {} is still running, not starting {}".format(self.active.name, controller.name))
+            self.active = controller
+            controller.start()
+
+        self.lastSwitchSec = time.perf_counter() - start
+        self.maxSwitchSec = max(self.maxSwitchSec, self.lastSwitchSec)
+        self.switches += 1
+        return self.lastSwitchSec
+
+    def stop(self, vent=True):
+        '''
+        Stop the active controller, venting to the default pressure unless
+        vent is False. Returns False if it didn't stop in time
+        '''
+        with self.lock:
+            if self.active is None:
+                return True
+            stopped = self.active.stop(vent, self.timeout)
+            if stopped:
+                self.active = None
+            return stopped
+
+    def __repr__(self):
+        return 'controllerSupervisor(active={}, switches={}, lastSwitch={:.4f}, maxSwitch={:.4f})'.format(
+            None if self.active is None else self.active.name, self.switches, self.lastSwitchSec, self.maxSwitchSec)
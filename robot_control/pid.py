@@ -0,0 +1,113 @@
+'''
+ * @file    pid.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   PID controller on the channel pressures shared by all control scripts
+
+    The controllers command a pressure change on top of the measured
+    pressure of every channel:
+
+        integral += (error + previousError)/2 * dT      clipped to +-integralLimit
+        P_des = P_act + kp*error + ki*integral + kd*(error - previousError)/dT
+                                                        clipped to [lower, upper]
+
+    All channels are updated at once with NumPy operations that write into
+    arrays allocated when the controller is created, so a tick allocates
+    nothing and any number of controllers can run side by side.
+'''
+import numpy as np
+
+class PIDController:
+    '''
+    Vectorized PID controller for numChannels channels, e.g.
+
+        pid = PIDController(3, kp=0.03, ki=0.01, kd=0.001, integralLimit=10, lower=9.0, upper=max_pressure)
+        P_des = pid.update(epsi, P_act, dT)
+
+    Gains and limits can be a float for every channel or one value per channel
+    '''
+    def __init__(self, numChannels, kp, ki=0.0, kd=0.0, integralLimit=np.inf, lower=-np.inf, upper=np.inf,
+                 initialOutput=0.0):
+        self.numChannels = numChannels
+        self.kp = self.channelArray(kp)
+        self.ki = self.channelArray(ki)
+        self.kd = self.channelArray(kd)
+        self.integralUpper = self.channelArray(integralLimit)
+        self.integralLower = -self.integralUpper
+        self.lower = self.channelArray(lower)
+        self.upper = self.channelArray(upper)
+
+        self.error = np.zeros(numChannels)
+        self.previousError = np.zeros(numChannels)
+        self.integral = np.zeros(numChannels)
+        self.derivative = np.zeros(numChannels)
+        self.output = self.channelArray(initialOutput)     # desired pressures of the last update
+        self.scratch = np.zeros(numChannels)
+
+    def channelArray(self, value):
+        array = np.empty(self.numChannels)
+        array[:] = value
+        return array
+
+    def setGains(self, kp=None, ki=None, kd=None):
+        '''
+        Change the gains that are given, a float sets every channel
+        '''
+        if kp is not None:
+            self.kp[:] = kp
+        if ki is not None:
+            self.ki[:] = ki
+        if kd is not None:
+            self.kd[:] = kd
+
+    def reset(self, output=None):
+        '''
+        Forget the integral and the previous error, optionally set the output
+        '''
+        self.error.fill(0.0)
+        self.previousError.fill(0.0)
+        self.integral.fill(0.0)
+        self.derivative.fill(0.0)
+        if output is not None:
+            self.output[:] = output
+
+    def update(self, error, actual, dT):
+        """ run one controller step
+
+        Parameters
+        ----------
+        error : float or array of numChannels floats
+            error of every channel (e.g. epsi from the force vector calculation)
+        actual : float or array of numChannels floats
+            measured pressure of every channel (psi)
+        dT : float or array of numChannels floats
+            time since the last update (seconds)
+
+        Returns
+        -------
+        numpy array
+            desired pressures within [lower, upper], the controller's own
+            output array that the next update overwrites
+
+        """
+        self.error[:] = error
+
+        # Trapezoidal integral, clipped so it can't wind up
+        np.add(self.error, self.previousError, out=self.scratch)
+        self.scratch *= 0.5
+        self.scratch *= dT
+        self.integral += self.scratch
+        np.clip(self.integral, self.integralLower, self.integralUpper, out=self.integral)
+
+        np.subtract(self.error, self.previousError, out=self.derivative)
+        self.derivative /= dT
+
+        np.multiply(self.kp, self.error, out=self.output)
+        np.multiply(self.ki, self.integral, out=self.scratch)
+        self.output += self.scratch
+        np.multiply(self.kd, self.derivative, out=self.scratch)
+        self.output += self.scratch
+        self.output += actual
+        np.clip(self.output, self.lower, self.upper, out=self.output)
+
+        self.previousError[:] = self.error
+        return self.output
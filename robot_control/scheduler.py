@@ -0,0 +1,100 @@
+'''
+ * @file    scheduler.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Run a control loop at a fixed rate
+
+    Ticks are released on absolute time.perf_counter() deadlines, one
+    period apart, so the loop period doesn't drift with how long the work
+    (serial round trips, EM reads) takes. The time actually measured
+    between the start of two ticks is handed back to the loop, so the
+    integral and derivative terms use the real dt instead of an estimate.
+'''
+import time
+
+# What to do when a tick runs past one or more deadlines
+SKIP = "skip"           # drop the missed ticks and wait for the next deadline on the grid
+CATCH_UP = "catch up"   # run the missed ticks back to back until the loop is on schedule again
+
+DEFAULT_MAX_CATCH_UP = 3    # with CATCH_UP, ticks further behind than this are dropped anyway
+SPIN_SEC = 0.0005           # busy wait this long before a deadline instead of trusting sleep to wake up on time
+
+class fixedRateScheduler:
+    '''
+    Call wait() at the top of every tick of the control loop:
+
+        scheduler = fixedRateScheduler(8)
+        while True:
+            dt = scheduler.wait()
+            ...
+    '''
+    def __init__(self, rateHz, policy=SKIP, maxCatchUp=DEFAULT_MAX_CATCH_UP, spin=SPIN_SEC):
+        if rateHz <= 0:
+            raise ValueError("Control rate must be positive, got {}".format(rateHz))
+        if policy not in (SKIP, CATCH_UP):
+            raise ValueError("Unknown scheduler policy '{}'".format(policy))
+        self.rateHz = rateHz
+        self.period = 1.0 / rateHz
+        self.policy = policy
+        self.maxCatchUp = maxCatchUp
+        self.spin = spin
+
+        self.deadline = None    # perf_counter() time the next tick is due
+        self.lastTick = None    # perf_counter() time the previous tick started
+        self.dt = self.period   # measured time between the starts of the last two ticks (seconds)
+
+        # Statistics
+        self.ticks = 0          # ticks released
+        self.overruns = 0       # ticks that were still running when the next one was due
+        self.missed = 0         # deadlines dropped without running a tick
+        self.maxLateness = 0.0  # latest a tick was released after its deadline (seconds)
+
+    def reset(self):
+        '''
+        Start over, the next wait() returns immediately
+        '''
+        self.deadline = None
+        self.lastTick = None
+
+    def wait(self, interrupt=None):
+        '''
+        Block until the next tick is due. Returns the time since the
+        previous tick started (one period for the first tick). If the
+        threading.Event interrupt is set while waiting, returns right away
+        without releasing a tick
+        '''
+        now = time.perf_counter()
+        if self.deadline is None:
+            self.deadline = now
+
+        remaining = self.deadline - now
+        if remaining > 0:
+            if remaining > self.spin:
+                if interrupt is None:
+                    time.sleep(remaining - self.spin)
+                elif interrupt.wait(remaining - self.spin):
+                    return self.dt
+            while time.perf_counter() < self.deadline:
+                pass
+        elif self.lastTick is not None:
+            # The previous tick ran into this one
+            self.overruns += 1
+            late = -remaining
+            behind = int(late // self.period)
+            if behind > 0:
+                dropped = behind if self.policy == SKIP else max(0, behind - self.maxCatchUp)
+                self.missed += dropped
+                self.deadline += dropped * self.period
+                late -= dropped * self.period
+            self.maxLateness = max(self.maxLateness, late)
+
+        tick = time.perf_counter()
+        if self.lastTick is not None:
+            self.dt = tick - self.lastTick
+        self.lastTick = tick
+        self.deadline += self.period
+        self.ticks += 1
+        return self.dt
+
+    def __repr__(self):
+        return 'fixedRateScheduler(rate={} Hz, ticks={}, overruns={}, missed={}, maxLateness={:.6f})'.format(
+            self.rateHz, self.ticks, self.overruns, self.missed, self.maxLateness)
@@ -0,0 +1,186 @@
+'''
+ * @file    trajectory.py
+ * @author  CU Boulder Medtronic Team 7
+ * @brief   Precomputed reference trajectories for the controllers
+
+    A trajectory is sampled once, when it is created, every resolution
+    seconds: positions, velocities and accelerations of every axis end up
+    in one (3, samples, axes) table together with the step to the next
+    sample. Looking up a time is then an index computation and one
+    multiply-add into arrays owned by the trajectory, no trig and no
+    allocation per tick however complicated the shape is.
+
+    Periodic trajectories (circle, figureEight, triangle, sinusoid) repeat
+    forever. Waypoints loaded with fromCSV are played once and then hold
+    the last position.
+
+    The shapes are the references the control scripts used to compute
+    every tick. Axes are in the order the controllers use, (z, x) for the
+    three channel robot and (z,) for the single channel one.
+'''
+import math
+import numpy as np
+
+DEFAULT_RESOLUTION_SEC = 0.005      # time between two precomputed samples, linear interpolation in between
+
+POSITION = 0        # rows of trajectory.table and of the array sample() returns
+VELOCITY = 1
+ACCELERATION = 2
+
+class trajectory:
+    '''
+    Reference that is looked up by time, e.g.
+
+        reference = circle(radius=15, period=60)
+        r_des[:] = reference.sample(time.perf_counter() - start)
+        feedforward = reference.velocity
+
+    Build one with the functions below or from any vectorized function
+    with fromFunction()
+    '''
+    def __init__(self, positions, resolution, periodic):
+        positions = np.asarray(positions, dtype=float)
+        if positions.ndim == 1:
+            positions = positions[:, np.newaxis]
+        if len(positions) < 2:
+            raise ValueError("A trajectory needs at least two samples, got {}".format(len(positions)))
+        self.resolution = resolution
+        self.periodic = periodic
+        self.numSteps = len(positions) - 1
+        self.duration = self.numSteps * resolution
+        self.numAxes = positions.shape[1]
+
+        # Central differences, across the wrap for periodic trajectories
+        # (where the last sample is the first one again)
+        if periodic:
+            cycle = positions[:-1]
+            velocities = (np.roll(cycle, -1, axis=0) - np.roll(cycle, 1, axis=0)) / (2*resolution)
+            accelerations = (np.roll(velocities, -1, axis=0) - np.roll(velocities, 1, axis=0)) / (2*resolution)
+            velocities = np.concatenate((velocities, velocities[:1]))
+            accelerations = np.concatenate((accelerations, accelerations[:1]))
+        else:
+            velocities = np.gradient(positions, resolution, axis=0)
+            accelerations = np.gradient(velocities, resolution, axis=0)
+
+        self.table = np.stack((positions, velocities, accelerations))    # (3, numSteps + 1, numAxes)
+        self.steps = np.diff(self.table, axis=1)                        # table[:, i + 1] - table[:, i]
+        self.sampled = np.zeros((3, self.numAxes))                       # filled by sample()
+        self.position = self.sampled[POSITION]
+        self.velocity = self.sampled[VELOCITY]
+        self.acceleration = self.sampled[ACCELERATION]
+
+    def sample(self, t):
+        """ look up the reference at a time
+
+        Parameters
+        ----------
+        t : float
+            seconds since the trajectory started
+
+        Returns
+        -------
+        numpy array
+            position of every axis at t. velocity and acceleration are
+            updated at the same time. All three are arrays of the
+            trajectory that the next sample() overwrites
+
+        """
+        if self.periodic:
+            t = t % self.duration
+        elif t >= self.duration:
+            # Played to the end, hold the last position
+            self.sampled[POSITION] = self.table[POSITION, -1]
+            self.sampled[VELOCITY:] = 0.0
+            return self.position
+        elif t < 0:
+            t = 0.0
+
+        index, fraction = divmod(t / self.resolution, 1.0)
+        index = min(int(index), self.numSteps - 1)
+        np.multiply(self.steps[:, index], fraction, out=self.sampled)
+        self.sampled += self.table[:, index]
+        return self.position
+
+def fromFunction(function, duration, resolution=DEFAULT_RESOLUTION_SEC, periodic=True):
+    """ precompute a trajectory from a function of time
+
+    Parameters
+    ----------
+    function : function
+        maps a NumPy array of times (seconds) to the positions at those
+        times, an array with one row per time (or a 1D array for one axis)
+    duration : float
+        length of the trajectory, the period if it is periodic (seconds)
+    resolution : float
+        time between two precomputed samples (seconds)
+    periodic : bool
+        whether the trajectory starts over after duration
+
+    Returns
+    -------
+    trajectory
+
+    """
+    numSteps = max(int(math.ceil(duration / resolution)), 1)
+    times = np.linspace(0.0, duration, numSteps + 1)
+    return trajectory(function(times), duration / numSteps, periodic)
+
+def circle(radius=15.0, period=60.0, center=(0.0, 0.0), resolution=DEFAULT_RESOLUTION_SEC):
+    """ circle in the (z, x) plane, starting at z = center + radius """
+    w = 2*math.pi/period
+    return fromFunction(lambda t: np.column_stack((center[0] + radius*np.cos(w*t), center[1] + radius*np.sin(w*t))),
+                        period, resolution)
+
+def figureEight(radius=15.0, period=60.0, center=(0.0, 0.0), resolution=DEFAULT_RESOLUTION_SEC):
+    """ figure eight in the (z, x) plane through center """
+    w = 2*math.pi/period
+    return fromFunction(lambda t: np.column_stack((center[0] + radius*np.sin(w*t),
+                                                   center[1] + radius*np.sin(w*t)*np.cos(w*t))),
+                        period, resolution)
+
+def triangle(low=50.0, high=80.0, period=30.0, resolution=DEFAULT_RESOLUTION_SEC):
+    """ one axis ramping from low up to high and back every period """
+    # Same as sawtooth(2*pi*t/period, width=0.5) scaled to [low, high]
+    return fromFunction(lambda t: low + (high - low)*(1.0 - np.abs(2.0*t/period - 1.0)), period, resolution)
+
+def sinusoid(amplitude=5.0, offset=60.0, frequency=0.1, resolution=DEFAULT_RESOLUTION_SEC):
+    """ one axis oscillating around offset """
+    w = 2*math.pi*frequency
+    return fromFunction(lambda t: offset + amplitude*np.sin(w*t), 1.0/frequency, resolution)
+
+def fromCSV(path, resolution=DEFAULT_RESOLUTION_SEC, periodic=False):
+    """ trajectory through the waypoints of a CSV file
+
+    Parameters
+    ----------
+    path : string
+        CSV file with a header line and one waypoint per line, time in
+        seconds first and one column per axis after it, e.g. time,z,x
+    resolution : float
+        time between two precomputed samples (seconds)
+    periodic : bool
+        start over after the last waypoint, which should then be the
+        same as the first one
+
+    Returns
+    -------
+    trajectory
+        moving in straight lines between the waypoints
+
+    Raises
+    ------
+    ValueError
+        If there are fewer than two waypoints, no axis columns, or the
+        times don't increase.
+
+    """
+    waypoints = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+    if len(waypoints) < 2 or waypoints.shape[1] < 2:
+        raise ValueError("{} needs at least two waypoints with a time and a position".format(path))
+    times = waypoints[:, 0] - waypoints[0, 0]
+    if np.any(np.diff(times) <= 0):
+        raise ValueError("Waypoint times in {} must increase".format(path))
+
+    def interpolate(t):
+        return np.column_stack([np.interp(t, times, waypoints[:, axis]) for axis in range(1, waypoints.shape[1])])
+    return fromFunction(interpolate, times[-1], resolution, periodic)
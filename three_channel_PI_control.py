@@ -4,21 +4,15 @@
  * @brief   Basic 2D proportional and/or PID controller
             used for 3 channel robots
 '''
-from cmath import cos
 import NDI_communication
 import arduino_communcation
-import threading
-from queue import Queue
-import ctypes
+import robot_control
 import time
 from tkinter import *
 from tkinter import ttk
 from ttkthemes import ThemedStyle
 import logging
 from csv_logger import CsvLogger
-from math import sin, pi, sqrt, cos
-from scipy import signal as sg
-import scipy.optimize as sp_opt
 import numpy as np
 
 # Data Collection
@@ -37,7 +31,7 @@ try:
 except:
     print("Arduino or NDI sensor not connected")
 # Times used for running predefined sequences like tracking a circle
-start_time = 0      # start time for the circle signals
+start_time = 0      # start time of the reference trajectory, 0 while it isn't running
 time_diff = 0       # time difference betweeen the start and current times
 
 # <== 2X Robot Parameters ==>
@@ -78,28 +72,28 @@ We are using global positioning in our control system, however it should be conv
 to relative positioning. With global, if you orient the robot or the EM in the wrong way, the
 controllers predictions will not work and the robot will get sent in entirely the wrong direction.
 '''
-P_des = np.array([12.25, 12.25, 12.25])     # desired pressure we're sending to the Arduino (c0, c1, c2)
+P_des = np.array([12.25, 12.25, 12.25])     # desired pressure the controller starts from (c0, c1, c2)
 P_act = np.array([0.0, 0.0, 0.0])           # actual pressure read from the pressure sensor (c0, c1, c2)
 r_des = np.array([0.0, 0.0])                # desired position of robot in form (z, x)
 r_act = np.array([0.0, 0.0])                # actual position of the robot using EM sensor (z, x)
-dT = np.array([0.125, 0.125, 0.125])        # estimated time between cycles (seconds)
-int_sum = np.array([0.0, 0.0, 0.0])         # sum of the integral term
-err_r = np.array([0.0, 0.0])                # error between measured position and actual position
-epsi = np.array([0.0, 0.0, 0.0])            # stores the solution to the force vector algorithm
-epsi_prev = np.array([0.0, 0.0, 0.0])       # modified error in r (after force vector solution) for the previous time step # TODO: figure out if this should be a global value
-
-# Queue for inter-thread communication (between GUI thread and controller thread)
-commandsFromGUI = Queue()
-
-class command:
-    '''
-    Basic command format to be used in the queue. We pass along
-    id's and any other important info in field1 and field2
-    '''
-    def __init__(self, id, field1, field2):
-        self.id = id
-        self.field1 = field1
-        self.field2 = field2
+dT = np.array([0.125, 0.125, 0.125])        # time between cycles (seconds), measured by the controller every tick
+PRESSURE_RATE_HZ = 25                       # rate the pressure loop reads the pressures and streams setpoints, a tick costs two text round trips
+POSITION_RATE_HZ = 8                        # rate of the position loop, the gains were tuned at 0.125 s per cycle. None runs it on every new EM frame (retune the gains first)
+EM_FRAME_RATE_HZ = 40                       # measurement rate of the Aurora, the nominal position loop rate when POSITION_RATE_HZ is None
+MAX_SLEW_PSI_PER_SEC = 20.0                 # fastest the pressure loop moves a setpoint towards the one of the position loop, None jumps
+PRESSURE_TIMEOUT_SEC = 1.0                  # longest the position loop waits for the pressure loop's first read
+FILTER_EM_POSITION = True                   # smooth the EM position with a Kalman filter and predict it ahead, False uses raw positions
+PREDICTION_LEAD_SEC = 0.02                  # time from computing the pressures until they take effect (seconds)
+INTEGRAL_LIMIT = 10.0                       # the integral sum of every channel is kept within +-INTEGRAL_LIMIT to avoid windup
+MIN_PRESSURE = 9.0                          # lower limit of the pressure we are sending into the controller
+channelGeometry = robot_control.ChannelGeometry()   # C0, C1, C2 unit vectors and their precomputed pseudoinverse
+# (z, x) reference followed while logging. Precomputed once, swap in
+# robot_control.trajectory.figureEight() or .fromCSV('waypoints.csv') to follow something else
+reference = robot_control.trajectory.circle(radius=15, period=60)
+
+# Typed commands from the GUI thread to the controller thread. The
+# controller applies everything that arrived since its last tick at once
+commandsFromGUI = robot_control.commandBus()
 
 class GUI:
     '''
@@ -195,43 +189,38 @@ class GUI:
         '''
         Handle setting the position from the GUI
         '''
-        newCmd = command("GuiToController", "setXPosition", float(self.x_position_entry.get()))
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setPosition(1, float(self.x_position_entry.get())))     # r_des is (z, x)
 
     def GUI_handlesetZPositionCommand(self, *args):
         '''
         Handle setting the position from the GUI
         '''
-        newCmd = command("GuiToController", "setZPosition", float(self.z_position_entry.get()))
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setPosition(0, float(self.z_position_entry.get())))     # r_des is (z, x)
 
     def GUI_handleSetKpCommand(self, *args):
         '''
         Handle setting the gain from the GUI
         '''
-        newCmd = command("GuiToController", "setKp", float(self.kp_entry.get()))
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setGain('kp', float(self.kp_entry.get())))
 
     def GUI_handleSetKiCommand(self, *args):
         '''
         Handle setting the gain from the GUI
         '''
-        newCmd = command("GuiToController", "setKi", float(self.ki_entry.get()))
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setGain('ki', float(self.ki_entry.get())))
 
     def GUI_handleSetKdCommand(self, *args):
         '''
         Handle setting the gain from the GUI
         '''
-        newCmd = command("GuiToController", "setKd", float(self.kd_entry.get()))
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setGain('kd', float(self.kd_entry.get())))
 
     def GUI_handleDataDisplay(self, *args):
         '''
         Display control algorithm parameters to the GUI. When the GUI is open,
         you can press and hold enter to display all the values
         '''
-        global r_des, r_act, y_des, y_act, int_sum
+        global r_des, r_act, y_des, y_act
 
         self.x_des_label.configure(text = "X desired: " + str(round(r_des[1],3)))
         self.x_act_label.configure(text = "X actual: " + str(round(r_act[1],3)))
@@ -242,8 +231,8 @@ class GUI:
         '''
         This function handles starting of the logging. Starting the logging
         sequence also starts running a predefined trajectory like a circle.
-        You can uncomment the circle_signal call if you want to record data
-        while still maintaining manual control
+        You can remove the reference lookup in three_channel_algorithm if
+        you want to record data while still maintaining manual control
         '''
         global start_time, sample_num
 
@@ -263,14 +252,18 @@ class GUI:
             with open('data.log', 'w'):
                 pass
 
-class controllerThread(threading.Thread):
+class controllerThread(robot_control.controllerThread):
     '''
     This thread is where the main controller is run.
     This is where our PID controller lives
     '''
     def __init__(self, name):
-        threading.Thread.__init__(self)
-        self.name = name
+        robot_control.controllerThread.__init__(self, name)
+        # Controller state belongs to the thread, starting from the tuned gains
+        self.pid = robot_control.PIDController(3, k_p, k_i, k_d, integralLimit=INTEGRAL_LIMIT,
+                                               lower=MIN_PRESSURE, upper=max_pressure, initialOutput=P_des)
+        self.err_r = np.zeros(2)        # error between desired and actual position (z, x)
+        self.epsi = np.zeros(3)         # channel errors, the solution to the force vector algorithm
 
     def run(self):
         '''
@@ -278,81 +271,70 @@ class controllerThread(threading.Thread):
         Continues to look for new commands from the GUI
         and runs the three channel main.
         '''
+        # Cascade: the pressure loop owns the Arduino and streams setpoints at
+        # PRESSURE_RATE_HZ (the firmware regulates to them on every pass of
+        # its own loop), this thread is the position loop and publishes new
+        # setpoints at POSITION_RATE_HZ, each tick on a new EM frame
+        self.board = arduino
+        self.pressureLoop = robot_control.pressureLoop(arduino, self.pid.output, PRESSURE_RATE_HZ, lower=MIN_PRESSURE,
+                                                       upper=max_pressure, maxSlew=MAX_SLEW_PSI_PER_SEC)
+        self.pressureLoop.start()
+        self.positionFilter = robot_control.positionFilter() if FILTER_EM_POSITION else None
+        self.positionStats = robot_control.loopStats('position', POSITION_RATE_HZ or EM_FRAME_RATE_HZ)
+        scheduler = robot_control.fixedRateScheduler(POSITION_RATE_HZ) if POSITION_RATE_HZ else None
         try:
-            while True:
-                # Look for new commands
-                if (commandsFromGUI.empty() == False):
-                    newCmd = commandsFromGUI.get()
-                    self.handleGUICommand(newCmd)
-
-                self.three_channel_main()
-                # Slow down controller so we give the arduino some
-                # time to relax. Don't want to be sending serial commands
-                # every loop the arduino executes
-                time.sleep(.07)
-
-        finally:
-            print('Controller thread teminated')
-
-    def circle_signal(self):
-        '''
-        Function will send position commands to follow a circle
-        '''
-        global start_time, r_des, time_diff
-
-        current_time = time.time()              # current time compared to start time
-
-        time_diff = current_time - start_time   # time difference used in the signal
-
-        radius = 15                             # radius of the circle in mm
-
-        T = 60                                  # period of the circle (in seconds)
-        center = np.array([0, 0])           # center of the circle script (z, x)
-
-        # parametric equations that represent circle as a function of time
-        r_des[0] = center[0] + radius*cos((2*pi/T)*time_diff)        # in z
-        r_des[1] = center[1] + radius*sin((2*pi/T)*time_diff)        # in x
-
-    def fig_eight_signal(self):
-        '''
-        Function will try to send robot in a figure 8
-        '''
-        global start_time, r_des, time_diff
-
-        current_time = time.time()              # current time compared to start time
+            while self.running():
+                if scheduler is not None:
+                    scheduler.wait(self.stopEvent)
+                    if not self.running():
+                        break
 
-        time_diff = current_time - start_time   # time difference used in the signal
+                # Apply every command sent since the last tick, the last value of each setting wins
+                commandsFromGUI.dispatch(self.handleGUICommand)
 
-        radius = 15                             # "radius" of the figure eight in mm
+                # Blocks until the tracker has measured a frame this loop hasn't used yet
+                position = ndi.waitForNextFrame()
 
-        T = 60                                  # period of the figure eight (in seconds)
-        center = np.array([0, 0])           # center of the figure eight script (z, x)
+                # Integral and derivative terms use the measured time since the last tick
+                dT[:] = self.positionStats.tick()
+                self.three_channel_main(position)
+                self.positionStats.done()
 
-        # parametric equations that represent figure eight as a function of time
-        r_des[0] = center[0] + radius*sin((2*pi/T)*time_diff)                                # in z
-        r_des[1] = center[1] + radius*sin((2*pi/T)*time_diff)*cos((2*pi/T)*time_diff)        # in x
-
-    def three_channel_main(self):
-        '''
-        main function used in thread to perform 3 channel algorithm
-        '''
-        global time_diff, r_des, r_act, P_des, P_act, csv_logger, sample_num
-
-        # get the actual pressure from the pressure sensor
-        P_act[0] = arduino.getActualPressure(arduino.channel0)
-        P_act[1] = arduino.getActualPressure(arduino.channel1)
-        P_act[2] = arduino.getActualPressure(arduino.channel2)
-
-        # get actual position from EM sensor
-        position = ndi.getPositionInRange()
-        r_act[1] = position.deltaX          # x dim
-        r_act[0] = position.deltaZ          # y dim
-        # print("r_act[0]: " + str(r_act[0]) + "r_act[1]: " + str(r_act[1]))
-
-        # perform 3 channel control algorithm
-        self.three_channel_algorithm()
-
-        # send the desired pressure into Arduino
+        finally:
+            self.pressureLoop.stop()
+            print('Controller thread teminated', self.positionStats, scheduler)
+            print('Pressure loop', self.pressureLoop)
+            print('GUI commands', commandsFromGUI)
+            print('EM tracking', ndi.stats)
+
+    def three_channel_main(self, position):
+        '''
+        main function used in thread to perform 3 channel algorithm on a new EM position
+        '''
+        global time_diff, r_des, r_act, P_act, csv_logger, sample_num
+        P_des = self.pid.output
+
+        # newest pressures measured by the pressure loop, no serial round trip.
+        # Raises IOError, ending the controller, if the pressure loop has stopped
+        self.pressureLoop.pressures(out=P_act, timeout=PRESSURE_TIMEOUT_SEC)
+        if position:
+            delta = position.delta
+            if self.positionFilter is not None:
+                # Smoothed position of the tip at the time the new pressures take effect
+                self.positionFilter.update(position.delta, position.frame)
+                delta = self.positionFilter.predict(position.age() + PREDICTION_LEAD_SEC)
+            r_act[1] = delta[0]          # x dim
+            r_act[0] = delta[2]          # y dim
+            # print("r_act[0]: " + str(r_act[0]) + "r_act[1]: " + str(r_act[1]))
+
+            # perform 3 channel control algorithm
+            self.three_channel_algorithm()
+        else:
+            # EM coil out of the field volume, the pressure loop keeps
+            # regulating to the last desired pressures
+            logging.warning("No EM position this tick: %s", position)
+
+        # hand the desired pressures to the pressure loop
         self.sendDesiredPressure()
 
         # Log all control variables if needed
@@ -369,52 +351,33 @@ class controllerThread(threading.Thread):
         '''
         Proportional/PID feedback loop algorithm (vector based solution -- includes dot product and bounded least squares solution)
         '''
-        global r_des, r_act, err_r, P_des, P_act, k_p, k_i, k_d, dT, int_sum, epsi, epsi_prev, start_time
+        global r_des, r_act, P_act, dT, start_time, time_diff
 
-        # If user has started logging, start the circle signal. You could
-        # also run the figure 8 here if you would like.
+        # If user has started logging, follow the reference trajectory
+        # (a circle unless reference was changed at the top of the file)
         if start_time > 0:
-            self.circle_signal()
+            time_diff = time.time() - start_time
+            r_des[:] = reference.sample(time_diff)
 
         # Calculate the error between current and desired positions
-        err_r = r_des - r_act
+        np.subtract(r_des, r_act, out=self.err_r)
 
         # perform force vector calculations
         self.forceVectorCalc()
 
-        # Calculate the integral sum for integral control
-        int_sum = int_sum + 0.5*(epsi + epsi_prev)*dT   # these are all element-wise operations
-        for i in range(len(int_sum)):                   # checks the integral sum to see if it's in range (hardcoded integral windup)
-            if int_sum[i] > 10:
-                int_sum[i] = 10
-            elif int_sum[i] < -10:
-                int_sum[i] = -10
-
-        # Calculate the derivative term of the controller
-        deriv = (epsi - epsi_prev)/dT
-
         # < ------- Feedback controller --------- >
-        del_P_des = k_p*epsi + k_i*(int_sum) + k_d*deriv    # should be element-wise operations
-        P_des = P_act + del_P_des
-
-        # Update the error value for next iteration of epsi_prev
-        epsi_prev = epsi
+        # P_des = P_act + k_p*epsi + k_i*int_sum + k_d*deriv for every channel,
+        # with the integral sum and P_des clipped to their limits
+        self.pid.update(self.epsi, P_act, dT)
 
     def forceVectorCalc(self):
         '''
         calculates the force vector solution for the controller given the error vector and the unit vectors of each channel
         '''
-        global err_r, epsi
-
-        # <----- Bounded least squares implementation ----->
-        # array that contains C1, C2, C3 unit vectors
-        A = np.array([[sqrt(3)/2, -sqrt(3)/2, 0], [1/2, 1/2, -1]])
-
-        # perform unbounded least squares
-        sol = sp_opt.lsq_linear(A, err_r)
-
-        # return the solution to the optimization (m, n, p)
-        epsi = sol.x
+        # <----- Least squares implementation ----->
+        # minimum norm solution (m, n, p) of A @ epsi = err_r using the
+        # pseudoinverse precomputed for the channel unit vectors
+        channelGeometry.solve(self.err_r, out=self.epsi)
         # print("epsi: ", epsi)
 
         # # <----- Dot product method ----->
@@ -422,9 +385,9 @@ class controllerThread(threading.Thread):
         # # method, but we chose to stick with least squares.
 
         # # develop channel unit vectors
-        # C0 = A[:, 0]
-        # C1 = A[:, 1]
-        # C2 = A[:, 2]
+        # C0 = channelGeometry.A[:, 0]
+        # C1 = channelGeometry.A[:, 1]
+        # C2 = channelGeometry.A[:, 2]
 
         # # dot product of error vector along the channel vectors
         # epsi[0] = np.dot(err_r, C0)
@@ -434,25 +397,13 @@ class controllerThread(threading.Thread):
 
     def sendDesiredPressure(self):
         '''
-        convert P_des and send this pressure into the Arduino
+        publish P_des to the pressure loop, which streams it to the Arduino
         '''
-        global P_des
         # Safety check so we don't the arduino a super high or low pressure!
-        # it will blow up if you have the wrong bounds
-        for i in range(len(P_des)):
-            if P_des[i] < 9.0:
-                # lower limit of the pressure we are sending into the controller
-                P_des[i] = 9.0
-            elif P_des[i] > max_pressure[i]:
-                # higher limit of the pressure we are sending into the controller
-                P_des[i] = max_pressure[i]
-
-        # send each channel pressure
-        # We chose to send them individually so that we can control
-        # any number of channels at a time
-        arduino.sendDesiredPressure(arduino.channel0, float(P_des[0]))
-        arduino.sendDesiredPressure(arduino.channel1, float(P_des[1]))
-        arduino.sendDesiredPressure(arduino.channel2, float(P_des[2]))
+        # it will blow up if you have the wrong bounds. The controller keeps
+        # P_des between MIN_PRESSURE and max_pressure, and the pressure loop
+        # clips to the same limits again
+        self.pressureLoop.setSetpoints(self.pid.output)
 
     def handleGUICommand(self, newCmd):
         '''
@@ -461,50 +412,18 @@ class controllerThread(threading.Thread):
         '''
         global r_des, k_p, k_i, k_d
 
-        if (newCmd.id == "GuiToController"):
-            if (newCmd.field1 == "setXPosition"):
-                r_des[1] = newCmd.field2
-            elif (newCmd.field1 == "setZPosition"):
-                r_des[0] = newCmd.field2
-            elif (newCmd.field1 == "setKp"):
-                # This will set Kp for all channels at once
-                k_p[0] = newCmd.field2
-                k_p[1] = newCmd.field2
-                k_p[2] = newCmd.field2
-                logging.debug("\nCommand recieved to set proportional gain to", k_p)
-            elif (newCmd.field1 == "setKi"):
-                # This will set Ki for all channels at once
-                k_i[0] = newCmd.field2
-                k_i[1] = newCmd.field2
-                k_i[2] = newCmd.field2
-                logging.debug("\nCommand recieved to set integral gain to", k_i)
-            elif (newCmd.field1 == "setKd"):
-                # This will set Kd for all channels at once
-                k_d[0] = newCmd.field2
-                k_d[1] = newCmd.field2
-                k_d[2] = newCmd.field2
-                logging.debug("\nCommand recieved to set integral gain to", k_d)
-
-    def get_id(self):
-        '''
-        returns id of the respective thread
-        '''
-        if hasattr(self, '_thread_id'):
-            return self._thread_id
-        for id, thread in threading._active.items():
-            if thread is self:
-                return id
+        if isinstance(newCmd, robot_control.setPosition):
+            r_des[newCmd.axis] = newCmd.position
+        elif isinstance(newCmd, robot_control.setGain):
+            # The GUI sets a gain for all channels at once
+            gains = {'kp': k_p, 'ki': k_i, 'kd': k_d}[newCmd.term]
+            if newCmd.channel is None:
+                gains[:] = newCmd.value
+            else:
+                gains[newCmd.channel] = newCmd.value
+            self.pid.setGains(**{newCmd.term: gains})
+            logging.debug("Command recieved to set %s to %s", newCmd.term, gains)
 
-    def raise_exception(self):
-        '''
-        raise exception for controller thread
-        '''
-        thread_id = self.get_id()
-        res = ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id,
-              ctypes.py_object(SystemExit))
-        if res > 1:
-            ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, 0)
-            print('Exception raise failure')
 
 
 def main():
@@ -523,9 +442,9 @@ def main():
     GUI(root)
     root.mainloop()
 
-    # Kill controller once GUI is exited
-    cThread.raise_exception()
-    cThread.join()
+    # Stop the controller once GUI is exited, it finishes its tick and the
+    # Arduino is vented to the default pressure
+    cThread.stop()
 
 if __name__ == "__main__":
     main()
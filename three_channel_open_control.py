@@ -6,17 +6,13 @@
 '''
 import NDI_communication
 import arduino_communcation
-import threading
-from queue import Queue
-import ctypes
+import robot_control
 import time
 from tkinter import *
 from tkinter import ttk
 from ttkthemes import ThemedStyle
 import logging
 from csv_logger import CsvLogger
-from math import sin, pi
-from scipy import signal as sg
 import numpy as np
 import random
 
@@ -34,19 +30,9 @@ except:
 P_des = np.array([12.25, 12.25, 12.25])     # desired pressure we're sending to the Arduino (c0, c1, c2)
 P_act = np.array([0.0, 0.0, 0.0])           # actual pressure read from the pressure sensor (c0, c1, c2)
 
-# Queue for inter-thread communication (between GUI thread and controller thread)
-commandsFromGUI = Queue()
-
-class command:
-    '''
-    Basic command format to be used in the queue. We pass along
-    id's and any other important info in field1 and field2
-    '''
-    def __init__(self, id, field1, field2, field3):
-        self.id = id
-        self.field1 = field1
-        self.field2 = field2
-        self.field3 = field3
+# Typed commands from the GUI thread to the controller thread. The
+# controller applies everything that arrived since its last tick at once
+commandsFromGUI = robot_control.commandBus()
 
 class GUI:
     '''
@@ -122,22 +108,19 @@ class GUI:
         '''
         Handle setting the channel in pressure 0
         '''
-        newCmd = command("Arduino", "setPressure", 0, float(self.channel0_entry.get())) # arduino.channel0
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setPressure(0, float(self.channel0_entry.get()))) # arduino.channel0
 
     def GUI_setChannel1(self, *args):
         '''
         Handle setting the channel in pressure 1
         '''
-        newCmd = command("Arduino", "setPressure", 1, float(self.channel1_entry.get())) # arduino.channel1
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setPressure(1, float(self.channel1_entry.get()))) # arduino.channel1
 
     def GUI_setChannel2(self, *args):
         '''
         Handle setting the channel in pressure 2
         '''
-        newCmd = command("Arduino", "setPressure", 2, float(self.channel2_entry.get())) # arduino.channel2
-        commandsFromGUI.put(newCmd)
+        commandsFromGUI.put(robot_control.setPressure(2, float(self.channel2_entry.get()))) # arduino.channel2
 
     def GUI_handleDataDisplay(self, *args):
         '''
@@ -166,14 +149,13 @@ class GUI:
             with open('data.log', 'w'):
                 pass
 
-class controllerThread(threading.Thread):
+class controllerThread(robot_control.controllerThread):
     '''
     This thread is where the main controller is run
     for the open controller
     '''
     def __init__(self, name):
-        threading.Thread.__init__(self)
-        self.name = name
+        robot_control.controllerThread.__init__(self, name)
 
     def run(self):
         '''
@@ -181,21 +163,22 @@ class controllerThread(threading.Thread):
         Continues to look for new commands from the GUI.
         and runs the three channel main.
         '''
+        self.board = arduino
         try:
-            while True:
-                # Look for new commands
-                if (commandsFromGUI.empty() == False):
-                    newCmd = commandsFromGUI.get()
-                    self.handleGUICommand(newCmd)
+            while self.running():
+                # Apply every command sent since the last tick, the last pressure of each channel wins
+                commandsFromGUI.dispatch(self.handleGUICommand)
 
                 self.three_channel_main()
                 # Slow down controller so we give the arduino some
                 # time to relax. Don't want to be sending serial commands
-                # every loop the arduino executes
-                time.sleep(.07)
+                # every loop the arduino executes. Wakes up right away
+                # when the controller is stopped
+                self.stopEvent.wait(.07)
 
         finally:
             print('Controller thread teminated')
+            print('GUI commands', commandsFromGUI)
 
     def three_channel_main(self):
         '''
@@ -214,14 +197,10 @@ class controllerThread(threading.Thread):
                 P_des[channel] = 16.0
 
         # get the actual pressure from the pressure sensor
-        P_act[0] = arduino.getActualPressure(arduino.channel0)
-        P_act[1] = arduino.getActualPressure(arduino.channel1)
-        P_act[2] = arduino.getActualPressure(arduino.channel2)
+        P_act[:] = arduino.getActualPressures()
 
         # send the desired pressure into Arduino
-        arduino.sendDesiredPressure(arduino.channel0, float(P_des[0]))
-        arduino.sendDesiredPressure(arduino.channel1, float(P_des[1]))
-        arduino.sendDesiredPressure(arduino.channel2, float(P_des[2]))
+        arduino.sendDesiredPressures(float(P_des[0]), float(P_des[1]), float(P_des[2]))
 
     def handleGUICommand(self, newCmd):
         '''
@@ -230,30 +209,9 @@ class controllerThread(threading.Thread):
         '''
         global P_des
 
-        if (newCmd.id == "Arduino"):
-            if (newCmd.field1 == "setPressure"):
-                P_des[newCmd.field2] = newCmd.field3
-
-    def get_id(self):
-        '''
-        returns id of the respective thread
-        '''
-        if hasattr(self, '_thread_id'):
-            return self._thread_id
-        for id, thread in threading._active.items():
-            if thread is self:
-                return id
+        if isinstance(newCmd, robot_control.setPressure):
+            P_des[newCmd.channel] = newCmd.pressure
 
-    def raise_exception(self):
-        '''
-        raise exception for controller thread
-        '''
-        thread_id = self.get_id()
-        res = ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id,
-              ctypes.py_object(SystemExit))
-        if res > 1:
-            ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, 0)
-            print('Exception raise failure')
 
 
 def main():
@@ -271,9 +229,9 @@ def main():
     GUI(root)
     root.mainloop()
 
-    # Kill controller once GUI is exited
-    cThread.raise_exception()
-    cThread.join()
+    # Stop the controller once GUI is exited, it finishes its tick and the
+    # Arduino is vented to the default pressure
+    cThread.stop()
 
 if __name__ == "__main__":
     main()